@@ -0,0 +1,246 @@
+"""
+Latency-aware width / depth search over the ResNet (4 stages) and ResNet2 (2 stages)
+templates with BasicBlocks.
+
+  1. enumerate stage widths and depths, keep the configs under --max-params (counted
+     analytically, nothing is built)
+  2. estimate the CPU latency of the survivors from a per-layer-shape lookup table: every
+     distinct (block in/out channels, stride, input size) is timed once and cached in
+     --lut, so later searches on the same host only time new shapes
+  3. keep the Pareto front of latency against MACs (the capacity proxy) under --max-latency
+  4. train the front briefly with early stopping on validation accuracy, and print the
+     fastest configs that reach --target-acc
+
+    python arch_search.py --max-params 5000000 --max-latency 15 --target-acc 85 --epochs 15
+"""
+
+import os
+import json
+import time
+import itertools
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+from models.resnet import ResNet, ResNet2, BasicBlock
+from customTensorDataset import get_transform, load_cifar_train
+from splits import stratified_split, make_split_datasets
+from utils import evaluate_accuracy, measure_latency, progress_bar
+
+STEM_WIDTH = 64
+TEMPLATES = {
+    # family: (spatial size of every stage at 32x32 input, stage strides, pooled map size of the head)
+    'ResNet': ([32, 16, 8, 4], [1, 2, 2, 2], 1),
+    'ResNet2': ([32, 16], [1, 2], 2),
+}
+
+
+def _blocks(config):
+    # (in_planes, planes, stride, input size) of every block
+    sizes, strides, _ = TEMPLATES[config['family']]
+    in_planes, size, blocks = STEM_WIDTH, 32, []
+    for width, depth, stride, out_size in zip(config['widths'], config['depths'], strides, sizes):
+        for i in range(depth):
+            blocks.append((in_planes, width, stride if i == 0 else 1, size if i == 0 else out_size))
+            in_planes = width
+        size = out_size
+    return blocks
+
+
+def count_params(config, num_classes=10):
+    params = 3 * STEM_WIDTH * 9 + 2 * STEM_WIDTH
+    for in_planes, planes, stride, _ in _blocks(config):
+        params += in_planes * planes * 9 + planes * planes * 9 + 4 * planes
+        if stride != 1 or in_planes != planes:
+            params += in_planes * planes + 2 * planes
+    head = config['widths'][-1] * TEMPLATES[config['family']][2] ** 2
+    return params + head * num_classes + num_classes
+
+
+def count_macs(config, num_classes=10):
+    macs = 32 * 32 * 3 * STEM_WIDTH * 9
+    for in_planes, planes, stride, size in _blocks(config):
+        out = (size // stride) ** 2
+        macs += out * (in_planes * planes * 9 + planes * planes * 9)
+        if stride != 1 or in_planes != planes:
+            macs += out * in_planes * planes
+    head = config['widths'][-1] * TEMPLATES[config['family']][2] ** 2
+    return macs + head * num_classes
+
+
+def build(config):
+    if config['family'] == 'ResNet':
+        return ResNet(BasicBlock, config['depths'], widths=tuple(config['widths']))
+    return ResNet2(BasicBlock, config['depths'], widths=tuple(config['widths']))
+
+
+def enumerate_configs(max_params, base_widths=(24, 32, 40, 48, 56, 64), depth_choices=(1, 2, 3)):
+    configs = []
+    for family, (sizes, _, _) in TEMPLATES.items():
+        stages = len(sizes)
+        for base in base_widths:
+            for growth in (1.5, 2.0):
+                widths = [int(round(base * growth ** i / 8)) * 8 for i in range(stages)]
+                if family == 'ResNet2':
+                    # ResNet2 works on larger maps, use wider stages
+                    widths = [w * 2 for w in widths]
+                for depths in itertools.product(depth_choices, repeat=stages):
+                    config = {'family': family, 'widths': widths, 'depths': list(depths)}
+                    params = count_params(config)
+                    if params < max_params:
+                        config['params'] = params
+                        config['macs'] = count_macs(config)
+                        configs.append(config)
+    return configs
+
+
+class LatencyTable:
+    """Median CPU latency (ms) of single blocks / stems / heads by shape, cached in a JSON file.
+    Entries are keyed by thread count and batch size too, a table only holds for one host."""
+
+    def __init__(self, path, batch_size=1):
+        self.path = path
+        self.batch_size = batch_size
+        self.table = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.table = json.load(f)
+        self.prefix = f"t{torch.get_num_threads()}-b{batch_size}"
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self.table, f, indent=1, sort_keys=True)
+
+    def _lookup(self, key, make_module, in_channels, size):
+        key = f"{self.prefix}-{key}"
+        if key not in self.table:
+            module = make_module().eval()
+            inputs = torch.randn(self.batch_size, in_channels, size, size)
+            times = []
+            with torch.no_grad():
+                for i in range(25):
+                    start = time.perf_counter()
+                    module(inputs)
+                    if i >= 5:
+                        times.append((time.perf_counter() - start) * 1000)
+            self.table[key] = sorted(times)[len(times) // 2]
+        return self.table[key]
+
+    def block(self, in_planes, planes, stride, size):
+        return self._lookup(f"block-{in_planes}-{planes}-{stride}-{size}",
+                            lambda: BasicBlock(in_planes, planes, stride), in_planes, size)
+
+    def stem(self):
+        return self._lookup("stem", lambda: nn.Sequential(
+            nn.Conv2d(3, STEM_WIDTH, 3, padding=1, bias=False), nn.BatchNorm2d(STEM_WIDTH), nn.ReLU()), 3, 32)
+
+    def head(self, channels, size, pooled):
+        return self._lookup(f"head-{channels}-{size}-{pooled}", lambda: nn.Sequential(
+            nn.AdaptiveAvgPool2d(pooled), nn.Flatten(), nn.Linear(channels * pooled ** 2, 10)), channels, size)
+
+    def estimate(self, config):
+        sizes, _, pooled = TEMPLATES[config['family']]
+        latency = self.stem()
+        latency += sum(self.block(*block) for block in _blocks(config))
+        return latency + self.head(config['widths'][-1], sizes[-1], pooled)
+
+
+# configs not beaten by another one that is both faster and has more MACs
+def pareto_front(configs):
+    front = []
+    for config in sorted(configs, key=lambda c: (c['latency_ms'], -c['macs'])):
+        if not front or config['macs'] > front[-1]['macs']:
+            front.append(config)
+    return front
+
+
+def train_briefly(net, trainloader, validloader, max_epochs, patience, lr, device):
+    net = net.to(device)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.SGD(net.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4)
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max_epochs)
+    best_acc, best_epoch = 0.0, 0
+    for epoch in range(max_epochs):
+        net.train()
+        for batch_idx, (inputs, targets) in enumerate(trainloader):
+            inputs, targets = inputs.to(device), targets.to(device)
+            optimizer.zero_grad()
+            loss = criterion(net(inputs), targets)
+            loss.backward()
+            optimizer.step()
+            progress_bar(batch_idx, len(trainloader), 'epoch %d Loss: %.3f' % (epoch, loss.item()))
+        scheduler.step()
+        acc = evaluate_accuracy(net, validloader, device)
+        if acc > best_acc:
+            best_acc, best_epoch = acc, epoch
+        elif epoch - best_epoch >= patience:
+            print(f"early stop at epoch {epoch}, best {best_acc:.2f}% at epoch {best_epoch}")
+            break
+    return best_acc
+
+
+def describe(config):
+    return f"{config['family']} widths={config['widths']} depths={config['depths']}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency-aware ResNet width/depth search')
+    parser.add_argument('--max-params', default=5_000_000, type=int)
+    parser.add_argument('--max-latency', default=None, type=float, help='ms per batch of --latency-batch')
+    parser.add_argument('--latency-batch', default=1, type=int)
+    parser.add_argument('--lut', default='./latency_lut.json')
+    parser.add_argument('--top', default=8, type=int, help='train at most this many Pareto configs')
+    parser.add_argument('--epochs', default=15, type=int)
+    parser.add_argument('--patience', default=3, type=int)
+    parser.add_argument('--lr', default=0.05, type=float)
+    parser.add_argument('--batch-size', default=256, type=int)
+    parser.add_argument('--target-acc', default=85.0, type=float)
+    parser.add_argument('--out', default='./arch_search.json')
+    args = parser.parse_args()
+    if args.top < 1:
+        parser.error('--top must be at least 1')
+
+    configs = enumerate_configs(args.max_params)
+    print(f"{len(configs)} configs under {args.max_params} parameters")
+
+    table = LatencyTable(args.lut, args.latency_batch)
+    for config in configs:
+        config['latency_ms'] = table.estimate(config)
+    table.save()
+    if args.max_latency is not None:
+        configs = [c for c in configs if c['latency_ms'] <= args.max_latency]
+    front = pareto_front(configs)
+    print(f"Pareto front: {len(front)} configs")
+    # spread the trained candidates over the whole front, a single one is the fastest config
+    if len(front) > args.top:
+        step = (len(front) - 1) / (args.top - 1) if args.top > 1 else 0
+        front = [front[round(i * step)] for i in range(args.top)]
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    images, labels = load_cifar_train()
+    tensors = (torch.Tensor(images), torch.from_numpy(labels))
+    train_idx, valid_idx = stratified_split(labels, valid_size=0.1, seed=42)
+    train_dataset, valid_dataset = make_split_datasets(tensors, train_idx, valid_idx,
+                                                       get_transform("train"), get_transform("valid"))
+    trainloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
+    validloader = DataLoader(valid_dataset, batch_size=400, shuffle=False)
+
+    for config in front:
+        print(f"\n{describe(config)} params={config['params']} MMACs={config['macs'] / 1e6:.0f} "
+              f"est {config['latency_ms']:.2f}ms")
+        net = build(config)
+        config['measured_ms'] = measure_latency(net, args.latency_batch, 'cpu')
+        config['valid_acc'] = train_briefly(net, trainloader, validloader, args.epochs, args.patience, args.lr, device)
+
+    with open(args.out, 'w') as f:
+        json.dump(front, f, indent=2)
+    passing = sorted([c for c in front if c['valid_acc'] >= args.target_acc], key=lambda c: c['latency_ms'])
+    print(f"\nconfigs reaching {args.target_acc}% (fastest first), all results in {args.out}:")
+    for config in passing:
+        print(f"  {describe(config)}  {config['measured_ms']:.2f}ms (est {config['latency_ms']:.2f}) "
+              f"acc {config['valid_acc']:.2f}% params {config['params']}")
+    if not passing:
+        print("  none, try more --epochs or a larger --max-latency")
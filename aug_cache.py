@@ -0,0 +1,163 @@
+"""
+Pre-augmented epoch cache (data echoing, Choi et al. 2019, "Faster Neural Network Training
+with Data Echoing").
+
+Background producer processes run the train augmentation over the training images and write
+whole epochs, already shuffled and quantized to uint8, into a ring of memmapped slots under
+cache_dir. Training reads contiguous uint8 batches from the oldest ready slot and normalizes
+them on the device, so the per-sample PIL pipeline leaves the training loop.
+
+With echo_factor k > 1 an epoch slot may be served up to k times (in a new batch order) when
+the next one is not ready yet, instead of waiting for the producers. The producer and consumer
+rates are printed per epoch to size --aug-producers.
+"""
+
+import os
+import time
+import queue
+import multiprocessing as mp
+
+import numpy as np
+import torch
+
+from customTensorDataset import get_transform
+
+MEAN = (0.5101, 0.5193, 0.5548)
+STD = (0.2032, 0.2001, 0.2025)
+
+
+def _producer(images, cache_dir, num_slots, free_slots, ready_slots, producer_id, num_producers, seed, size):
+    torch.set_num_threads(1)
+    transform = get_transform("train_uint8", size)
+    num_samples = len(images)
+    epoch = producer_id
+    while True:
+        slot = free_slots.get()
+        if slot is None:
+            break
+        start = time.time()
+        torch.manual_seed(seed + epoch)
+        order = torch.randperm(num_samples).numpy()
+        data = np.memmap(os.path.join(cache_dir, f'slot{slot}.u8'), dtype=np.uint8, mode='r+',
+                         shape=(num_samples, 3, size, size))
+        for i, sample in enumerate(order):
+            # float like the torch.Tensor images of the validation / test path, ToPILImage scales
+            # both the same way, so the cached epochs match what the model is evaluated on
+            data[i] = transform(torch.from_numpy(images[sample]).float()).numpy()
+        data.flush()
+        del data
+        np.save(os.path.join(cache_dir, f'slot{slot}.order.npy'), order)
+        ready_slots.put((slot, epoch, time.time() - start))
+        epoch += num_producers
+
+
+# one pass over a cached slot, contiguous uint8 batches normalized on the device
+class _EpochView:
+    def __init__(self, cache, slot, order, batch_size, device, batch_order):
+        self.cache = cache
+        self.slot = slot
+        self.order = order
+        self.batch_size = batch_size
+        self.device = device
+        self.batch_order = batch_order
+
+    def __len__(self):
+        return len(self.batch_order)
+
+    def __iter__(self):
+        data = self.cache._open(self.slot)
+        mean = torch.tensor(MEAN, device=self.device).view(1, 3, 1, 1)
+        std = torch.tensor(STD, device=self.device).view(1, 3, 1, 1)
+        start = time.time()
+        for b in self.batch_order:
+            lo, hi = b * self.batch_size, min((b + 1) * self.batch_size, len(self.order))
+            inputs = torch.from_numpy(np.ascontiguousarray(data[lo:hi])).to(self.device)
+            inputs = (inputs.float() / 255 - mean) / std
+            targets = self.cache.labels[torch.from_numpy(self.order[lo:hi])].to(self.device)
+            yield inputs, targets
+        self.cache._consumed(len(self.order), time.time() - start)
+
+
+class AugmentationCache:
+    def __init__(self, images, labels, cache_dir='./aug_cache', num_slots=3, num_producers=1,
+                 echo_factor=1, seed=0, size=32):
+        """images: uint8 numpy array (N, 3, H, W), labels: int64 tensor (N,)"""
+        assert num_slots >= 2, "need one slot to read and one to fill"
+        self.cache_dir = cache_dir
+        self.labels = labels.cpu()
+        self.num_samples = len(images)
+        self.size = size
+        self.echo_factor = echo_factor
+        os.makedirs(cache_dir, exist_ok=True)
+        for slot in range(num_slots):
+            np.memmap(os.path.join(cache_dir, f'slot{slot}.u8'), dtype=np.uint8, mode='w+',
+                      shape=(self.num_samples, 3, size, size)).flush()
+
+        ctx = mp.get_context('fork')
+        self._free = ctx.Queue()
+        self._ready = ctx.Queue()
+        for slot in range(num_slots):
+            self._free.put(slot)
+        self._producers = [ctx.Process(target=_producer, daemon=True,
+                                       args=(images, cache_dir, num_slots, self._free, self._ready,
+                                             i, num_producers, seed, size))
+                           for i in range(num_producers)]
+        for process in self._producers:
+            process.start()
+
+        self._current = None  # (slot, order, times served)
+        self.stats = {'produced': 0, 'produce_time': 0.0, 'consumed': 0, 'consume_time': 0.0,
+                      'wait_time': 0.0, 'echoed': 0}
+
+    def _open(self, slot):
+        return np.memmap(os.path.join(self.cache_dir, f'slot{slot}.u8'), dtype=np.uint8, mode='r',
+                         shape=(self.num_samples, 3, self.size, self.size))
+
+    def _consumed(self, images, seconds):
+        self.stats['consumed'] += images
+        self.stats['consume_time'] += seconds
+
+    def _take_ready(self, block):
+        slot, epoch, seconds = self._ready.get(block=block)
+        self.stats['produced'] += self.num_samples
+        self.stats['produce_time'] += seconds
+        order = np.load(os.path.join(self.cache_dir, f'slot{slot}.order.npy'))
+        return slot, order
+
+    # the next epoch to train on: a fresh slot if one is ready, otherwise an echo of the current one
+    # (up to echo_factor times), otherwise wait for the producers
+    def epoch(self, batch_size, device='cpu'):
+        fresh = None
+        try:
+            fresh = self._take_ready(block=False)
+        except queue.Empty:
+            if self._current is not None and self._current[2] < self.echo_factor:
+                slot, order, served = self._current
+                self._current = (slot, order, served + 1)
+                self.stats['echoed'] += 1
+                num_batches = (len(order) + batch_size - 1) // batch_size
+                return _EpochView(self, slot, order, batch_size, device, np.random.permutation(num_batches))
+            start = time.time()
+            fresh = self._take_ready(block=True)
+            self.stats['wait_time'] += time.time() - start
+        if self._current is not None:
+            self._free.put(self._current[0])
+        slot, order = fresh
+        self._current = (slot, order, 1)
+        num_batches = (len(order) + batch_size - 1) // batch_size
+        return _EpochView(self, slot, order, batch_size, device, np.arange(num_batches))
+
+    def describe_rates(self):
+        s = self.stats
+        produce_rate = s['produced'] / s['produce_time'] if s['produce_time'] else 0.0
+        consume_rate = s['consumed'] / s['consume_time'] if s['consume_time'] else 0.0
+        return (f"aug cache: producer {produce_rate:.0f} img/s per process ({len(self._producers)} processes), "
+                f"consumer {consume_rate:.0f} img/s, waited {s['wait_time']:.1f}s, echoed epochs {s['echoed']}")
+
+    def close(self):
+        for _ in self._producers:
+            self._free.put(None)
+        for process in self._producers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
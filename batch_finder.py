@@ -0,0 +1,107 @@
+"""
+Batch-size autotuner: for one architecture and precision, time training steps and inference
+at growing batch sizes while tracking the peak memory (CUDA allocator peak, or the peak RSS of
+a forked process on CPU), and pick the batch size with the highest images/sec under a memory cap.
+
+    python batch_finder.py --model ResNet5M --precision bf16 --memory-cap 8000
+
+main.py uses it through --batch-size auto.
+"""
+
+import argparse
+import contextlib
+
+import torch
+
+from models.resnet import get_model
+from utils import run_isolated, time_train_steps, measure_latency
+
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+DEFAULT_CANDIDATES = [32, 64, 128, 256, 400, 512, 1024, 2048]
+
+
+# autocast for a precision name, a no-op for fp32
+def autocast_context(device, precision):
+    if PRECISIONS[precision] is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device, dtype=PRECISIONS[precision])
+
+
+def _synthetic_batches(batch_size, device):
+    inputs = torch.randn(batch_size, 3, 32, 32, device=device)
+    targets = torch.randint(0, 10, (batch_size,), device=device)
+    while True:
+        yield inputs, targets
+
+
+def _measure(model_fn, batch_size, mode, precision, steps, device):
+    net = model_fn().to(device)
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    with autocast_context(device, precision):
+        if mode == 'train':
+            images_per_sec = time_train_steps(net, _synthetic_batches(batch_size, device), device, steps=steps)
+        else:
+            images_per_sec = batch_size * 1000 / measure_latency(net, batch_size, device, iters=steps, warmup=1)
+    peak_mb = torch.cuda.max_memory_allocated() / 2**20 if device == 'cuda' else None
+    return images_per_sec, peak_mb
+
+
+# images/sec and peak MB of one setting, None when it runs out of memory
+def measure(model_fn, batch_size, mode='train', precision='fp32', steps=5, device='cpu'):
+    try:
+        if device == 'cuda':
+            result = _measure(model_fn, batch_size, mode, precision, steps, device)
+            torch.cuda.empty_cache()
+            return result
+        (images_per_sec, _), peak_mb = run_isolated(_measure, model_fn, batch_size, mode, precision, steps, device)
+        return images_per_sec, peak_mb
+    except (RuntimeError, MemoryError) as e:
+        # MemoryError also covers a forked child killed by the OOM killer before it could report
+        message = str(e).lower()
+        if isinstance(e, RuntimeError) and 'out of memory' not in message and 'not enough memory' not in message:
+            raise
+        if device == 'cuda':
+            torch.cuda.empty_cache()
+        return None
+
+
+# throughput-optimal batch size under memory_cap_mb, plus every measurement as (bs, img/s, peak MB)
+def find_batch_size(model_fn, mode='train', precision='fp32', memory_cap_mb=None, candidates=None,
+                    steps=5, device='cpu', verbose=True):
+    results = []
+    for batch_size in candidates or DEFAULT_CANDIDATES:
+        result = measure(model_fn, batch_size, mode, precision, steps, device)
+        if result is None:
+            if verbose:
+                print(f"{mode} {precision} bs={batch_size}: out of memory")
+            break
+        images_per_sec, peak_mb = result
+        results.append((batch_size, images_per_sec, peak_mb))
+        if verbose:
+            print(f"{mode} {precision} bs={batch_size}: {images_per_sec:.1f} img/s, peak {peak_mb:.0f} MB")
+        # larger batches only need more memory
+        if memory_cap_mb is not None and peak_mb > memory_cap_mb:
+            break
+    fitting = [r for r in results if memory_cap_mb is None or r[2] <= memory_cap_mb]
+    if not fitting:
+        raise ValueError(f"no batch size fits in {memory_cap_mb} MB")
+    return max(fitting, key=lambda r: r[1])[0], results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput-optimal batch size under a memory cap')
+    parser.add_argument('--model', default='ResNet5M')
+    parser.add_argument('--precision', default='fp32', choices=list(PRECISIONS))
+    parser.add_argument('--memory-cap', default=None, type=float, help='MB')
+    parser.add_argument('--candidates', nargs='+', type=int, default=DEFAULT_CANDIDATES)
+    parser.add_argument('--steps', default=5, type=int)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model_fn = lambda: get_model(args.model)
+    print(f"device: {device}, model: {args.model}, precision: {args.precision}")
+    for mode in ['train', 'infer']:
+        best, _ = find_batch_size(model_fn, mode, args.precision, args.memory_cap, args.candidates,
+                                  args.steps, device)
+        print(f"best {mode} batch size: {best}")
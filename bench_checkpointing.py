@@ -0,0 +1,78 @@
+"""
+Peak memory and step time of the deep ResNets with and without activation checkpointing.
+
+    python bench_checkpointing.py --models ResNet34 ResNet50 ResNet101 ResNet152 --batch-size 128 --every 0 2 1
+
+--every 0 is no checkpointing, N checkpoints every N-th block of each stage and 1 checkpoints all blocks.
+On CPU every setting runs in its own forked process so the peak RSS is not shared between settings.
+"""
+
+import argparse
+import time
+
+import torch
+
+from models.resnet import get_model, set_activation_checkpointing
+from utils import run_isolated, time_train_steps
+
+
+def _synthetic_batches(batch_size, device):
+    inputs = torch.randn(batch_size, 3, 32, 32, device=device)
+    targets = torch.randint(0, 10, (batch_size,), device=device)
+    while True:
+        yield inputs, targets
+
+
+def _measure(model_name, checkpoint_every, batch_size, steps, device):
+    net = set_activation_checkpointing(get_model(model_name), checkpoint_every).to(device)
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    images_per_sec = time_train_steps(net, _synthetic_batches(batch_size, device), device, steps=steps)
+    peak_mb = torch.cuda.max_memory_allocated() / 2**20 if device == 'cuda' else None
+    return batch_size / images_per_sec, peak_mb
+
+
+def benchmark(model_name, checkpoint_every, batch_size, steps, device):
+    if device == 'cuda':
+        return _measure(model_name, checkpoint_every, batch_size, steps, device)
+    (step_time, _), peak_mb = run_isolated(_measure, model_name, checkpoint_every, batch_size, steps, device)
+    return step_time, peak_mb
+
+
+def describe_setting(checkpoint_every):
+    if checkpoint_every == 0:
+        return 'none'
+    if checkpoint_every == 1:
+        return 'all'
+    return f'every {checkpoint_every}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Activation checkpointing benchmark')
+    parser.add_argument('--models', nargs='+', default=['ResNet34', 'ResNet50', 'ResNet101', 'ResNet152'])
+    parser.add_argument('--every', nargs='+', type=int, default=[0, 2, 1])
+    parser.add_argument('--batch-size', default=128, type=int)
+    parser.add_argument('--steps', default=5, type=int)
+    parser.add_argument('--memory-budget', default=None, type=float,
+                        help='MB, pick the fastest setting that fits')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print(f"device: {device}, batch size: {args.batch_size}")
+    print(f"{'model':<12}{'checkpointing':<16}{'peak MB':>10}{'step s':>10}{'img/s':>10}")
+    for model_name in args.models:
+        results = []
+        for checkpoint_every in args.every:
+            start = time.time()
+            step_time, peak_mb = benchmark(model_name, checkpoint_every, args.batch_size, args.steps, device)
+            results.append((checkpoint_every, step_time, peak_mb))
+            print(f"{model_name:<12}{describe_setting(checkpoint_every):<16}{peak_mb:>10.0f}"
+                  f"{step_time:>10.3f}{args.batch_size / step_time:>10.1f}")
+
+        if args.memory_budget is not None:
+            fitting = [r for r in results if r[2] <= args.memory_budget]
+            if fitting:
+                best = min(fitting, key=lambda r: r[1])
+                print(f"{model_name}: fastest under {args.memory_budget:.0f} MB is {describe_setting(best[0])}")
+            else:
+                print(f"{model_name}: no setting fits in {args.memory_budget:.0f} MB at batch size {args.batch_size}")
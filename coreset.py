@@ -0,0 +1,220 @@
+"""
+Coreset selection: train hyperparameter-ranking trials on a class-balanced fraction of the
+training set instead of all of it.
+
+Samples are scored with a cheap proxy (ResNet5M2Layers by default) trained for a few epochs:
+  * EL2N (Paul et al. 2021): || softmax(f(x)) - onehot(y) ||_2 on the un-augmented image after
+    the proxy training, averaged over --proxies independently trained proxies
+  * forgetting (Toneva et al. 2019): how often a sample goes from correctly to incorrectly
+    classified between two presentations; samples never learned count as forgotten every epoch
+
+Scores are stored by position in the shared image tensor (NaN for positions that were not
+scored, e.g. the validation split), so a coreset is just another index array for
+CustomTensorDataset(indices=...), like the train/valid splits in splits.py.
+
+    python coreset.py score --epochs 10 --out coreset_scores.npz
+    python coreset.py rank --scores coreset_scores.npz --fraction 0.3 --lrs 0.01,0.03,0.1,0.3 --baseline-random
+    python main.py --coreset coreset_scores.npz --coreset-fraction 0.3
+"""
+
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.utils.data import DataLoader
+from scipy.stats import spearmanr, kendalltau
+
+from models.resnet import get_model
+from customTensorDataset import CustomTensorDataset, get_transform, load_cifar_train
+from splits import stratified_split, make_split_datasets
+from utils import progress_bar
+from arch_search import train_briefly
+
+
+class ForgettingTracker:
+    def __init__(self, num_samples):
+        self.last_correct = torch.zeros(num_samples, dtype=torch.bool)
+        self.learned = torch.zeros(num_samples, dtype=torch.bool)
+        self.forgetting = torch.zeros(num_samples)
+
+    def update(self, outputs, targets, sample_ids):
+        correct = outputs.argmax(1).eq(targets).cpu()
+        sample_ids = sample_ids.cpu()
+        self.forgetting[sample_ids] += (self.last_correct[sample_ids] & ~correct).float()
+        self.last_correct[sample_ids] = correct
+        self.learned[sample_ids] |= correct
+
+    def scores(self, epochs):
+        return torch.where(self.learned, self.forgetting, torch.tensor(float(epochs))).numpy()
+
+
+# train one proxy on the train positions, tracking forgetting events, and return its EL2N scores
+def train_proxy(tensors, train_idx, model_name, epochs, lr, batch_size, tracker, device, seed=0):
+    torch.manual_seed(seed)
+    dataset = CustomTensorDataset(tensors=tensors, transform=get_transform("train"), indices=train_idx,
+                                  return_index=True)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    net = get_model(model_name).to(device)
+    optimizer = optim.SGD(net.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4)
+    scheduler = optim.lr_scheduler.OneCycleLR(optimizer, max_lr=lr, epochs=epochs, steps_per_epoch=len(loader))
+    criterion = nn.CrossEntropyLoss()
+    for epoch in range(epochs):
+        net.train()
+        for batch_idx, (inputs, targets, sample_ids) in enumerate(loader):
+            inputs, targets = inputs.to(device), targets.to(device)
+            optimizer.zero_grad()
+            outputs = net(inputs)
+            loss = criterion(outputs, targets)
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            if tracker is not None:
+                tracker.update(outputs.detach(), targets, sample_ids)
+            progress_bar(batch_idx, len(loader), 'proxy epoch %d Loss: %.3f' % (epoch, loss.item()))
+    return el2n_scores(net, tensors, train_idx, batch_size, device)
+
+
+def el2n_scores(net, tensors, indices, batch_size, device):
+    dataset = CustomTensorDataset(tensors=tensors, transform=get_transform("valid"), indices=indices)
+    loader = DataLoader(dataset, batch_size=batch_size * 2, shuffle=False)
+    net.eval()
+    scores = []
+    with torch.no_grad():
+        for inputs, targets in loader:
+            probs = F.softmax(net(inputs.to(device)).float(), dim=1)
+            onehot = F.one_hot(targets.to(device), probs.size(1)).float()
+            scores.append((probs - onehot).norm(dim=1).cpu())
+    return torch.cat(scores).numpy()
+
+
+def score_samples(tensors, train_idx, model_name='ResNet5M2Layers', epochs=10, lr=0.1, batch_size=256,
+                  proxies=1, device='cpu'):
+    num_samples = tensors[0].size(0)
+    el2n = np.full(num_samples, np.nan, dtype=np.float32)
+    forgetting = np.full(num_samples, np.nan, dtype=np.float32)
+    el2n[train_idx] = 0
+    forgetting[train_idx] = 0
+    for seed in range(proxies):
+        # a fresh tracker per proxy, the first presentation to a new proxy is not a forgetting event
+        tracker = ForgettingTracker(num_samples)
+        el2n[train_idx] += train_proxy(tensors, train_idx, model_name, epochs, lr, batch_size,
+                                       tracker, device, seed) / proxies
+        forgetting[train_idx] += tracker.scores(epochs)[train_idx] / proxies
+    return {'el2n': el2n, 'forgetting': forgetting}
+
+
+def save_scores(path, scores, labels):
+    np.savez(path, labels=np.asarray(labels), **scores)
+
+
+def load_scores(path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+# class-balanced coreset: the `fraction` highest-scoring positions of every class among `candidates`,
+# after dropping the hardest `skip_hardest` fraction (mislabeled / ambiguous images dominate the top
+# scores when only a small fraction is kept). mode='random' ignores the scores (baseline)
+def select_coreset(scores, labels, candidates, fraction, skip_hardest=0.0, mode='hard', seed=0):
+    labels = np.asarray(labels)
+    candidates = np.asarray(candidates)
+    if mode != 'random' and np.isnan(scores[candidates]).any():
+        raise ValueError("some candidate positions have no score, they were scored with another split")
+    rng = np.random.default_rng(seed)
+    selected = []
+    for c in np.unique(labels[candidates]):
+        members = candidates[labels[candidates] == c]
+        keep = max(1, int(round(fraction * len(members))))
+        if mode == 'random':
+            selected.append(rng.choice(members, keep, replace=False))
+            continue
+        # ties (e.g. equal forgetting counts) are broken randomly
+        order = np.lexsort((rng.random(len(members)), -scores[members]))
+        skip = int(round(skip_hardest * len(members)))
+        selected.append(members[order[skip:skip + keep]])
+    # sorted positions keep the reads from the shared tensor in memory order
+    return np.sort(np.concatenate(selected))
+
+
+def ranking_agreement(full_scores, coreset_scores):
+    full_scores = np.asarray(full_scores)
+    coreset_scores = np.asarray(coreset_scores)
+    return {
+        'spearman': spearmanr(full_scores, coreset_scores)[0],
+        'kendall': kendalltau(full_scores, coreset_scores)[0],
+        'same_best': int(np.argmax(full_scores) == np.argmax(coreset_scores)),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coreset selection for hyperparameter-ranking trials')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('score', help='score the training samples with a briefly trained proxy')
+    p.add_argument('--model', default='ResNet5M2Layers')
+    p.add_argument('--epochs', default=10, type=int)
+    p.add_argument('--lr', default=0.1, type=float)
+    p.add_argument('--proxies', default=1, type=int, help='average the scores over this many proxies')
+    p.add_argument('--out', default='./coreset_scores.npz')
+    p = sub.add_parser('rank', help='compare hyperparameter rankings on the coreset and the full training set')
+    p.add_argument('--scores', default='./coreset_scores.npz')
+    p.add_argument('--score', default='el2n', choices=['el2n', 'forgetting'])
+    p.add_argument('--fraction', default=0.3, type=float)
+    p.add_argument('--skip-hardest', default=0.0, type=float)
+    p.add_argument('--model', default='ResNet5M2Layers', help='model of the ranking trials')
+    p.add_argument('--lrs', default=[0.01, 0.03, 0.1, 0.3], type=lambda s: [float(v) for v in s.split(',')])
+    p.add_argument('--epochs', default=10, type=int)
+    p.add_argument('--baseline-random', action='store_true', help='also rank on a random subset of the same size')
+    for p in sub.choices.values():
+        p.add_argument('--batch-size', default=256, type=int)
+        p.add_argument('--valid-size', default=0.1, type=float)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    images, labels = load_cifar_train()
+    tensors = (torch.Tensor(images), torch.from_numpy(labels))
+    # the same split as main.py, the validation positions are never scored or selected
+    train_idx, valid_idx = stratified_split(labels, valid_size=args.valid_size, seed=42)
+
+    if args.command == 'score':
+        start = time.time()
+        scores = score_samples(tensors, train_idx, args.model, args.epochs, args.lr, args.batch_size,
+                               args.proxies, device)
+        save_scores(args.out, scores, labels)
+        print(f"\nscored {len(train_idx)} samples in {time.time() - start:.0f}s, saved to {args.out}")
+        for name, values in scores.items():
+            values = values[train_idx]
+            print(f"  {name}: mean {values.mean():.3f}, median {np.median(values):.3f}, max {values.max():.3f}")
+    else:
+        scores = load_scores(args.scores)[args.score]
+        subsets = {'full': train_idx,
+                   args.score: select_coreset(scores, labels, train_idx, args.fraction, args.skip_hardest)}
+        if args.baseline_random:
+            subsets['random'] = select_coreset(scores, labels, train_idx, args.fraction, mode='random')
+        validloader = DataLoader(CustomTensorDataset(tensors=tensors, transform=get_transform("valid"),
+                                                     indices=valid_idx), batch_size=400, shuffle=False)
+        results = {name: [] for name in subsets}
+        times = {name: 0.0 for name in subsets}
+        for name, indices in subsets.items():
+            train_dataset, _ = make_split_datasets(tensors, indices, valid_idx, get_transform("train"))
+            trainloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
+            for lr in args.lrs:
+                print(f"\n{name} ({len(indices)} samples), lr {lr}")
+                torch.manual_seed(0)
+                start = time.time()
+                acc = train_briefly(get_model(args.model), trainloader, validloader, args.epochs, args.epochs, lr, device)
+                times[name] += time.time() - start
+                results[name].append(acc)
+
+        print(f"\n{'lr':>8}" + ''.join(f"{name:>12}" for name in subsets))
+        for i, lr in enumerate(args.lrs):
+            print(f"{lr:>8g}" + ''.join(f"{results[name][i]:>12.2f}" for name in subsets))
+        for name in subsets:
+            if name == 'full':
+                continue
+            agreement = ranking_agreement(results['full'], results[name])
+            print(f"{name}: spearman {agreement['spearman']:.3f}, kendall {agreement['kendall']:.3f}, "
+                  f"same best lr: {bool(agreement['same_best'])}, {times['full'] / times[name]:.1f}x faster")
@@ -4,6 +4,7 @@ Code from here: https://stackoverflow.com/questions/55588201/pytorch-transforms-
 
 """
 
+import os
 import numpy as np
 import torch
 from torch.utils.data import Dataset, TensorDataset
@@ -16,29 +17,42 @@ import matplotlib.pyplot as plt
 # create special obeject to make sure the tensors can be transformed later
 class CustomTensorDataset(Dataset):
 
-    def __init__(self, tensors, transform=None):
+    def __init__(self, tensors, transform=None, indices=None, return_index=False):
         assert all(tensors[0].size(0) == tensor.size(0) for tensor in tensors)
         self.tensors = tensors
         self.transform = transform
+        # optional index view into the shared tensors, so train/valid splits never copy the images
+        self.indices = indices
+        # also return the position of the sample in the shared tensors (per-sample bookkeeping)
+        self.return_index = return_index
     
     def __getitem__(self, index):
+        if self.indices is not None:
+            index = int(self.indices[index])
         x = self.tensors[0][index]
 
         if self.transform:
             x = self.transform(x)
         
         y = self.tensors[1][index]
+        if self.return_index:
+            return x, y, index
         return x, y
 
     def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
         return self.tensors[0].size(0)
 
-def get_transform(split):
+# size < 32 downsamples first (progressive resizing), crop padding scales with the size
+def get_transform(split, size=32):
+    resize = [transforms.Resize(size, antialias=True)] if size != 32 else []
     if split == "train":
         transform_train = transforms.Compose([
             transforms.ToPILImage(),
+            *resize,
             transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1),
-            transforms.RandomCrop(32, padding=4),
+            transforms.RandomCrop(size, padding=size // 8),
             transforms.RandomHorizontalFlip(),
             transforms.RandomRotation(degrees=15),
             transforms.ToTensor(),
@@ -46,13 +60,38 @@ def get_transform(split):
             transforms.RandomErasing()
         ])
         return transform_train
+    elif split == "train_uint8":
+        # same augmentation on uint8 images, left as uint8 so it can be cached (aug_cache.py) and
+        # normalized later on the device; erased patches get the mean color, like the normalized 0 above
+        transform_train_uint8 = transforms.Compose([
+            transforms.ToPILImage(),
+            *resize,
+            transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1),
+            transforms.RandomCrop(size, padding=size // 8),
+            transforms.RandomHorizontalFlip(),
+            transforms.RandomRotation(degrees=15),
+            transforms.PILToTensor(),
+            transforms.RandomErasing(value=(130, 132, 141)),
+        ])
+        return transform_train_uint8
     elif split == "valid":
         transform_valid = transforms.Compose([
             transforms.ToPILImage(),
+            *resize,
             transforms.ToTensor(),
             transforms.Normalize((0.5101, 0.5193, 0.5548), (0.2032, 0.2001, 0.2025)),
         ])
         return transform_valid
+    elif split == "fixres":
+        # test-time preprocessing plus a flip, for fine-tuning at the test resolution (FixRes)
+        transform_fixres = transforms.Compose([
+            transforms.ToPILImage(),
+            *resize,
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize((0.5101, 0.5193, 0.5548), (0.2032, 0.2001, 0.2025)),
+        ])
+        return transform_fixres
     elif split == "test":
         transform_test = transforms.Compose([
             transforms.ToPILImage(),
@@ -74,4 +113,14 @@ def test_unpickle(file):
     import pickle
     with open(file, 'rb') as fo:
         temp_dict = pickle.load(fo, encoding='bytes')
-    return temp_dict
\ No newline at end of file
+    return temp_dict
+
+# function to load the five CIFAR-10 training batches as uint8 images (N, 3, 32, 32) and int64 labels
+def load_cifar_train(cifar10_dir='data/cifar-10-batches-py'):
+    all_images = []
+    all_labels = []
+    for i in range(1, 6):
+        batch_dict = test_unpickle(os.path.join(cifar10_dir, f'data_batch_{i}'))
+        all_images.append(batch_dict[b'data'].reshape((10000, 3, 32, 32)))
+        all_labels.append(np.asarray(batch_dict[b'labels'], dtype=np.int64))
+    return np.concatenate(all_images, axis=0), np.concatenate(all_labels, axis=0)
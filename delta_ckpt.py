@@ -0,0 +1,201 @@
+"""
+Compressed delta checkpoints. A full base snapshot is written every base_every epochs; the
+epochs in between only store the XOR of every tensor's bits with the base, byte-shuffled
+(all first bytes, then all second bytes, ...) and compressed with zstd (zlib when zstandard is
+not installed). Weights and momentum buffers move little between nearby epochs, so sign,
+exponent and high mantissa bytes XOR to zero and compress away, and the reconstruction is
+bit-exact. Any epoch loads from its base plus a single delta.
+
+Non-tensor parts of the checkpoint (epoch, best_acc, trend lists, scheduler settings) are
+pickled as they are.
+
+    python delta_ckpt.py --root checkpoint/delta --epoch 120 --out checkpoint/ckpt120.pth
+"""
+
+import os
+import zlib
+import pickle
+import argparse
+
+import numpy as np
+import torch
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# integer views of the same width, XOR works on the raw bits
+INT_VIEWS = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+class _TensorRef:
+    def __init__(self, key):
+        self.key = key
+
+
+def _split_tensors(obj, tensors, prefix=''):
+    if isinstance(obj, torch.Tensor):
+        tensors[prefix] = obj.detach().cpu().contiguous()
+        return _TensorRef(prefix)
+    if isinstance(obj, dict):
+        return type(obj)((k, _split_tensors(v, tensors, f'{prefix}/{k}')) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_split_tensors(v, tensors, f'{prefix}/{i}') for i, v in enumerate(obj))
+    return obj
+
+
+def _join_tensors(obj, tensors):
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.key]
+    if isinstance(obj, dict):
+        return type(obj)((k, _join_tensors(v, tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_join_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _bits(tensor):
+    return tensor.reshape(-1).view(INT_VIEWS[tensor.element_size()]).numpy()
+
+
+def _shuffle(data, itemsize):
+    return data.view(np.uint8).reshape(-1, itemsize).T.tobytes()
+
+
+def _unshuffle(raw, itemsize, dtype):
+    return np.frombuffer(raw, dtype=np.uint8).reshape(itemsize, -1).T.copy().view(dtype).reshape(-1)
+
+
+class DeltaCheckpointStore:
+    def __init__(self, root, base_every=10, level=3):
+        self.root = root
+        self.base_every = base_every
+        self.level = level
+        self.codec = 'zstd' if zstandard is not None else 'zlib'
+        self._base = None  # (epoch, tensors) of the most recent base
+        os.makedirs(root, exist_ok=True)
+
+    def _compress(self, raw):
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level).compress(raw)
+        return zlib.compress(raw, self.level)
+
+    def _decompress(self, codec, data):
+        if codec == 'zstd':
+            if zstandard is None:
+                raise ImportError("checkpoint was written with zstd, pip install zstandard")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    def _path(self, epoch, kind):
+        return os.path.join(self.root, f'epoch{epoch:04d}.{kind}')
+
+    # most recent base written before epoch
+    def _latest_base(self, epoch):
+        bases = [int(n[5:9]) for n in os.listdir(self.root) if n.endswith('.base')]
+        bases = [b for b in bases if b < epoch]
+        return max(bases) if bases else None
+
+    def _base_tensors(self, base_epoch):
+        if self._base is None or self._base[0] != base_epoch:
+            self._base = (base_epoch, self._load_tensors(base_epoch, 'base'))
+        return self._base[1]
+
+    def save(self, epoch, state):
+        tensors = {}
+        skeleton = _split_tensors(state, tensors)
+        base_epoch = self._latest_base(epoch)
+        base = None
+        if base_epoch is not None and epoch - base_epoch < self.base_every:
+            base = self._base_tensors(base_epoch)
+
+        entries = {}
+        for key, tensor in tensors.items():
+            bits = _bits(tensor)
+            reference = base.get(key) if base is not None else None
+            # new keys or changed shapes / dtypes are stored against zeros
+            if reference is not None and reference.shape == tensor.shape and reference.dtype == tensor.dtype:
+                bits = bits ^ _bits(reference)
+            entries[key] = (str(tensor.dtype), tuple(tensor.shape),
+                            self._compress(_shuffle(bits, tensor.element_size())))
+
+        kind = 'delta' if base is not None else 'base'
+        record = {'epoch': epoch, 'base': base_epoch if base is not None else None,
+                  'codec': self.codec, 'skeleton': skeleton, 'tensors': entries}
+        path = self._path(epoch, kind)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        # an epoch saved again (e.g. after a resume) keeps a single record
+        stale = self._path(epoch, 'base' if kind == 'delta' else 'delta')
+        if os.path.exists(stale):
+            os.remove(stale)
+        if kind == 'base':
+            # CPU tensors are not copied by .cpu(), the cached base must not follow the live weights
+            self._base = (epoch, {k: v.clone() for k, v in tensors.items()})
+        return path
+
+    def _read(self, epoch, kind):
+        with open(self._path(epoch, kind), 'rb') as f:
+            return pickle.load(f)
+
+    def _decode(self, record, base):
+        tensors = {}
+        for key, (dtype_name, shape, data) in record['tensors'].items():
+            dtype = getattr(torch, dtype_name.replace('torch.', ''))
+            itemsize = torch.empty((), dtype=dtype).element_size()
+            int_dtype = INT_VIEWS[itemsize]
+            bits = _unshuffle(self._decompress(record['codec'], data), itemsize,
+                              torch.empty((), dtype=int_dtype).numpy().dtype)
+            reference = base.get(key) if base is not None else None
+            if reference is not None and tuple(reference.shape) == tuple(shape) and reference.dtype == dtype:
+                bits = bits ^ _bits(reference)
+            tensors[key] = torch.from_numpy(bits).view(dtype).reshape(shape)
+        return tensors
+
+    def _load_tensors(self, epoch, kind):
+        return self._decode(self._read(epoch, kind), None)
+
+    def epochs(self):
+        names = os.listdir(self.root)
+        return sorted(int(n[5:9]) for n in names if n.endswith('.base') or n.endswith('.delta'))
+
+    # the checkpoint dict of any saved epoch, bit-exact
+    def load(self, epoch, map_location='cpu'):
+        if os.path.exists(self._path(epoch, 'base')):
+            record = self._read(epoch, 'base')
+            tensors = self._decode(record, None)
+        else:
+            record = self._read(epoch, 'delta')
+            tensors = self._decode(record, self._base_tensors(record['base']))
+        tensors = {k: v.to(map_location) for k, v in tensors.items()}
+        return _join_tensors(record['skeleton'], tensors)
+
+    def size_report(self):
+        sizes = {'base': 0, 'delta': 0}
+        for name in os.listdir(self.root):
+            kind = name.rsplit('.', 1)[-1]
+            if kind in sizes:
+                sizes[kind] += os.path.getsize(os.path.join(self.root, name))
+        return sizes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Restore one epoch from a delta checkpoint store')
+    parser.add_argument('--root', default='./checkpoint/delta')
+    parser.add_argument('--epoch', default=None, type=int, help='default: the latest epoch')
+    parser.add_argument('--out', default=None, help='write the restored checkpoint with torch.save')
+    args = parser.parse_args()
+
+    # base_every only matters for saving, loading follows the base recorded in each delta
+    store = DeltaCheckpointStore(args.root)
+    epochs = store.epochs()
+    sizes = store.size_report()
+    print(f"{len(epochs)} epochs, bases {sizes['base'] / 2**20:.1f} MB, deltas {sizes['delta'] / 2**20:.1f} MB")
+    epoch = args.epoch if args.epoch is not None else epochs[-1]
+    checkpoint = store.load(epoch)
+    print(f"restored epoch {epoch}: {', '.join(checkpoint) if isinstance(checkpoint, dict) else type(checkpoint)}")
+    if args.out:
+        torch.save(checkpoint, args.out)
+        print(f"saved {args.out}")
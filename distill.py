@@ -0,0 +1,180 @@
+"""
+Knowledge distillation from a trained teacher (ResNet5M / ResNet34 checkpoints) into a small
+student (ResNet5M2Layers, ResNet2_Modified) with a precomputed teacher-logit cache.
+
+The teacher runs once per augmentation seed over the training set and its logits are stored
+as float16 memmaps (N x 10, indexed by sample id) under --cache-dir. The augmentation of
+every sample is seeded by (seed, sample id), so in epoch e the student sees exactly the
+images the teacher saw for seed e % num_seeds and reads their logits from the cache. With
+--seeds 0 the teacher only sees the un-augmented images and the student trains with the
+usual random augmentation against those logits.
+
+    python distill.py --teacher ResNet5M --teacher-checkpoint checkpoint/ckpt199.pth --student ResNet5M2Layers --seeds 4
+"""
+
+import os
+import json
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+from models.resnet import get_model
+from customTensorDataset import CustomTensorDataset, get_transform, load_cifar_train
+from splits import stratified_split
+from utils import load_checkpoint_weights, evaluate_accuracy, progress_bar
+
+
+# CustomTensorDataset that also returns the sample id, with the augmentation of every sample
+# seeded by (seed, sample id) so it can be replayed exactly; seed=None keeps the random augmentation
+class SeededDataset(CustomTensorDataset):
+    def __init__(self, tensors, transform=None, indices=None, seed=None):
+        super(SeededDataset, self).__init__(tensors, transform=transform, indices=indices)
+        self.seed = seed
+
+    def __getitem__(self, index):
+        sample_id = int(self.indices[index]) if self.indices is not None else index
+        x = self.tensors[0][sample_id]
+        if self.transform:
+            if self.seed is None:
+                x = self.transform(x)
+            else:
+                with torch.random.fork_rng(devices=[]):
+                    torch.manual_seed(self.seed * 1_000_003 + sample_id)
+                    x = self.transform(x)
+        y = self.tensors[1][sample_id]
+        return x, y, sample_id
+
+
+# float16 teacher logits for every sample id, one memmap per augmentation seed ('clean' = no augmentation)
+class TeacherLogitCache:
+    def __init__(self, cache_dir, num_samples, num_classes=10):
+        self.cache_dir = cache_dir
+        self.num_samples = num_samples
+        self.num_classes = num_classes
+        self.meta_path = os.path.join(cache_dir, 'meta.json')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, seed):
+        return os.path.join(self.cache_dir, 'teacher_clean.f16' if seed is None else f'teacher_seed{seed}.f16')
+
+    def read_meta(self):
+        if not os.path.exists(self.meta_path):
+            return {}
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def is_complete(self, teacher_key, seed):
+        meta = self.read_meta()
+        return meta.get('teacher') == teacher_key and str(seed) in meta.get('complete', []) \
+            and os.path.exists(self._path(seed))
+
+    def open(self, seed, mode='r'):
+        return np.memmap(self._path(seed), dtype=np.float16, mode=mode,
+                         shape=(self.num_samples, self.num_classes))
+
+    def mark_complete(self, teacher_key, seed):
+        meta = self.read_meta()
+        if meta.get('teacher') != teacher_key:
+            meta = {'teacher': teacher_key, 'num_samples': self.num_samples,
+                    'num_classes': self.num_classes, 'complete': []}
+        meta['complete'] = sorted(set(meta['complete']) | {str(seed)})
+        with open(self.meta_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+# run the teacher once over the training set for one seed and store its logits
+def build_teacher_logits(teacher, tensors, cache, teacher_key, seed, batch_size=400, device='cpu'):
+    if cache.is_complete(teacher_key, seed):
+        print(f"teacher logits for seed {seed} already cached")
+        return
+    transform = get_transform("valid") if seed is None else get_transform("train")
+    dataset = SeededDataset(tensors, transform=transform, seed=seed)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    logits = cache.open(seed, mode='w+')
+    teacher.eval()
+    with torch.no_grad():
+        for batch_idx, (inputs, _, sample_ids) in enumerate(loader):
+            outputs = teacher(inputs.to(device))
+            logits[sample_ids.numpy()] = outputs.cpu().numpy().astype(np.float16)
+            progress_bar(batch_idx, len(loader), f'teacher seed {seed}')
+    logits.flush()
+    del logits
+    cache.mark_complete(teacher_key, seed)
+
+
+# Hinton et al. 2015: soft-target KL at temperature T (scaled by T^2) mixed with the hard-label loss
+def kd_loss(student_logits, teacher_logits, targets, temperature=4.0, alpha=0.9):
+    soft = F.kl_div(F.log_softmax(student_logits / temperature, dim=1),
+                    F.softmax(teacher_logits / temperature, dim=1),
+                    reduction='batchmean') * temperature ** 2
+    hard = F.cross_entropy(student_logits, targets)
+    return alpha * soft + (1 - alpha) * hard
+
+
+def train_student(student, tensors, train_idx, cache, seeds, epochs, batch_size, lr, temperature, alpha,
+                  device='cpu', validloader=None):
+    criterion_params = dict(temperature=temperature, alpha=alpha)
+    optimizer = optim.SGD(student.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4)
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=epochs)
+    for epoch in range(epochs):
+        seed = seeds[epoch % len(seeds)]
+        dataset = SeededDataset(tensors, transform=get_transform("train"), indices=train_idx, seed=seed)
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+        logits = cache.open(seed)
+        student.train()
+        train_loss = 0
+        for batch_idx, (inputs, targets, sample_ids) in enumerate(loader):
+            inputs, targets = inputs.to(device), targets.to(device)
+            teacher_logits = torch.from_numpy(logits[sample_ids.numpy()].astype(np.float32)).to(device)
+            optimizer.zero_grad()
+            loss = kd_loss(student(inputs), teacher_logits, targets, **criterion_params)
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item()
+            progress_bar(batch_idx, len(loader), 'kd Loss: %.3f' % (train_loss / (batch_idx + 1)))
+        scheduler.step()
+        if validloader is not None:
+            print(f"epoch {epoch} seed {seed} valid acc {evaluate_accuracy(student, validloader, device):.2f}%")
+    return student
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Knowledge distillation with a cached teacher')
+    parser.add_argument('--teacher', default='ResNet5M')
+    parser.add_argument('--teacher-checkpoint', required=True)
+    parser.add_argument('--student', default='ResNet5M2Layers')
+    parser.add_argument('--seeds', default=4, type=int, help='augmentation seeds to cache, 0 = un-augmented only')
+    parser.add_argument('--cache-dir', default='./teacher_cache')
+    parser.add_argument('--epochs', default=200, type=int)
+    parser.add_argument('--batch-size', default=400, type=int)
+    parser.add_argument('--lr', default=0.1, type=float)
+    parser.add_argument('--temperature', default=4.0, type=float)
+    parser.add_argument('--alpha', default=0.9, type=float, help='weight of the soft-target loss')
+    parser.add_argument('--out', default='./checkpoint/student.pth')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    images, labels = load_cifar_train()
+    tensors = (torch.Tensor(images), torch.from_numpy(labels))
+    train_idx, valid_idx = stratified_split(labels, valid_size=0.1, seed=42)
+    valid_dataset = CustomTensorDataset(tensors, transform=get_transform("valid"), indices=valid_idx)
+    validloader = DataLoader(valid_dataset, batch_size=400, shuffle=False)
+
+    teacher = load_checkpoint_weights(get_model(args.teacher), args.teacher_checkpoint).to(device)
+    teacher_key = f"{args.teacher}:{os.path.abspath(args.teacher_checkpoint)}:{os.path.getmtime(args.teacher_checkpoint)}"
+    cache = TeacherLogitCache(args.cache_dir, num_samples=len(labels))
+    seeds = list(range(args.seeds)) if args.seeds > 0 else [None]
+    for seed in seeds:
+        build_teacher_logits(teacher, tensors, cache, teacher_key, seed, device=device)
+    print(f"teacher valid acc {evaluate_accuracy(teacher, validloader, device):.2f}%")
+    del teacher
+
+    student = get_model(args.student).to(device)
+    train_student(student, tensors, train_idx, cache, seeds, args.epochs, args.batch_size, args.lr,
+                  args.temperature, args.alpha, device=device, validloader=validloader)
+    torch.save({'net': student.state_dict(), 'model': args.student}, args.out)
+    print(f"saved {args.out}")
@@ -0,0 +1,135 @@
+"""
+DistributedDataParallel helpers for the training scripts.
+
+Launch with torchrun, e.g. on one many-core CPU host with 4 processes:
+
+    torchrun --standalone --nproc_per_node=4 main.py --lr 0.1
+
+torchrun sets RANK / WORLD_SIZE / LOCAL_RANK, without them everything here falls back
+to the old single-process behaviour (DataParallel on CUDA, plain model on CPU).
+The batch size in the scripts is per process, so the global batch is batch_size * world_size.
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, IterableDataset
+from torch.utils.data.distributed import DistributedSampler
+
+
+# set up the process group when launched by torchrun, returns (rank, world_size, local_rank)
+def init_distributed(backend=None):
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        return 0, 1, 0
+    rank = int(os.environ['RANK'])
+    world_size = int(os.environ['WORLD_SIZE'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend=backend)
+    return rank, world_size, local_rank
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+# checkpoints, plots and prediction files are only written by rank 0
+def is_main_process():
+    return get_rank() == 0
+
+
+def wrap_model(net, device, local_rank=0):
+    if is_distributed():
+        if device == 'cuda':
+            return DistributedDataParallel(net, device_ids=[local_rank])
+        return DistributedDataParallel(net)
+    if device == 'cuda':
+        return torch.nn.DataParallel(net)
+    return net
+
+
+class ResumableSampler(DistributedSampler):
+    """DistributedSampler (also used with a single process) whose epoch order only depends on
+    seed + epoch, so an interrupted epoch can be resumed at the first sample not yet consumed."""
+
+    def __init__(self, dataset, shuffle=True, seed=0):
+        super().__init__(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle, seed=seed)
+        self.resume_epoch = None
+        self.start = 0
+
+    # skip the first `start` samples of this rank's share of `epoch`, other epochs are not affected
+    def resume_at(self, epoch, start):
+        self.resume_epoch = epoch
+        self.start = start
+
+    def _skip(self):
+        return self.start if self.epoch == self.resume_epoch else 0
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self._skip():])
+
+    def __len__(self):
+        # a snapshot taken after the last batch skips the whole share
+        return max(0, self.num_samples - self._skip())
+
+
+# every rank sees a disjoint shard of the dataset, reshuffled each epoch through set_epoch.
+# resumable=True makes the order deterministic per epoch (see ResumableSampler)
+def make_loader(dataset, batch_size, shuffle, seed=0, resumable=False, **kwargs):
+    if isinstance(dataset, IterableDataset):
+        # streaming datasets (shards.ShardedDataset) split themselves across ranks and workers
+        return DataLoader(dataset, batch_size=batch_size, **kwargs)
+    if resumable:
+        return DataLoader(dataset, batch_size=batch_size, sampler=ResumableSampler(dataset, shuffle, seed), **kwargs)
+    if is_distributed():
+        sampler = DistributedSampler(dataset, shuffle=shuffle, seed=seed)
+        return DataLoader(dataset, batch_size=batch_size, sampler=sampler, **kwargs)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
+
+
+def set_epoch(loader, epoch):
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+    if hasattr(loader.dataset, 'set_epoch'):
+        loader.dataset.set_epoch(epoch)
+
+
+# linear scaling rule: the global batch grows with the number of processes, so does the lr.
+# For OneCycleLR this is the max_lr, steps_per_epoch must come from the sharded loader.
+# CosineAnnealingLR is stepped per epoch, its T_max does not change.
+def scale_lr(lr, world_size=None):
+    if world_size is None:
+        world_size = get_world_size()
+    return lr * world_size
+
+
+# sum a list of python numbers over all ranks (e.g. loss sum, correct, total)
+def all_reduce_sum(values, device='cpu'):
+    if not is_distributed():
+        return list(values)
+    # gloo can only reduce CPU tensors
+    if dist.get_backend() == 'gloo':
+        device = 'cpu'
+    tensor = torch.tensor([float(v) for v in values], dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def cleanup():
+    if is_distributed():
+        dist.barrier()
+        dist.destroy_process_group()
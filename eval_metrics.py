@@ -0,0 +1,100 @@
+"""
+Streaming evaluation metrics with on-device accumulators: loss, top-k accuracy, a confusion
+matrix (from one bincount per batch) and the reliability histogram for the expected
+calibration error. update() never copies to the host, so a pass has no per-batch syncs;
+compute() sums the accumulators over all distributed ranks once and reads them back.
+"""
+
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+
+from distributed import is_distributed
+
+
+class EvalMetrics:
+    def __init__(self, num_classes=10, topk=(1, 5), ece_bins=15, device='cpu'):
+        self.num_classes = num_classes
+        self.topk = tuple(k for k in topk if k <= num_classes)
+        self.ece_bins = ece_bins
+        self.device = device
+        self.confusion = torch.zeros(num_classes * num_classes, dtype=torch.float64, device=device)
+        self.topk_correct = torch.zeros(len(self.topk), dtype=torch.float64, device=device)
+        self.loss_sum = torch.zeros(1, dtype=torch.float64, device=device)
+        self.bin_count = torch.zeros(ece_bins, dtype=torch.float64, device=device)
+        self.bin_confidence = torch.zeros(ece_bins, dtype=torch.float64, device=device)
+        self.bin_correct = torch.zeros(ece_bins, dtype=torch.float64, device=device)
+
+    # loss is the batch mean (as returned by nn.CrossEntropyLoss)
+    @torch.no_grad()
+    def update(self, outputs, targets, loss=None):
+        outputs = outputs.float()
+        C = self.num_classes
+        predicted = outputs.argmax(1)
+        self.confusion += torch.bincount(targets * C + predicted, minlength=C * C).double()
+
+        top = outputs.topk(max(self.topk), dim=1).indices.eq(targets.unsqueeze(1))
+        self.topk_correct += torch.stack([top[:, :k].any(1).sum() for k in self.topk]).double()
+
+        confidence = F.softmax(outputs, dim=1).max(1).values
+        bins = (confidence * self.ece_bins).long().clamp(max=self.ece_bins - 1)
+        self.bin_count += torch.bincount(bins, minlength=self.ece_bins).double()
+        self.bin_confidence += torch.bincount(bins, weights=confidence.double(), minlength=self.ece_bins)
+        self.bin_correct += torch.bincount(bins, weights=predicted.eq(targets).double(), minlength=self.ece_bins)
+
+        if loss is not None:
+            self.loss_sum += loss.detach().double() * targets.size(0)
+
+    def _accumulators(self):
+        return [self.confusion, self.topk_correct, self.loss_sum, self.bin_count, self.bin_confidence, self.bin_correct]
+
+    # sum every accumulator over all ranks in a single all_reduce
+    def all_reduce(self):
+        if not is_distributed():
+            return
+        tensors = self._accumulators()
+        flat = torch.cat(tensors)
+        # gloo can only reduce CPU tensors
+        if dist.get_backend() == 'gloo':
+            flat = flat.cpu()
+        dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+        flat = flat.to(self.device)
+        offset = 0
+        for tensor in tensors:
+            tensor.copy_(flat[offset:offset + tensor.numel()])
+            offset += tensor.numel()
+
+    def compute(self, reduce=True):
+        if reduce:
+            self.all_reduce()
+        C = self.num_classes
+        confusion = self.confusion.view(C, C).cpu()
+        total = confusion.sum().item()
+        per_class_total = confusion.sum(1)
+        per_class_acc = (confusion.diag() / per_class_total.clamp(min=1) * 100).tolist()
+        bin_count = self.bin_count.cpu()
+        gaps = (self.bin_confidence.cpu() - self.bin_correct.cpu()).abs()
+        results = {
+            'count': int(total),
+            'loss': self.loss_sum.item() / total if total else 0.0,
+            'acc': 100.0 * confusion.diag().sum().item() / total if total else 0.0,
+            'per_class_acc': per_class_acc,
+            'confusion': confusion.long().tolist(),
+            # expected calibration error: bin-weighted |confidence - accuracy|
+            'ece': gaps.sum().item() / total if total else 0.0,
+            'reliability': [(c / n if n else 0.0, a / n if n else 0.0, int(n)) for c, a, n in
+                            zip(self.bin_confidence.cpu().tolist(), self.bin_correct.cpu().tolist(), bin_count.tolist())],
+        }
+        for k, correct in zip(self.topk, self.topk_correct.cpu().tolist()):
+            results[f'top{k}'] = 100.0 * correct / total if total else 0.0
+        return results
+
+
+def describe(results, class_names=None):
+    names = class_names or [str(i) for i in range(len(results['per_class_acc']))]
+    topk = ' '.join(f"{k}: {v:.2f}%" for k, v in results.items() if k.startswith('top'))
+    worst = min(range(len(names)), key=lambda i: results['per_class_acc'][i]) if names else None
+    line = f"Loss: {results['loss']:.3f} | Acc: {results['acc']:.3f}% ({results['count']}) | {topk} | ECE: {results['ece']:.4f}"
+    if worst is not None and results['count']:
+        line += f" | worst class {names[worst]} {results['per_class_acc'][worst]:.1f}%"
+    return line
@@ -0,0 +1,140 @@
+"""
+Milestone evaluation for the training scripts.
+
+Policies decide at which epochs test-set predictions should be written. When one
+fires, EvalScheduler takes a CPU snapshot of the weights and hands it to a worker
+process, which rebuilds the model, predicts on the test set and writes the CSV
+while training carries on.
+"""
+
+import io
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from utils import generate_predictions, save_predictions_to_csv
+
+
+# fires every k epochs
+class EveryKEpochs:
+    def __init__(self, k, tag=''):
+        self.k = k
+        self.tag = tag
+
+    def should_run(self, epoch, metric):
+        return self.k > 0 and epoch % self.k == 0
+
+
+# fires at a fixed list of epochs (the old hardcoded milestones)
+class AtEpochs:
+    def __init__(self, epochs, tag=''):
+        self.epochs = set(epochs)
+        self.tag = tag
+
+    def should_run(self, epoch, metric):
+        return epoch in self.epochs
+
+
+# fires whenever the watched metric (validation accuracy) beats its best value so far
+class OnImprovement:
+    def __init__(self, min_delta=0.0, tag='Best'):
+        self.min_delta = min_delta
+        self.tag = tag
+        self.best = None
+
+    def should_run(self, epoch, metric):
+        if metric is None:
+            return False
+        if self.best is None or metric > self.best + self.min_delta:
+            self.best = metric
+            return True
+        return False
+
+
+# fires whenever the watched metric is at or above a threshold
+class AboveThreshold:
+    def __init__(self, threshold, tag='Good'):
+        self.threshold = threshold
+        self.tag = tag
+
+    def should_run(self, epoch, metric):
+        return metric is not None and metric >= self.threshold
+
+
+def _snapshot(net):
+    # unwrap DataParallel / DistributedDataParallel so the worker can load into a plain model
+    if hasattr(net, 'module'):
+        net = net.module
+    buffer = io.BytesIO()
+    torch.save({k: v.detach().cpu() for k, v in net.state_dict().items()}, buffer)
+    return buffer.getvalue()
+
+
+def _run_job(model, testloader, job, out_dir):
+    epoch, tags, weights = job
+    model.load_state_dict(torch.load(io.BytesIO(weights), map_location='cpu'))
+    predictions = generate_predictions(model, testloader, device='cpu')
+    for tag in tags:
+        save_predictions_to_csv(predictions, list(range(len(predictions))),
+                                csv_filename=f"{out_dir}/predictions{tag}{epoch}.csv")
+
+
+def _eval_worker(queue, model_fn, test_dataset, batch_size, out_dir, num_threads):
+    torch.set_num_threads(num_threads)
+    model = model_fn()
+    testloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+    while True:
+        job = queue.get()
+        if job is None:
+            break
+        _run_job(model, testloader, job, out_dir)
+
+
+class EvalScheduler:
+    """Run test-set predictions for the epochs picked by the policies in a worker process.
+
+    model_fn builds an untrained model of the same architecture (e.g. ResNet5M) and
+    test_dataset must hold CPU tensors, the worker never touches the GPU.
+    """
+
+    def __init__(self, policies, model_fn, test_dataset, batch_size=400, out_dir='.',
+                 num_threads=1, background=True):
+        self.policies = list(policies)
+        self.out_dir = out_dir
+        self.model_fn = model_fn
+        self.test_dataset = test_dataset
+        self.batch_size = batch_size
+        self._queue = None
+        self._worker = None
+        if background:
+            # fork so the worker does not re-import the training script
+            ctx = mp.get_context('fork')
+            self._queue = ctx.Queue()
+            self._worker = ctx.Process(target=_eval_worker, daemon=True,
+                                       args=(self._queue, model_fn, test_dataset, batch_size,
+                                             out_dir, num_threads))
+            self._worker.start()
+
+    # check every policy for this epoch and submit a snapshot if any of them fires,
+    # returns the policies that fired
+    def step(self, net, epoch, metric=None):
+        fired = [policy for policy in self.policies if policy.should_run(epoch, metric)]
+        if fired:
+            self.submit(net, epoch, [policy.tag for policy in fired])
+        return fired
+
+    def submit(self, net, epoch, tags=('',)):
+        job = (epoch, list(tags), _snapshot(net))
+        if self._queue is not None:
+            self._queue.put(job)
+        else:
+            testloader = DataLoader(self.test_dataset, batch_size=self.batch_size, shuffle=False)
+            _run_job(self.model_fn(), testloader, job, self.out_dir)
+
+    # wait for all queued predictions to be written
+    def close(self):
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
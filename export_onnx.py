@@ -0,0 +1,93 @@
+"""
+Export a checkpoint of any model in models/resnet.py to ONNX with a dynamic batch axis,
+optionally with every BatchNorm folded into the conv before it, then check the ONNX Runtime
+output against eager PyTorch and compare CPU latency / throughput of the two backends.
+
+    python export_onnx.py --model ResNet5M --checkpoint checkpoint/ckpt199.pth --batch-sizes 1 16 64 256
+"""
+
+import argparse
+import copy
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from models.resnet import get_model
+from inference import TorchBackend, OnnxBackend, check_parity, benchmark_backend
+from utils import load_checkpoint_weights
+
+
+def _fold_pairs(module):
+    # conv{i} / bn{i} attribute pairs (blocks, stems) and Conv2d -> BatchNorm2d runs in Sequentials
+    children = dict(module.named_children())
+    pairs = []
+    for name, child in children.items():
+        if isinstance(child, nn.Conv2d) and name.startswith('conv'):
+            bn_name = 'bn' + name[len('conv'):]
+            if isinstance(children.get(bn_name), nn.BatchNorm2d):
+                pairs.append((name, bn_name))
+    if isinstance(module, nn.Sequential):
+        names = list(children)
+        for a, b in zip(names, names[1:]):
+            if isinstance(children[a], nn.Conv2d) and isinstance(children[b], nn.BatchNorm2d):
+                pairs.append((a, b))
+    return pairs
+
+
+# copy of net in eval mode with every conv + BatchNorm pair fused into a single conv
+def fold_batchnorm(net):
+    net = copy.deepcopy(net).cpu().eval()
+    for module in list(net.modules()):
+        for conv_name, bn_name in _fold_pairs(module):
+            fused = fuse_conv_bn_eval(getattr(module, conv_name), getattr(module, bn_name))
+            setattr(module, conv_name, fused)
+            setattr(module, bn_name, nn.Identity())
+    return net
+
+
+def export_onnx(net, path, fold_bn=True, image_size=32, opset=17):
+    net = fold_batchnorm(net) if fold_bn else copy.deepcopy(net).cpu().eval()
+    dummy = torch.randn(1, 3, image_size, image_size)
+    torch.onnx.export(net, dummy, path, input_names=['input'], output_names=['logits'],
+                      dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+                      opset_version=opset)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ONNX export with parity and latency checks')
+    parser.add_argument('--model', default='ResNet5M')
+    parser.add_argument('--checkpoint', default=None, help='without a checkpoint the random init is exported')
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--no-fold-bn', action='store_true')
+    parser.add_argument('--opset', default=17, type=int)
+    parser.add_argument('--threads', default=None, type=int, help='ONNX Runtime intra-op threads')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 16, 64, 256])
+    parser.add_argument('--atol', default=1e-3, type=float)
+    args = parser.parse_args()
+
+    net = get_model(args.model)
+    if args.checkpoint:
+        net = load_checkpoint_weights(net, args.checkpoint)
+    net.eval()
+    out = args.out or f'./checkpoint/{args.model}.onnx'
+    export_onnx(net, out, fold_bn=not args.no_fold_bn, opset=args.opset)
+    print(f"exported {out} (BatchNorm {'kept' if args.no_fold_bn else 'folded'})")
+
+    onnx_backend = OnnxBackend(out, args.threads)
+    max_diff, agreement = check_parity(net, onnx_backend, batch_sizes=args.batch_sizes)
+    print(f"parity: max |logit diff| = {max_diff:.2e}, argmax agreement = {agreement * 100:.2f}%")
+    if max_diff > args.atol:
+        raise SystemExit(f"ONNX output differs from eager by more than {args.atol}")
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    backends = [TorchBackend(net, 'cpu'), onnx_backend]
+    print(f"{'batch':>6}" + ''.join(f"{b.name + ' ms':>12}{b.name + ' img/s':>14}" for b in backends))
+    for batch_size in args.batch_sizes:
+        row = f"{batch_size:>6}"
+        for backend in backends:
+            ms, throughput = benchmark_backend(backend, batch_size)
+            row += f"{ms:>12.2f}{throughput:>14.1f}"
+        print(row)
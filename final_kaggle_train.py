@@ -10,23 +10,37 @@ from torchinfo import summary
 import torchvision
 import torchvision.transforms as transforms
 from torch.utils.data import TensorDataset, DataLoader
-from sklearn.model_selection import train_test_split
 from models.resnet import ResNet18, ResNet5M, ResNet5MWithDropout, ResNet2_Modified, ResNet5M2Layers, ResNet34
 import matplotlib.pyplot as plt
-from customTensorDataset import CustomTensorDataset, get_transform, test_unpickle
+from customTensorDataset import CustomTensorDataset, get_transform, test_unpickle, load_cifar_train
+from splits import stratified_split, make_split_datasets
 import os
 import argparse
 import pickle
 from models import *
-from utils import progress_bar, plot_losses, plot_acc, get_lrs, plot_lr
+from utils import progress_bar, get_lrs, generate_predictions, save_predictions_to_csv
+from metrics_sink import MetricsSink
+from optimizers import build_optimizer, DEFAULT_LR, check_lr
+from distributed import init_distributed, is_main_process, wrap_model, make_loader, set_epoch, scale_lr, all_reduce_sum, cleanup
+from eval_metrics import EvalMetrics, describe as describe_metrics
 
 # Parser 
 parser = argparse.ArgumentParser(description='PyTorch CIFAR10 Training')
-parser.add_argument('--lr', default=0.1, type=float, help='learning rate')
+parser.add_argument('--lr', default=None, type=float,
+                    help='OneCycleLR peak lr (default: sgd 0.1, lars 5 with a usual range of 1-20, lamb 5e-3)')
 parser.add_argument('--resume', '-r', action='store_true',
                     help='resume from checkpoint')
+parser.add_argument('--batch-size', default=400, type=int, help='training batch size per process')
+parser.add_argument('--optimizer', default='sgd', choices=['sgd', 'lars', 'lamb'],
+                    help='lars/lamb for large batches, they skip weight decay on BatchNorm and bias')
+parser.add_argument('--dist-backend', default=None, help='process group backend under torchrun (gloo or nccl)')
+parser.add_argument('--no-lr-scaling', action='store_true',
+                    help='do not scale the lr with the number of processes under torchrun')
 args = parser.parse_args()
 
+# no-op unless launched through torchrun
+rank, world_size, local_rank = init_distributed(args.dist_backend)
+
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 best_acc = 0  
 start_epoch = 0 
@@ -42,18 +56,9 @@ print('==> Preparing data..')
 cifar10_dir = 'data/cifar-10-batches-py'
 meta_data_dict = load_cifar_batch(os.path.join(cifar10_dir, 'batches.meta'))
 label_names = meta_data_dict[b'label_names']
-all_images = []
-all_labels = []
-for i in range(1, 6):
-    batch_dict = load_cifar_batch(os.path.join(cifar10_dir, f'data_batch_{i}'))
-    batch_images = batch_dict[b'data'].reshape((10000, 3, 32, 32)).transpose(0, 1, 2, 3)
-    batch_labels = batch_dict[b'labels']
-    all_images.append(batch_images)
-    all_labels.append(batch_labels)
-    train_images_tensor = torch.Tensor(np.concatenate(all_images, axis=0)).to(device)
-    train_labels_tensor = torch.Tensor(np.concatenate(all_labels, axis=0)).to(torch.long).to(device)
-print("all_images", len(all_images))
-print("all_labels", len(all_labels))
+train_images, train_labels = load_cifar_train(cifar10_dir)
+train_images_tensor = torch.Tensor(train_images).to(device)
+train_labels_tensor = torch.from_numpy(train_labels).to(device)
 print("train_images_tensor", len(train_images_tensor ))
 print("train_labels_tensor", len(train_labels_tensor))
 # Getting test data here: 
@@ -66,19 +71,19 @@ all_test_images.append(batch_test_images)
 all_test_labels.append(batch_test_labels)
 test_images_tensor = torch.Tensor(np.concatenate(all_test_images, axis=0)).to(device)
 test_labels_tensor = torch.Tensor(np.concatenate(all_test_labels, axis=0)).to(torch.long).to(device)
-train_dataset = TensorDataset(train_images_tensor, train_labels_tensor)
-X_train, X_valid, y_train, y_valid = train_test_split(train_images_tensor, train_labels_tensor, test_size=0.1, random_state=42)
+# index views over the shared image tensor, the submission run trains on every sample
+train_idx, valid_idx = stratified_split(train_labels, valid_size=0.1, seed=42)
 print("all test images", len(all_test_images))
 print("all test labels", len(all_test_labels))
 print("test image tensor", len(test_images_tensor))
 print("test images tensor", len(test_labels_tensor))
 # Training dataset
-train_dataset = CustomTensorDataset(tensors=(X_train, y_train), transform=get_transform("train"))
-valid_dataset = CustomTensorDataset(tensors=(X_valid, y_valid), transform=get_transform("valid"))
-batch_size =  400
-train_dataset = CustomTensorDataset(tensors=(train_images_tensor, train_labels_tensor), transform=get_transform("train"))
-trainloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-validloader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False)
+train_dataset, valid_dataset = make_split_datasets((train_images_tensor, train_labels_tensor), None, valid_idx,
+                                                   get_transform("train"), get_transform("valid"))
+batch_size =  args.batch_size
+# sharded across processes when running distributed
+trainloader = make_loader(train_dataset, batch_size, shuffle=True)
+validloader = make_loader(valid_dataset, batch_size, shuffle=False)
 print("train loader length: ", len(trainloader))
 # Testing dataset
 test_dataset = CustomTensorDataset(tensors=(test_images_tensor, test_labels_tensor), transform = get_transform("test"))
@@ -90,21 +95,24 @@ classes = ('plane', 'car', 'bird', 'cat', 'deer',
   
 net = ResNet34()
 net = net.to(device)
+
+# on the unwrapped model, a forward through DDP is a collective the other ranks would never join
+if is_main_process():
+    model_stats = summary(net, input_size = (400, 3, 32, 32))
+    print("Trainable Parameters: "+ str(model_stats.trainable_params))
+
+net = wrap_model(net, device, local_rank)
 if device == 'cuda':
-    net = torch.nn.DataParallel(net)
     cudnn.benchmark = True
 
 checkpoint_dir = './checkpoint/'
 os.makedirs(checkpoint_dir, exist_ok=True)
 
-summary(net, input_size = (400, 3, 32, 32))
-print("Trainable Parameters: "+ str(summary(net, input_size = (400, 3, 32, 32)).trainable_params))
-
 checkpoint_path = './checkpoint/ckpt_epoch.pth'
 
 if os.path.exists(checkpoint_path):
     try:
-        checkpoint = torch.load(checkpoint_path)
+        checkpoint = torch.load(checkpoint_path, map_location=device)
         net.load_state_dict(checkpoint['net'])
 
         best_acc = checkpoint['best_acc']
@@ -121,6 +129,7 @@ print("best_acc", best_acc)
 def train(epoch):
     print('\nEpoch: %d' % epoch)
     net.train()
+    set_epoch(trainloader, epoch)
     train_loss = 0
     correct = 0
     total = 0
@@ -136,8 +145,8 @@ def train(epoch):
             nn.utils.clip_grad_value_(list(net.parameters()), grad_clip)
 
         optimizer.step()
-        current_lr = optimizer.param_groups[0]['lr']
-        lr_trend.append(current_lr)
+        if metrics_sink is not None:
+            metrics_sink.log_step(get_lrs(optimizer))
 
         train_loss += loss.item()
         _, predicted = outputs.max(1)
@@ -147,12 +156,16 @@ def train(epoch):
         progress_bar(batch_idx, len(trainloader), 'train Loss: %.3f | train Acc: %.3f%% (%d/%d)'
                      % (train_loss/(batch_idx+1), 100.*correct/total, correct, total))
 
+    # average over all processes when running distributed
+    train_loss, num_batches, correct, total = all_reduce_sum([train_loss, len(trainloader), correct, total], device)
     train_accuracy = 100.0* correct/total
-    train_loss /= len(trainloader)
+    train_loss /= num_batches
 
     train_loss_trend.append(train_loss)
     train_acc_trend.append(train_accuracy)
     # Save training checkpoint after each epoch
+    if not is_main_process():
+        return
     if not os.path.isdir('checkpoint'):
         os.mkdir('checkpoint')
     torch.save({
@@ -182,13 +195,15 @@ def valid(epoch):
             progress_bar(batch_idx, len(validloader), 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
                          % (test_loss/(batch_idx+1), 100.*correct/total, correct, total))
 
+    # the DistributedSampler pads the last shard, so a few samples may be counted twice
+    test_loss, num_batches, correct, total = all_reduce_sum([test_loss, len(validloader), correct, total], device)
     valid_accuracy = 100.0 * correct / total
-    test_loss /= len(validloader)
+    test_loss /= num_batches
     valid_loss_trend.append(test_loss)
     valid_acc_trend.append(valid_accuracy)
 
     # Save checkpoint.
-    acc = 100.*correct/total
+    acc = valid_accuracy
     if acc > best_acc:
         print('Saving..')
         state = {
@@ -210,37 +225,31 @@ def valid(epoch):
         'valid_acc_trend': valid_acc_trend,
     }
 
+    if not is_main_process():
+        return
     if not os.path.isdir('checkpoint'):
         os.mkdir('checkpoint')
         torch.save(state, './checkpoint/ckpt.pth')
     torch.save(checkpoint, f'./checkpoint/ckpt{epoch}.pth')
 
-            
-def generate_predictions(model, test_loader):
-    model.eval()  
-    predictions = []
-    with torch.no_grad():
-        for batch in test_loader:
-            images, _ = batch 
-            images = images.to(device)
-            outputs = model(images)
-            _, preds = torch.max(outputs, dim=1)
-            predictions.extend(preds.cpu().numpy())  
-    return predictions
-
-def save_predictions_to_csv(predictions, test_ids, csv_filename="predictions.csv"):
-    df = pd.DataFrame({"ID": test_ids, "Labels": predictions})
-    df.to_csv(csv_filename, index=False)
-    print(f"Predictions saved to {csv_filename}")
-
 
 epochs = 200
-max_lr = 0.1
+# LARS / LAMB steps are already scaled to the weight norm, they need a very different lr than SGD
+max_lr = args.lr if args.lr is not None else DEFAULT_LR[args.optimizer]
+check_lr(args.optimizer, max_lr)
 grad_clip = 0.1
 weight_decay_adam = 1e-4
 opt_func = torch.optim.SGD
 criterion = nn.CrossEntropyLoss()
-optimizer = opt_func(net.parameters(), max_lr, weight_decay=weight_decay_adam)
+# the global batch is batch_size * world_size under torchrun, scale the peak lr with it;
+# len(trainloader) is already the per-process number of steps
+if not args.no_lr_scaling:
+    max_lr = scale_lr(max_lr, world_size)
+# OneCycleLR already warms up (pct_start), so no extra warmup is put in front of it
+if args.optimizer == 'sgd':
+    optimizer = opt_func(net.parameters(), max_lr, weight_decay=weight_decay_adam)
+else:
+    optimizer = build_optimizer(net, args.optimizer, max_lr, weight_decay=weight_decay_adam)
 scheduler= torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr, epochs=epochs, 
                                                 steps_per_epoch=len(trainloader))
 
@@ -257,7 +266,7 @@ lr_para = "OneCycleLR"
 scheduler_para = "WD: " + str(weight_decay_adam)
 lr_para = "Max LR: " + str(max_lr)
 grad_clip_para = "GC: " + str(grad_clip)
-opt_para = "SGD"
+opt_para = args.optimizer.upper()
 epoch_para = "Epochs: " + str(epochs)
 paras_for_graph = [lr_para, scheduler_para, grad_clip_para, opt_para, epoch_para, lr_para]
 
@@ -265,26 +274,32 @@ train_loss_trend = []
 train_acc_trend = []
 valid_loss_trend = []
 valid_acc_trend = []
-lr_trend = []
+
+# only rank 0 writes metrics, plots and predictions
+metrics_sink = None
+if is_main_process():
+    metrics_sink = MetricsSink('./metrics/', paras_for_graph, reset=(start_epoch == 0))
 
 for epoch in range(epochs):
     train(epoch)
-    current_lr = optimizer.param_groups[0]['lr']
-    lr_trend.append(current_lr)
     valid(epoch)
+    if metrics_sink is not None:
+        metrics_sink.log_epoch(epoch, train_loss_trend[-1], train_acc_trend[-1],
+                               valid_loss_trend[-1], valid_acc_trend[-1], get_lrs(optimizer))
     scheduler.step()
 
-predictions = generate_predictions(net, testloader)
-save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions_final.csv")
-print("checking progress")
-print(train_acc_trend)
-print(train_loss_trend)
-print(valid_acc_trend)
-print(valid_loss_trend)
-print("over")
-plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
+if is_main_process():
+    # predict with the unwrapped model, a DDP forward on one rank alone would wait for the others
+    predictions = generate_predictions(getattr(net, 'module', net), testloader, device)
+    save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions_final.csv")
+    print("checking progress")
+    print(train_acc_trend)
+    print(train_loss_trend)
+    print(valid_acc_trend)
+    print(valid_loss_trend)
+    print("over")
+    metrics_sink.request_plots(epoch)
+    metrics_sink.close()
 
 def get_default_device():
     """Pick GPU if available, else CPU"""
@@ -342,24 +357,22 @@ def get_real_test_dataloader():
 
 def test_acc(model, testLoader):
     model.eval()
-    test_loss = 0
-    correct = 0
-    total = 0
+    # per-class accuracy, top-k and calibration come out of the same pass
+    metrics = EvalMetrics(num_classes=10, device=device)
     with torch.no_grad():
         for batch_idx, (inputs, targets) in enumerate(testLoader):
             inputs, targets = inputs.to(device), targets.to(device)
-            outputs = net(inputs)
-            _, predicted = outputs.max(1)
-            total += targets.size(0)
-            correct += predicted.eq(targets).sum().item()
-            progress_bar(batch_idx, len(testLoader), 'Acc: %.3f%% (%d/%d)'
-                         % (100.*correct/total, correct, total))
-
-    valid_accuracy = 100.0 * correct / total
+            outputs = model(inputs)
+            metrics.update(outputs, targets, criterion(outputs, targets))
+            progress_bar(batch_idx, len(testLoader))
 
-    # Save checkpoint.
-    acc = 100.*correct/total
-    return acc
+    # every rank evaluates the full test set, so no reduction
+    results = metrics.compute(reduce=False)
+    names = [name.decode() for name in label_names]
+    print(describe_metrics(results, names))
+    for name, acc in zip(names, results['per_class_acc']):
+        print(f"  {name}: {acc:.2f}%")
+    return results['acc']
 
 
 
@@ -373,4 +386,5 @@ print(real_results)
 
 
 
-    
\ No newline at end of file
+    
+cleanup()
@@ -0,0 +1,110 @@
+"""
+Inference backends with one predict API: eager PyTorch (TorchBackend) or an exported ONNX
+graph on ONNX Runtime (OnnxBackend, CPU). Both take a float32 batch (N, 3, H, W) as a
+tensor or numpy array and return numpy logits / class ids.
+
+    backend = load_backend('onnx', onnx_path='checkpoint/ResNet5M.onnx')
+    predictions = predict_loader(backend, test_loader)
+"""
+
+import time
+
+import numpy as np
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+def _to_numpy(images):
+    if isinstance(images, torch.Tensor):
+        return images.detach().cpu().numpy().astype(np.float32, copy=False)
+    return np.ascontiguousarray(images, dtype=np.float32)
+
+
+class TorchBackend:
+    name = 'torch'
+
+    def __init__(self, net, device='cpu'):
+        self.net = net.to(device).eval()
+        self.device = device
+
+    def predict_logits(self, images):
+        if not isinstance(images, torch.Tensor):
+            images = torch.from_numpy(_to_numpy(images))
+        with torch.no_grad():
+            return self.net(images.to(self.device)).cpu().numpy()
+
+    def predict(self, images):
+        return self.predict_logits(images).argmax(1)
+
+
+class OnnxBackend:
+    name = 'onnx'
+
+    def __init__(self, onnx_path, num_threads=None):
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is not installed, pip install onnxruntime")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict_logits(self, images):
+        return self.session.run(None, {self.input_name: _to_numpy(images)})[0]
+
+    def predict(self, images):
+        return self.predict_logits(images).argmax(1)
+
+
+def load_backend(kind, net=None, onnx_path=None, device='cpu', num_threads=None):
+    if kind == 'torch':
+        return TorchBackend(net, device)
+    elif kind == 'onnx':
+        return OnnxBackend(onnx_path, num_threads)
+    else:
+        raise ValueError(f"unknown backend {kind}")
+
+
+# same output as utils.generate_predictions, for any backend
+def predict_loader(backend, loader):
+    predictions = []
+    for images, _ in loader:
+        predictions.extend(backend.predict(images))
+    return predictions
+
+
+# compare a backend against the eager model on random and (optionally) real batches,
+# returns the max absolute logit difference and the fraction of matching argmax
+def check_parity(net, backend, batch_sizes=(1, 7, 64), image_size=32, seed=0, images=None):
+    reference = TorchBackend(net, 'cpu')
+    generator = torch.Generator().manual_seed(seed)
+    batches = [torch.randn(bs, 3, image_size, image_size, generator=generator) for bs in batch_sizes]
+    if images is not None:
+        batches.append(images)
+    max_diff, agree, total = 0.0, 0, 0
+    for batch in batches:
+        expected = reference.predict_logits(batch)
+        actual = backend.predict_logits(batch)
+        max_diff = max(max_diff, float(np.abs(expected - actual).max()))
+        agree += int((expected.argmax(1) == actual.argmax(1)).sum())
+        total += len(batch)
+    return max_diff, agree / total
+
+
+# median latency (ms) and throughput (img/s) of one backend at one batch size
+def benchmark_backend(backend, batch_size, iters=20, warmup=5, image_size=32):
+    images = np.random.randn(batch_size, 3, image_size, image_size).astype(np.float32)
+    times = []
+    for i in range(warmup + iters):
+        start = time.perf_counter()
+        backend.predict_logits(images)
+        if i >= warmup:
+            times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    median = times[len(times) // 2]
+    return median, batch_size * 1000 / median
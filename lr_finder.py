@@ -0,0 +1,157 @@
+"""
+LR range test (Smith 2017, "Cyclical Learning Rates for Training Neural Networks"): starting
+from a fixed initial state, the lr grows exponentially from --start-lr to --end-lr over a few
+hundred steps while the bias-corrected exponential moving average of the loss is recorded.
+The test stops once the smoothed loss diverges, and the model and optimizer are restored.
+
+Suggestions:
+  * OneCycleLR max_lr: a tenth of the lr with the lowest smoothed loss
+  * CosineAnnealingLR base lr: the lr where the smoothed loss falls fastest (steepest slope
+    against log lr), taken before the minimum
+
+The curve is written to metrics/lr_range.csv, one row per step with the columns step, lr, loss,
+smoothed_loss (its own layout, not metrics.csv's per-epoch columns), and plotted.
+
+    python lr_finder.py --model ResNet5M --batch-size 400 --steps 300
+"""
+
+import os
+import csv
+import copy
+import math
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from models.resnet import get_model
+from customTensorDataset import get_transform, load_cifar_train
+from splits import stratified_split, make_split_datasets
+from optimizers import build_optimizer
+from distributed import make_loader
+from utils import load_checkpoint_weights, repeat_batches, progress_bar, plot_lr_range
+
+RANGE_FIELDS = ['step', 'lr', 'loss', 'smoothed_loss']
+
+
+def lr_range_test(net, optimizer, criterion, batches, device='cpu', start_lr=1e-7, end_lr=10.0,
+                  num_steps=300, smoothing=0.98, diverge_factor=4.0):
+    state = (copy.deepcopy(net.state_dict()), copy.deepcopy(optimizer.state_dict()))
+    gamma = (end_lr / start_lr) ** (1.0 / max(num_steps - 1, 1))
+    lrs, losses, smoothed = [], [], []
+    avg_loss, best_loss = 0.0, float('inf')
+    net.train()
+    try:
+        for step in range(num_steps):
+            lr = start_lr * gamma ** step
+            for group in optimizer.param_groups:
+                group['lr'] = lr
+            inputs, targets = next(batches)[:2]
+            inputs, targets = inputs.to(device), targets.to(device)
+            optimizer.zero_grad()
+            loss = criterion(net(inputs), targets)
+            loss.backward()
+            optimizer.step()
+
+            value = loss.item()
+            avg_loss = smoothing * avg_loss + (1 - smoothing) * value
+            smooth = avg_loss / (1 - smoothing ** (step + 1))
+            lrs.append(lr)
+            losses.append(value)
+            smoothed.append(smooth)
+            progress_bar(step, num_steps, 'lr %.2e smoothed loss %.3f' % (lr, smooth))
+            if not math.isfinite(smooth) or smooth > diverge_factor * best_loss:
+                print(f"\nloss diverged at lr {lr:.2e}, stopping")
+                break
+            best_loss = min(best_loss, smooth)
+    finally:
+        net.load_state_dict(state[0])
+        optimizer.load_state_dict(state[1])
+    return lrs, losses, smoothed
+
+
+def _trim(lrs, smoothed, skip_start, skip_end):
+    lrs, smoothed = lrs[skip_start:len(lrs) - skip_end], smoothed[skip_start:len(smoothed) - skip_end]
+    finite = np.isfinite(smoothed)
+    return lrs[finite], smoothed[finite]
+
+
+def suggest(lrs, smoothed, skip_start=10, skip_end=5):
+    lrs, smoothed = np.asarray(lrs), np.asarray(smoothed)
+    # short runs or runs that diverged almost at once: shrink the skipped ends before giving up
+    for start, end in ((skip_start, skip_end), (min(skip_start, len(lrs) // 4), min(skip_end, 1)), (0, 0)):
+        trimmed_lrs, trimmed = _trim(lrs, smoothed, start, end)
+        if len(trimmed) >= 2:
+            break
+    else:
+        raise ValueError(f"the range test has {int(np.isfinite(smoothed).sum())} finite loss points, need at least 2: "
+                         f"run more --steps or lower --start-lr")
+    if (start, end) != (skip_start, skip_end):
+        print(f"too few finite points in {len(lrs)} steps, skipping {start} at the start and {end} at the end instead")
+    lrs, smoothed = trimmed_lrs, trimmed
+    min_idx = int(smoothed.argmin())
+    slopes = np.gradient(smoothed, np.log10(lrs))
+    steepest_idx = int(slopes[:max(min_idx, 1)].argmin())
+    return {
+        'min_loss_lr': float(lrs[min_idx]),
+        'onecycle_max_lr': float(lrs[min_idx] / 10),
+        'cosine_lr': float(lrs[steepest_idx]),
+    }
+
+
+def write_range_log(path, lrs, losses, smoothed):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(RANGE_FIELDS)
+        for step, row in enumerate(zip(lrs, losses, smoothed)):
+            writer.writerow([step, *row])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LR range test')
+    parser.add_argument('--model', default='ResNet5M')
+    parser.add_argument('--checkpoint', default=None, help='initial state, default: fresh init')
+    parser.add_argument('--optimizer', default='sgd', choices=['sgd', 'lars', 'lamb'])
+    parser.add_argument('--batch-size', default=400, type=int)
+    parser.add_argument('--start-lr', default=1e-7, type=float)
+    parser.add_argument('--end-lr', default=10.0, type=float)
+    parser.add_argument('--steps', default=300, type=int)
+    parser.add_argument('--log-dir', default='./metrics/')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    net = get_model(args.model)
+    if args.checkpoint:
+        net = load_checkpoint_weights(net, args.checkpoint)
+    net = net.to(device)
+
+    images, labels = load_cifar_train()
+    tensors = (torch.Tensor(images), torch.from_numpy(labels))
+    train_idx, valid_idx = stratified_split(labels, valid_size=0.1, seed=42)
+    train_dataset, _ = make_split_datasets(tensors, train_idx, valid_idx,
+                                           get_transform("train"), get_transform("valid"))
+    trainloader = make_loader(train_dataset, args.batch_size, shuffle=True)
+
+    criterion = nn.CrossEntropyLoss()
+    if args.optimizer == 'sgd':
+        optimizer = optim.SGD(net.parameters(), lr=args.start_lr, momentum=0.9, weight_decay=5e-4)
+    else:
+        optimizer = build_optimizer(net, args.optimizer, args.start_lr, weight_decay=5e-4)
+
+    lrs, losses, smoothed = lr_range_test(net, optimizer, criterion, repeat_batches(trainloader), device,
+                                          args.start_lr, args.end_lr, args.steps)
+    suggestions = suggest(lrs, smoothed)
+
+    os.makedirs(args.log_dir, exist_ok=True)
+    log_path = os.path.join(args.log_dir, 'lr_range.csv')
+    write_range_log(log_path, lrs, losses, smoothed)
+    hyperparam = [args.model, args.optimizer.upper(), f'batch {args.batch_size}']
+    plot_lr_range(lrs, smoothed, hyperparam,
+                  {'max_lr': suggestions['onecycle_max_lr'], 'cosine': suggestions['cosine_lr']})
+    print(f"wrote {log_path}")
+    print(f"lowest smoothed loss at lr {suggestions['min_loss_lr']:.2e}")
+    print(f"OneCycleLR max_lr: {suggestions['onecycle_max_lr']:.2e}")
+    print(f"CosineAnnealingLR lr (python main.py --lr): {suggestions['cosine_lr']:.2e}")
@@ -9,6 +9,7 @@ Main branch has the clean codes without training traces, the checkpoint data sho
 
 import torch
 import os
+import time
 import argparse
 import pickle
 import numpy as np
@@ -22,45 +23,135 @@ from torchinfo import summary
 import torchvision
 import torchvision.transforms as transforms
 from torch.utils.data import TensorDataset, DataLoader
-from sklearn.model_selection import train_test_split
 from models import *
-from models.resnet import ResNet18, ResNet5M, ResNet5MWithDropout, ResNet2_Modified, ResNet5M2Layers, ResNet34, ResNet50
+from models.resnet import ResNet18, ResNet5M, ResNet5MWithDropout, ResNet2_Modified, ResNet5M2Layers, ResNet34, ResNet50, set_activation_checkpointing
 import matplotlib.pyplot as plt
-from customTensorDataset import CustomTensorDataset, get_transform, test_unpickle
-from utils import progress_bar, plot_losses, plot_acc, get_lrs, plot_lr
+from customTensorDataset import CustomTensorDataset, get_transform, test_unpickle, load_cifar_train
+from splits import stratified_split, make_split_datasets
+from utils import progress_bar, get_lrs, generate_predictions, save_predictions_to_csv
+from metrics_sink import MetricsSink
+from eval_schedule import EvalScheduler, EveryKEpochs, AtEpochs, OnImprovement, AboveThreshold
+from runtime_config import plan_threads, apply_thread_config, loader_kwargs, autotune_threads, describe
+from optimizers import build_optimizer, with_warmup, DEFAULT_LR, check_lr
+from distributed import init_distributed, is_main_process, wrap_model, make_loader, set_epoch, scale_lr, all_reduce_sum, cleanup
+from progressive import ProgressiveSchedule, fixres_finetune
+from aug_cache import AugmentationCache
+from shards import ShardedDataset
+from delta_ckpt import DeltaCheckpointStore
+from selective_backprop import SelectiveBackprop
+from batch_finder import find_batch_size, autocast_context
+from eval_metrics import EvalMetrics, describe as describe_metrics
+from run_store import RunStore
+from coreset import load_scores, select_coreset
+from preemption import PreemptionHandler, snapshot_path, save_snapshot, load_snapshot, clear_snapshot
 
 # Parser 
 parser = argparse.ArgumentParser(description='PyTorch CIFAR10 Training')
-parser.add_argument('--lr', default=0.1, type=float, help='learning rate')
+parser.add_argument('--lr', default=None, type=float,
+                    help='learning rate at batch size 128 (default: sgd 0.1, lars 5 with a usual range of 1-20, lamb 5e-3)')
 parser.add_argument('--resume', '-r', action='store_true',
                     help='resume from checkpoint')
+parser.add_argument('--valid-size', default=0.1, type=lambda v: int(v) if v.isdigit() else float(v),
+                    help='validation fraction or number of samples, 0 for no validation set')
+parser.add_argument('--train-on-full', action='store_true',
+                    help='train on every sample, including the ones used for validation')
+parser.add_argument('--eval-epochs', default=[10, 20, 25] + list(range(50, 201, 10)),
+                    type=lambda s: [int(e) for e in s.split(',') if e], help='epochs to write test predictions at, e.g. 10,20,50')
+parser.add_argument('--eval-every', default=0, type=int, help='also write test predictions every K epochs')
+parser.add_argument('--eval-on-improvement', action='store_true',
+                    help='also write test predictions whenever validation accuracy improves')
+parser.add_argument('--dist-backend', default=None, help='process group backend under torchrun (gloo or nccl)')
+parser.add_argument('--no-lr-scaling', action='store_true',
+                    help='do not scale the lr with the batch size and the number of processes under torchrun')
+parser.add_argument('--batch-size', default=128, type=lambda v: v if v == 'auto' else int(v),
+                    help='training batch size per process, auto = throughput-optimal under --memory-cap')
+parser.add_argument('--memory-cap', default=None, type=float, help='MB per process for --batch-size auto')
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                    help='training / validation precision (bf16 runs the forward passes under autocast), '
+                         'also used by the --batch-size auto search')
+parser.add_argument('--optimizer', default='sgd', choices=['sgd', 'lars', 'lamb'],
+                    help='lars/lamb for large batches, they skip weight decay on BatchNorm and bias')
+parser.add_argument('--warmup-epochs', default=0, type=int, help='linear lr warmup before the cosine schedule')
+parser.add_argument('--checkpoint-every', default=0, type=int,
+                    help='activation checkpointing: 0 none, N every N-th block of each stage, 1 all blocks')
+parser.add_argument('--threads', default=None, type=int, help='intra-op compute threads (default: cores left after the workers)')
+parser.add_argument('--interop-threads', default=None, type=int, help='inter-op threads')
+parser.add_argument('--workers', default=None, type=int, help='DataLoader workers (default: a quarter of the cores)')
+parser.add_argument('--no-pin', action='store_true', help='do not pin compute threads and workers to cores')
+parser.add_argument('--autotune-threads', action='store_true',
+                    help='time a few training steps of the model to pick the compute/worker split')
+parser.add_argument('--progressive', action='store_true',
+                    help='progressive resizing: train early epochs on smaller images, ramping up to 32px')
+parser.add_argument('--prog-start-size', default=16, type=int, help='image size of the first epochs')
+parser.add_argument('--prog-ramp', default=[0, 100], type=lambda s: [int(e) for e in s.split(',')],
+                    help='epochs where the ramp from the start size to 32px begins and ends, e.g. 20,120')
+parser.add_argument('--fixres-epochs', default=0, type=int,
+                    help='fine-tune BatchNorm and classifier at 32px with test preprocessing after training')
+parser.add_argument('--fixres-lr', default=1e-3, type=float)
+parser.add_argument('--aug-cache', action='store_true',
+                    help='train on epochs pre-augmented by background producer processes')
+parser.add_argument('--aug-cache-dir', default='./aug_cache')
+parser.add_argument('--aug-slots', default=3, type=int, help='epochs buffered on disk')
+parser.add_argument('--aug-producers', default=1, type=int, help='augmentation producer processes')
+parser.add_argument('--aug-echo', default=1, type=int,
+                    help='serve a cached epoch up to this many times when the producers fall behind')
+parser.add_argument('--train-shards', default=None,
+                    help='stream the training set from a shard directory written by shards.py')
+parser.add_argument('--delta-ckpt', default=0, type=int,
+                    help='keep checkpoints as a full base every N epochs plus compressed deltas (0 = full torch.save files)')
+parser.add_argument('--selective-backprop', action='store_true',
+                    help='only backpropagate through high-loss samples, re-batched to the full batch size')
+parser.add_argument('--sb-beta', default=2.0, type=float, help='keep probability = loss percentile ** beta')
+parser.add_argument('--sb-start-epoch', default=100, type=int, help='train on every sample before this epoch')
+parser.add_argument('--run-store', default='./runs.sqlite',
+                    help='SQLite file the config, per-epoch metrics and artifacts of the run are recorded in, empty to disable')
+parser.add_argument('--run-name', default=None)
+parser.add_argument('--preemptible', action='store_true',
+                    help='snapshot and exit on SIGTERM/SIGINT after the current step, resume mid-epoch from the snapshot')
+parser.add_argument('--coreset', default=None,
+                    help='train on a class-balanced coreset picked from the scores written by coreset.py score')
+parser.add_argument('--coreset-fraction', default=0.3, type=float)
+parser.add_argument('--coreset-score', default='el2n', choices=['el2n', 'forgetting'])
 args = parser.parse_args()
+if args.lr is None:
+    args.lr = DEFAULT_LR[args.optimizer]
+check_lr(args.optimizer, args.lr)
+if args.aug_cache and args.progressive:
+    parser.error('--aug-cache produces 32px epochs, it cannot be combined with --progressive')
+if args.aug_cache and args.train_shards:
+    parser.error('--aug-cache augments the in-memory CIFAR images, it cannot be combined with --train-shards')
+if args.selective_backprop and (args.aug_cache or args.train_shards):
+    parser.error('--selective-backprop needs sample indices from the in-memory dataset')
+if args.preemptible and (args.aug_cache or args.train_shards or args.selective_backprop):
+    parser.error('--preemptible resumes through the sampler of the in-memory dataset, '
+                 'it cannot be combined with --aug-cache, --train-shards or --selective-backprop')
+
+# no-op unless launched through torchrun
+rank, world_size, local_rank = init_distributed(args.dist_backend)
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# on CPU split the cores between compute threads and loader workers,
+# on CUDA the data tensors live on the GPU so loading stays in the main process
+local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+thread_config = plan_threads(args.threads, args.interop_threads, args.workers if device == 'cpu' else 0,
+                             local_rank, local_world_size)
+if device == 'cpu':
+    apply_thread_config(thread_config, pin=not args.no_pin)
+    print(describe(thread_config))
 best_acc = 0  
 start_epoch = 0 
 
-def load_cifar_batch(file):
-    with open(file, 'rb') as fo:
-        dict = pickle.load(fo, encoding='bytes')
-    return dict
 # Data
 print('==> Preparing data..')
 
 # Getting training and validation data: 
 cifar10_dir = 'data/cifar-10-batches-py'
-meta_data_dict = load_cifar_batch(os.path.join(cifar10_dir, 'batches.meta'))
+meta_data_dict = test_unpickle(os.path.join(cifar10_dir, 'batches.meta'))
 label_names = meta_data_dict[b'label_names']
-all_images = []
-all_labels = []
-for i in range(1, 6):
-    batch_dict = load_cifar_batch(os.path.join(cifar10_dir, f'data_batch_{i}'))
-    batch_images = batch_dict[b'data'].reshape((10000, 3, 32, 32)).transpose(0, 1, 2, 3)
-    batch_labels = batch_dict[b'labels']
-    all_images.append(batch_images)
-    all_labels.append(batch_labels)
-    train_images_tensor = torch.Tensor(np.concatenate(all_images, axis=0)).to(device)
-    train_labels_tensor = torch.Tensor(np.concatenate(all_labels, axis=0)).to(torch.long).to(device)
+train_images, train_labels = load_cifar_train(cifar10_dir)
+train_images_tensor = torch.Tensor(train_images).to(device)
+train_labels_tensor = torch.from_numpy(train_labels).to(device)
 
 
 # Getting test data here: 
@@ -73,53 +164,117 @@ all_test_images.append(batch_test_images)
 all_test_labels.append(batch_test_labels)
 test_images_tensor = torch.Tensor(np.concatenate(all_test_images, axis=0)).to(device)
 test_labels_tensor = torch.Tensor(np.concatenate(all_test_labels, axis=0)).to(torch.long).to(device)
-train_dataset = TensorDataset(train_images_tensor, train_labels_tensor)
-X_train, X_valid, y_train, y_valid = train_test_split(train_images_tensor, train_labels_tensor, test_size=0.1, random_state=42)
-
-# Training and Vaidation dataset
-train_dataset = CustomTensorDataset(tensors=(X_train, y_train), transform=get_transform("train"))
-valid_dataset = CustomTensorDataset(tensors=(X_valid, y_valid), transform=get_transform("valid"))
-batch_size =  128
-train_dataset = CustomTensorDataset(tensors=(train_images_tensor, train_labels_tensor), transform=get_transform("train"))
-trainloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-validloader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False)
+
+# Training and Vaidation dataset, both are index views over the same image tensor
+train_idx, valid_idx = stratified_split(train_labels, valid_size=args.valid_size, seed=42)
+if args.train_on_full:
+    train_idx = None
+if args.coreset:
+    # e.g. for hyperparameter-ranking trials, the validation set is not affected
+    candidates = np.arange(len(train_labels)) if train_idx is None else train_idx
+    train_idx = select_coreset(load_scores(args.coreset)[args.coreset_score], train_labels, candidates,
+                               args.coreset_fraction)
+    print(f"training on a {args.coreset_score} coreset of {len(train_idx)} / {len(candidates)} samples")
+train_dataset, valid_dataset = make_split_datasets((train_images_tensor, train_labels_tensor), train_idx, valid_idx,
+                                                   get_transform("train"), get_transform("valid"))
+# Models to choose from 
+model_fn = ResNet5M
+# model_fn = ResNet34
+# model_fn = ResNet5MWithDropout
+# model_fn = ResNet5M2Layers
+# model_fn = lambda: ResNet2_Modified(in_channels=3, num_classes=10)
+
+batch_size =  args.batch_size
+test_batch_size =  100
+if args.batch_size == 'auto' and args.preemptible:
+    # a resumed epoch continues at sample batch_idx * batch_size, it needs the batch size it was started with
+    snapshot = load_snapshot(snapshot_path('./checkpoint/', rank), restore=False)
+    if snapshot is not None:
+        batch_size, test_batch_size = snapshot['batch_size'], snapshot['test_batch_size']
+        print(f"batch size {batch_size} from the preemption snapshot")
+    del snapshot
+if batch_size == 'auto':
+    # searched on rank 0 only, every rank must use the same batch size
+    batch_size, test_batch_size = 0, 0
+    if is_main_process():
+        batch_size, _ = find_batch_size(model_fn, 'train', args.precision, args.memory_cap, device=device)
+        test_batch_size, _ = find_batch_size(model_fn, 'infer', args.precision, args.memory_cap, device=device)
+    batch_size, test_batch_size = [int(v) for v in all_reduce_sum([batch_size, test_batch_size], device)]
+    print(f"batch size: train {batch_size}, test {test_batch_size}")
+if args.autotune_threads and device == 'cpu':
+    thread_config = autotune_threads(model_fn, train_dataset, batch_size, local_rank=local_rank,
+                                     local_world_size=local_world_size, pin=not args.no_pin)
+# selective backprop keeps a loss per sample, so the dataset also returns sample positions
+selector = None
+if args.selective_backprop:
+    if world_size > 1:
+        raise SystemExit('--selective-backprop runs a different number of steps per process, use a single process')
+    train_dataset.return_index = True
+    selector = SelectiveBackprop(len(train_labels), batch_size, beta=args.sb_beta)
+if args.train_shards:
+    # larger-than-memory training sets, streamed from uint8 record shards
+    train_dataset = ShardedDataset(args.train_shards, transform=get_transform("train"), seed=42)
+    # the shards must leave out this run's validation samples (shards.py --valid-size)
+    shard_split = train_dataset.index.get('split', {'valid_size': 0, 'seed': 42})
+    if not args.train_on_full and (shard_split['valid_size'] != args.valid_size or shard_split['seed'] != 42):
+        parser.error(f"--train-shards were written with --valid-size {shard_split['valid_size']}, they would "
+                     f"train on the validation samples of --valid-size {args.valid_size} (or pass --train-on-full)")
+# sharded across processes when running distributed
+trainloader = make_loader(train_dataset, batch_size, shuffle=True, resumable=args.preemptible,
+                          **loader_kwargs(thread_config, pin=not args.no_pin))
+validloader = make_loader(valid_dataset, batch_size, shuffle=False, **loader_kwargs(thread_config, pin=not args.no_pin))
 print("train loader length: ", len(trainloader))
 
+# this process' share of the training samples, augmented ahead of time into a ring of epochs on disk
+aug_cache = None
+if args.aug_cache:
+    cache_idx = np.arange(len(train_labels)) if train_idx is None else np.asarray(train_idx)
+    # pad to a multiple of the world size like the DistributedSampler, every rank needs the same number of batches
+    padded = -(-len(cache_idx) // world_size) * world_size
+    cache_idx = np.concatenate([cache_idx, cache_idx[:padded - len(cache_idx)]])[rank::world_size]
+    aug_cache = AugmentationCache(train_images[cache_idx], torch.from_numpy(train_labels[cache_idx]),
+                                  cache_dir=os.path.join(args.aug_cache_dir, f'rank{rank}'),
+                                  num_slots=args.aug_slots, num_producers=args.aug_producers,
+                                  echo_factor=args.aug_echo, seed=42 + rank)
+
 # Testing dataset
 test_dataset = CustomTensorDataset(tensors=(test_images_tensor, test_labels_tensor), transform = get_transform("test"))
-batch_size =  100
-testloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+testloader = DataLoader(test_dataset, batch_size=test_batch_size, shuffle=False)
 print("test loader length: ", len(testloader))
 classes = ('plane', 'car', 'bird', 'cat', 'deer',
            'dog', 'frog', 'horse', 'ship', 'truck')
 
-# Models to choose from 
 # print('==> Building model..')      
-net = ResNet5M()
-# net = ResNet34()
-# net = ResNet5MWithDropout()
-# net = ResNet5M2Layers()
-# net = ResNet2_Modified(in_channels=3, num_classes=10) 
-# net = ResNet34()
+net = model_fn()
+# trade recompute for activation memory (ResNet / ResNet5M34 stages only)
+set_activation_checkpointing(net, args.checkpoint_every)
 
 net = net.to(device)
+
+# print summary for clarity, on the unwrapped model: a forward through DDP broadcasts buffers,
+# a collective the other ranks would never join
+if is_main_process():
+    model_stats = summary(net, input_size = (batch_size, 3, 32, 32))
+    print("Trainable Parameters: "+ str(model_stats.trainable_params))
+
+net = wrap_model(net, device, local_rank)
 if device == 'cuda':
-    net = torch.nn.DataParallel(net)
     cudnn.benchmark = True
 
 checkpoint_dir = './checkpoint/'
 os.makedirs(checkpoint_dir, exist_ok=True)
 
-# print summary for clarity 
-summary(net, input_size = (400, 3, 32, 32))
-print("Trainable Parameters: "+ str(summary(net, input_size = (400, 3, 32, 32)).trainable_params))
-
 checkpoint_path = './checkpoint/ckpt_epoch.pth'
 
+# one compressed record per epoch instead of the two full torch.save files
+delta_store = None
+if args.delta_ckpt and is_main_process():
+    delta_store = DeltaCheckpointStore(os.path.join(checkpoint_dir, 'delta'), base_every=args.delta_ckpt)
+
 # create checkpoints
 if os.path.exists(checkpoint_path):
     try:
-        checkpoint = torch.load(checkpoint_path)
+        checkpoint = torch.load(checkpoint_path, map_location=device)
         net.load_state_dict(checkpoint['net'])
 
         best_acc = checkpoint['best_acc']
@@ -130,42 +285,111 @@ if os.path.exists(checkpoint_path):
 else:
     print(f"Checkpoint file '{checkpoint_path}' not found. Starting from scratch.")
 
-# training function 
-def train(epoch):
-    print('\nEpoch: %d' % epoch)
-    net.train()
-    train_loss = 0
-    correct = 0
-    total = 0
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        optimizer.zero_grad()
+# one optimizer step on a batch
+def train_step(inputs, targets):
+    optimizer.zero_grad()
+    with autocast_context(device, args.precision):
         outputs = net(inputs)
         loss = criterion(outputs, targets)
 
-        loss.backward()
+    loss.backward()
+
+    if grad_clip:
+        nn.utils.clip_grad_value_(list(net.parameters()), grad_clip)
 
-        if grad_clip:
-            nn.utils.clip_grad_value_(list(net.parameters()), grad_clip)
+    optimizer.step()
+    if metrics_sink is not None:
+        metrics_sink.log_step(get_lrs(optimizer))
+    return outputs, loss
+
+# everything needed to continue epoch `epoch` at batch `next_batch`, one file per rank
+def save_preemption_snapshot(epoch, next_batch, train_loss=0, correct=0, total=0):
+    save_snapshot(snapshot_path(checkpoint_dir, rank), {
+        'epoch': epoch,
+        'batch_idx': next_batch,
+        # batch_idx only locates the next sample with the same per-rank batch size and number of ranks
+        'batch_size': batch_size,
+        'test_batch_size': test_batch_size,
+        'world_size': world_size,
+        'train_loss': train_loss,
+        'correct': correct,
+        'total': total,
+        'start_epoch': start_epoch,
+        'net': net.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'best_acc': best_acc,
+        'train_loss_trend': train_loss_trend,
+        'valid_loss_trend': valid_loss_trend,
+        'train_acc_trend': train_acc_trend,
+        'valid_acc_trend': valid_acc_trend,
+    })
+    print(f"preemption snapshot written at epoch {epoch}, batch {next_batch}")
 
-        optimizer.step()
-        lr_trend.append(get_lrs(optimizer))
+# training function, returns False when it stopped early for a preemption snapshot
+def train(epoch, resume=None):
+    print('\nEpoch: %d' % epoch)
+    net.train()
+    set_epoch(trainloader, epoch)
+    start_batch = 0
+    train_loss = 0
+    correct = 0
+    total = 0
+    if resume is not None:
+        # continue the interrupted epoch at the first batch not trained on yet
+        start_batch = resume['batch_idx']
+        train_loss, correct, total = resume['train_loss'], resume['correct'], resume['total']
+        trainloader.sampler.resume_at(epoch, start_batch * batch_size)
+        # a snapshot after the last step leaves no batches, the epoch is just finished off
+    batches = aug_cache.epoch(batch_size, device) if aug_cache is not None else trainloader
+    selective = selector is not None and epoch >= args.sb_start_epoch
+    num_batches = start_batch + len(batches)
+    for batch_idx, batch in enumerate(batches, start=start_batch):
+        inputs, targets = batch[0].to(device), batch[1].to(device)
+        if selective:
+            # forward without autograd to score the batch, backward only on full batches of kept samples.
+            # Scored in eval mode, so only the training step updates the BatchNorm running stats
+            net.eval()
+            with torch.no_grad(), autocast_context(device, args.precision):
+                outputs = net(inputs)
+                losses = F.cross_entropy(outputs, targets, reduction='none')
+            net.train()
+            loss = losses.mean()
+            keep = selector.select(losses, batch[2])
+            for selected_inputs, selected_targets in selector.add(inputs, targets, keep):
+                train_step(selected_inputs, selected_targets)
+        else:
+            outputs, loss = train_step(inputs, targets)
 
         train_loss += loss.item()
         _, predicted = outputs.max(1)
         total += targets.size(0)
         correct += predicted.eq(targets).sum().item()
 
-        progress_bar(batch_idx, len(trainloader), 'train Loss: %.3f | train Acc: %.3f%% (%d/%d)'
+        progress_bar(batch_idx, num_batches, 'train Loss: %.3f | train Acc: %.3f%% (%d/%d)'
                      % (train_loss/(batch_idx+1), 100.*correct/total, correct, total))
 
+        if preemption is not None and preemption.should_stop(device):
+            save_preemption_snapshot(epoch, batch_idx + 1, train_loss, correct, total)
+            return False
+
+    # average over all processes when running distributed
+    train_loss, num_batches, correct, total = all_reduce_sum([train_loss, num_batches, correct, total], device)
     train_accuracy = 100.0* correct/total
-    train_loss /= len(trainloader)
+    train_loss /= num_batches
+    if aug_cache is not None:
+        print(aug_cache.describe_rates())
+    if selective:
+        for selected_inputs, selected_targets in selector.flush():
+            train_step(selected_inputs, selected_targets)
+        print("selective backprop: skipped %.1f%% of backward passes" % (100.0 * selector.backward_saved()))
 
     train_loss_trend.append(train_loss)
     train_acc_trend.append(train_accuracy)
 
-    # Save training checkpoint after each epoch
+    # Save training checkpoint after each epoch (valid() saves the delta record instead)
+    if not is_main_process() or delta_store is not None:
+        return True
     if not os.path.isdir('checkpoint'):
         os.mkdir('checkpoint')
     torch.save({
@@ -175,34 +399,35 @@ def train(epoch):
         'scheduler': scheduler.state_dict(),
         'best_acc': best_acc,
     }, './checkpoint/ckpt_epoch{}.pth'.format(epoch))
+    return True
 
 
 # validation set testing 
 def valid(epoch):
     global best_acc
     net.eval()
-    test_loss = 0
-    correct = 0
-    total = 0
+    # accumulated on the device, no host sync until the end of the pass
+    metrics = EvalMetrics(num_classes=len(classes), device=device)
     with torch.no_grad():
         for batch_idx, (inputs, targets) in enumerate(validloader):
             inputs, targets = inputs.to(device), targets.to(device)
-            outputs = net(inputs)
-            loss = criterion(outputs, targets)
-            test_loss += loss.item()
-            _, predicted = outputs.max(1)
-            total += targets.size(0)
-            correct += predicted.eq(targets).sum().item()
-            progress_bar(batch_idx, len(validloader), 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
-                         % (test_loss/(batch_idx+1), 100.*correct/total, correct, total))
-
-    valid_accuracy = 100.0 * correct / total
-    test_loss /= len(validloader)
+            with autocast_context(device, args.precision):
+                outputs = net(inputs)
+                loss = criterion(outputs, targets)
+            metrics.update(outputs, targets, loss)
+            progress_bar(batch_idx, len(validloader))
+
+    # one reduction over all ranks; the DistributedSampler pads the last shard, so a few
+    # samples may be counted twice. No validation set (e.g. the 60k/0 setup) reports zeros
+    results = metrics.compute()
+    print(describe_metrics(results, classes))
+    valid_accuracy = results['acc']
+    test_loss = results['loss']
     valid_loss_trend.append(test_loss)
     valid_acc_trend.append(valid_accuracy)
 
     # Save checkpoint.
-    acc = 100.*correct/total
+    acc = valid_accuracy
     if acc > best_acc:
         print('Saving..')
         state = {
@@ -224,29 +449,16 @@ def valid(epoch):
         'valid_acc_trend': valid_acc_trend,
     }
 
+    if not is_main_process():
+        return
     if not os.path.isdir('checkpoint'):
         os.mkdir('checkpoint')
         torch.save(state, './checkpoint/ckpt.pth')
-    torch.save(checkpoint, f'./checkpoint/ckpt{epoch}.pth')
+    if delta_store is not None:
+        delta_store.save(epoch, checkpoint)
+    else:
+        torch.save(checkpoint, f'./checkpoint/ckpt{epoch}.pth')
 
-# Help to test on the provided test data      
-def generate_predictions(model, test_loader):
-    model.eval()  
-    predictions = []
-    with torch.no_grad():
-        for batch in test_loader:
-            images, _ = batch 
-            images = images.to(device)
-            outputs = model(images)
-            _, preds = torch.max(outputs, dim=1)
-            predictions.extend(preds.cpu().numpy())  
-    return predictions
-
-# functions to save the predictions to desirable output
-def save_predictions_to_csv(predictions, test_ids, csv_filename="predictions.csv"):
-    df = pd.DataFrame({"ID": test_ids, "Labels": predictions})
-    df.to_csv(csv_filename, index=False)
-    print(f"Predictions saved to {csv_filename}")
 
 
 
@@ -260,9 +472,20 @@ epochs = 200
 max_lr = 0.01
 grad_clip = 0
 criterion = nn.CrossEntropyLoss()
-optimizer = optim.SGD(net.parameters(), lr=args.lr,
-                      momentum=0.9, weight_decay=5e-4)
-scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=200)
+# the global batch is batch_size * world_size under torchrun, scale the lr with it
+lr = args.lr if args.no_lr_scaling else scale_lr(args.lr, world_size)
+if batch_size != 128 and not args.no_lr_scaling:
+    # --lr is meant for batch size 128, scale it linearly with the per-process batch size
+    lr = lr * batch_size / 128
+    print(f"lr scaled to {lr:.4f} for batch size {batch_size}")
+if args.optimizer == 'sgd':
+    optimizer = optim.SGD(net.parameters(), lr=lr,
+                          momentum=0.9, weight_decay=5e-4)
+else:
+    # large-batch recipe: layer-wise adaptive lr, no weight decay on BatchNorm / bias
+    optimizer = build_optimizer(net, args.optimizer, lr, weight_decay=5e-4)
+scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=200 - args.warmup_epochs)
+scheduler = with_warmup(optimizer, scheduler, args.warmup_epochs)
 
 """
 TODO
@@ -290,280 +513,155 @@ train_loss_trend = []
 train_acc_trend = []
 valid_loss_trend = []
 valid_acc_trend = []
-lr_trend = []
+
+# on preemptible capacity: a signal only sets a flag, train() snapshots after the current step.
+# A snapshot left by a preempted run takes precedence over the epoch checkpoints
+preemption = None
+resume = None
+resume_epoch = 0
+if args.preemptible:
+    preemption = PreemptionHandler()
+    resume = load_snapshot(snapshot_path(checkpoint_dir, rank), map_location=device)
+    if resume is not None and (resume['batch_size'], resume['world_size']) != (batch_size, world_size):
+        raise SystemExit(f"the preemption snapshot was taken with batch size {resume['batch_size']} on "
+                         f"{resume['world_size']} processes, resume with the same (now {batch_size} on {world_size})")
+    if resume is not None:
+        net.load_state_dict(resume['net'])
+        optimizer.load_state_dict(resume['optimizer'])
+        scheduler.load_state_dict(resume['scheduler'])
+        best_acc = resume['best_acc']
+        start_epoch = resume['start_epoch']
+        resume_epoch = resume['epoch']
+        train_loss_trend = resume['train_loss_trend']
+        valid_loss_trend = resume['valid_loss_trend']
+        train_acc_trend = resume['train_acc_trend']
+        valid_acc_trend = resume['valid_acc_trend']
+        print(f"==> Resuming epoch {resume_epoch} at batch {resume['batch_idx']} from the preemption snapshot")
+
+# per-epoch metrics and per-step lr go to disk, plots are rendered in a background process.
+# Only rank 0 writes metrics, plots and predictions.
+metrics_sink = None
+eval_scheduler = None
+if is_main_process():
+    metrics_sink = MetricsSink('./metrics/', paras_for_graph, reset=(start_epoch == 0 and resume is None))
+
+# milestone predictions run on a snapshot of the weights in a worker process, so the test set
+# is handed over as CPU tensors
+eval_policies = [AtEpochs(args.eval_epochs)]
+if args.eval_every:
+    eval_policies.append(EveryKEpochs(args.eval_every))
+if args.eval_on_improvement:
+    eval_policies.append(OnImprovement())
+good_policy = AboveThreshold(99, tag='Good')
+eval_policies.append(good_policy)
+eval_test_dataset = CustomTensorDataset(tensors=(test_images_tensor.cpu(), test_labels_tensor.cpu()),
+                                        transform=get_transform("test"))
+if is_main_process():
+    eval_scheduler = EvalScheduler(eval_policies, model_fn, eval_test_dataset, batch_size=test_batch_size)
+
+# queryable record of the run, see run_store.py
+run_store = None
+if args.run_store and is_main_process():
+    run_store = RunStore(args.run_store)
+    run_store.start_run(dict(vars(args), model=getattr(model_fn, '__name__', str(model_fn)), lr=lr,
+                             batch_size=batch_size, epochs=epochs, world_size=world_size,
+                             start_epoch=start_epoch, resume_epoch=resume_epoch,
+                             paras_for_graph=paras_for_graph), name=args.run_name)
+    print(f"recording run {run_store.run_id} in {args.run_store}")
+
+# epochs where only the progress is printed and plotted
+progress_epochs = [2]
+
+# collect good epochs
+good_epochs = []
+
+# progressive resizing: the train transform (and the loader, whose workers are persistent) is
+# rebuilt whenever the image size changes
+prog_schedule = None
+train_size = 32
+if args.progressive:
+    prog_schedule = ProgressiveSchedule(args.prog_start_size, 32, ramp_start=args.prog_ramp[0], ramp_end=args.prog_ramp[1])
+    print("progressive resizing, relative training FLOPs: %.2f"
+          % prog_schedule.relative_cost(range(start_epoch+1, start_epoch+200)))
 
     
 # Training
-for epoch in range(start_epoch+1, start_epoch+200):
-    train(epoch)
+preempted = False
+for epoch in range(max(start_epoch+1, resume_epoch), start_epoch+200):
+    if prog_schedule is not None and prog_schedule.size_at(epoch) != train_size:
+        train_size = prog_schedule.size_at(epoch)
+        print(f"training at {train_size}x{train_size}")
+        train_dataset.transform = get_transform("train", train_size)
+        trainloader = make_loader(train_dataset, batch_size, shuffle=True, resumable=args.preemptible,
+                                  **loader_kwargs(thread_config, pin=not args.no_pin))
+    # a signal during the last validation pass, snapshot at the start of the epoch
+    if preemption is not None and preemption.should_stop(device):
+        save_preemption_snapshot(epoch, 0)
+        preempted = True
+        break
+    epoch_start = time.time()
+    if not train(epoch, resume if epoch == resume_epoch else None):
+        preempted = True
+        break
+    train_time = time.time() - epoch_start
     valid(epoch)
+    if preemption is not None:
+        clear_snapshot(snapshot_path(checkpoint_dir, rank))
+    epoch_time = time.time() - epoch_start
+    epoch_lr = get_lrs(optimizer)
     scheduler.step()
-
-    # create a list to collect good epochs 
-    good_epochs = []
-    n = 1
-
-    # keep track of the high validation acc
-    if valid_acc_trend[-1] >= 99:
+    if not is_main_process():
+        continue
+    metrics_sink.log_epoch(epoch, train_loss_trend[-1], train_acc_trend[-1],
+                           valid_loss_trend[-1], valid_acc_trend[-1], epoch_lr)
+
+    # write test predictions for every policy that fires, in a background process
+    fired = eval_scheduler.step(net, epoch, valid_acc_trend[-1])
+    if run_store is not None:
+        run_store.log_epoch(epoch, train_loss=train_loss_trend[-1], train_acc=train_acc_trend[-1],
+                            valid_loss=valid_loss_trend[-1], valid_acc=valid_acc_trend[-1], lr=epoch_lr,
+                            epoch_time=epoch_time, train_time=train_time, valid_time=epoch_time - train_time)
+        run_store.log_artifact('checkpoint', os.path.join(checkpoint_dir, 'delta') if delta_store is not None
+                               else f'./checkpoint/ckpt{epoch}.pth', epoch)
+        for policy in fired:
+            run_store.log_artifact('predictions', f"{eval_scheduler.out_dir}/predictions{policy.tag}{epoch}.csv", epoch)
+    if any(policy is good_policy for policy in fired):
         good_epochs.append(epoch)
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename=f"predictionsGood{n}.csv")
-        n += 1
         print("valid_acc is larger than 0.99")
 
-    # Check progress here to check if plots look good 
-    if epoch == 2:
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
     # Check progress of all the milestones, so if there is a clear overfit, we can save the good outputs before overfit
-    if epoch == 10:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions10.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 20:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions20.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 25:
-        print(epoch)
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions25.csv")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 50:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions50.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 60:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions60.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 70:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions70.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend,epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 80:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions80.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 90:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions90.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 100:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions100.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 110:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions110.csv")
+    if fired or epoch in progress_epochs:
         print("checking progress")
         print(train_acc_trend)
         print(train_loss_trend)
         print(valid_acc_trend)
         print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 120:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions120.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    
-    if epoch == 130:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions130.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 140:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions140.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 150:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions150.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 160:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions160.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 170:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions170.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 180:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions180.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 190:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions190.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-    if epoch == 200:
-        predictions = generate_predictions(net, testloader)
-        save_predictions_to_csv(predictions, list(range(len(predictions))), csv_filename="predictions200.csv")
-        print("checking progress")
-        print(train_acc_trend)
-        print(train_loss_trend)
-        print(valid_acc_trend)
-        print(valid_loss_trend)
-        print("over")
-        plot_losses(train_loss_trend, valid_loss_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_acc(train_acc_trend, valid_acc_trend, epoch = epoch, hyperparam = paras_for_graph)
-        plot_lr(lr_trend, epoch = epoch, hyperparam = paras_for_graph)
-
-# For analyzing where things could start to overfit
-print(good_epochs)
\ No newline at end of file
+        metrics_sink.request_plots(epoch)
+
+# FixRes: adapt BatchNorm statistics and the classifier to the 32px test-time preprocessing
+if args.fixres_epochs > 0 and not preempted:
+    train_dataset.transform = get_transform("fixres")
+    # fixres_finetune unpacks (inputs, targets)
+    train_dataset.return_index = False
+    trainloader = make_loader(train_dataset, batch_size, shuffle=True, **loader_kwargs(thread_config, pin=not args.no_pin))
+    set_epoch(trainloader, epoch + 1)
+    fixres_finetune(net, trainloader, args.fixres_epochs, args.fixres_lr, criterion, device, args.precision)
+    valid(epoch + 1)
+    if is_main_process():
+        print("valid acc after fixres fine-tune: %.3f%%" % valid_acc_trend[-1])
+        eval_scheduler.submit(net, epoch + 1, ['FixRes'])
+        if run_store is not None:
+            run_store.log_epoch(epoch + 1, valid_loss=valid_loss_trend[-1], valid_acc=valid_acc_trend[-1])
+            run_store.log_artifact('predictions', f"{eval_scheduler.out_dir}/predictionsFixRes{epoch + 1}.csv", epoch + 1)
+
+if aug_cache is not None:
+    aug_cache.close()
+if is_main_process():
+    eval_scheduler.close()
+    metrics_sink.close()
+    if run_store is not None:
+        run_store.finish('preempted' if preempted else 'finished')
+
+    # For analyzing where things could start to overfit
+    print(good_epochs)
+cleanup()
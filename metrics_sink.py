@@ -0,0 +1,149 @@
+"""
+Metrics sink for the training scripts.
+
+Every epoch a row is appended to a small CSV log (metrics.csv) and the per-step
+learning rates are appended to a flat float32 file (lr_steps.f32). Plots are
+rendered from those files by a background process, so the training loop only
+pays for a couple of small file writes per epoch and never waits on matplotlib.
+"""
+
+import os
+import csv
+import multiprocessing as mp
+
+import numpy as np
+
+from utils import plot_losses, plot_acc, plot_lr
+
+EPOCH_FIELDS = ['epoch', 'steps', 'train_loss', 'train_acc', 'valid_loss', 'valid_acc', 'lr']
+
+
+# reduce a long series to at most max_points, keeping the min and max of every bucket
+# so spikes (warmup, restarts) still show up in the plot
+def downsample(values, max_points=2000):
+    values = np.asarray(values, dtype=np.float32)
+    steps = np.arange(len(values))
+    if len(values) <= max_points:
+        return steps, values
+
+    n_buckets = max(max_points // 2, 1)
+    edges = np.linspace(0, len(values), n_buckets + 1).astype(np.int64)
+    keep = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end <= start:
+            continue
+        bucket = values[start:end]
+        keep.append(start + int(bucket.argmin()))
+        keep.append(start + int(bucket.argmax()))
+    keep = np.unique(np.asarray(keep))
+    return steps[keep], values[keep]
+
+
+# read the per-epoch log back as a dict of columns
+def read_epoch_log(path, max_epoch=None):
+    columns = {field: [] for field in EPOCH_FIELDS}
+    if not os.path.exists(path):
+        return columns
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            if max_epoch is not None and int(row['epoch']) > max_epoch:
+                continue
+            for field in EPOCH_FIELDS:
+                value = row[field]
+                columns[field].append(int(value) if field in ('epoch', 'steps') else float(value))
+    return columns
+
+
+# read the per-step learning rates, optionally only the first num_steps
+def read_step_log(path, num_steps=None):
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=np.float32)
+    lrs = np.fromfile(path, dtype=np.float32)
+    if num_steps is not None:
+        lrs = lrs[:num_steps]
+    return lrs
+
+
+def render_plots(epoch_path, step_path, epoch, hyperparam, max_points=2000):
+    log = read_epoch_log(epoch_path, max_epoch=epoch)
+    plot_losses(log['train_loss'], log['valid_loss'], epoch=epoch, hyperparam=hyperparam)
+    plot_acc(log['train_acc'], log['valid_acc'], epoch=epoch, hyperparam=hyperparam)
+    num_steps = log['steps'][-1] if log['steps'] else None
+    steps, lrs = downsample(read_step_log(step_path, num_steps), max_points)
+    plot_lr(lrs, epoch=epoch, hyperparam=hyperparam, steps=steps)
+
+
+def _plot_worker(queue, epoch_path, step_path, hyperparam, max_points):
+    while True:
+        epoch = queue.get()
+        if epoch is None:
+            break
+        try:
+            render_plots(epoch_path, step_path, epoch, hyperparam, max_points)
+        except Exception as e:
+            # a broken plot must never take the training run down with it
+            print(f"plotting for epoch {epoch} failed: {e}")
+
+
+class MetricsSink:
+    def __init__(self, log_dir, hyperparam, max_points=2000, reset=False, background=True):
+        os.makedirs(log_dir, exist_ok=True)
+        self.epoch_path = os.path.join(log_dir, 'metrics.csv')
+        self.step_path = os.path.join(log_dir, 'lr_steps.f32')
+        self.hyperparam = list(hyperparam)
+        self.max_points = max_points
+
+        if reset:
+            for path in (self.epoch_path, self.step_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        previous = read_epoch_log(self.epoch_path)
+        self.num_steps = previous['steps'][-1] if previous['steps'] else 0
+        self._step_buffer = []
+
+        write_header = not os.path.exists(self.epoch_path)
+        self._epoch_file = open(self.epoch_path, 'a', newline='')
+        self._writer = csv.writer(self._epoch_file)
+        if write_header:
+            self._writer.writerow(EPOCH_FIELDS)
+            self._epoch_file.flush()
+
+        # fork (not spawn) so the child does not re-run the training script on import
+        self._queue = None
+        self._plotter = None
+        if background:
+            ctx = mp.get_context('fork')
+            self._queue = ctx.Queue()
+            self._plotter = ctx.Process(target=_plot_worker, daemon=True,
+                                        args=(self._queue, self.epoch_path, self.step_path,
+                                              self.hyperparam, max_points))
+            self._plotter.start()
+
+    # called once per optimizer step, only buffers in memory
+    def log_step(self, lr):
+        self._step_buffer.append(lr)
+
+    # called once per epoch, appends one CSV row and the buffered learning rates
+    def log_epoch(self, epoch, train_loss, train_acc, valid_loss, valid_acc, lr):
+        if self._step_buffer:
+            with open(self.step_path, 'ab') as f:
+                np.asarray(self._step_buffer, dtype=np.float32).tofile(f)
+            self.num_steps += len(self._step_buffer)
+            self._step_buffer = []
+        self._writer.writerow([epoch, self.num_steps, train_loss, train_acc, valid_loss, valid_acc, lr])
+        self._epoch_file.flush()
+
+    # queue the loss/acc/lr plots for an epoch that has already been logged
+    def request_plots(self, epoch):
+        if self._queue is not None:
+            self._queue.put(epoch)
+        else:
+            render_plots(self.epoch_path, self.step_path, epoch, self.hyperparam, self.max_points)
+
+    def close(self):
+        if self._plotter is not None:
+            self._queue.put(None)
+            self._plotter.join()
+            self._plotter = None
+        self._epoch_file.close()
@@ -0,0 +1,66 @@
+"""
+Parameters, MACs and measured CPU latency of the models in models/resnet.py, to pick a model
+on the accuracy / latency curve rather than by parameter count.
+
+    python model_report.py --models ResNet5M ResNet5M2Layers MobileNetTiny MobileNetSmall MobileNetBase --threads 4
+
+With --checkpoints (same order as --models) the validation accuracy is added.
+"""
+
+import argparse
+
+import torch
+from torch.utils.data import DataLoader
+
+from models.resnet import get_model, MODELS
+from customTensorDataset import get_transform, load_cifar_train
+from splits import stratified_split, make_split_datasets
+from utils import count_params, count_macs, measure_latency, load_checkpoint_weights, evaluate_accuracy
+
+
+def report(model_name, batch_sizes=(1, 64), checkpoint=None, validloader=None):
+    net = get_model(model_name)
+    if checkpoint:
+        net = load_checkpoint_weights(net, checkpoint)
+    row = {
+        'model': model_name,
+        'params': count_params(net),
+        'macs': count_macs(net),
+    }
+    for batch_size in batch_sizes:
+        row[f'bs{batch_size} ms'] = measure_latency(net, batch_size, 'cpu')
+    if checkpoint and validloader is not None:
+        row['acc'] = evaluate_accuracy(net, validloader, 'cpu')
+    return row
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Params / MACs / CPU latency report')
+    parser.add_argument('--models', nargs='+', default=list(MODELS))
+    parser.add_argument('--checkpoints', nargs='*', default=None)
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 64])
+    parser.add_argument('--threads', default=None, type=int)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    validloader = None
+    if args.checkpoints:
+        assert len(args.checkpoints) == len(args.models), "one checkpoint per model"
+        images, labels = load_cifar_train()
+        tensors = (torch.Tensor(images), torch.from_numpy(labels))
+        train_idx, valid_idx = stratified_split(labels, valid_size=0.1, seed=42)
+        _, valid_dataset = make_split_datasets(tensors, train_idx, valid_idx, None, get_transform("valid"))
+        validloader = DataLoader(valid_dataset, batch_size=400, shuffle=False)
+
+    print(f"cpu threads: {torch.get_num_threads()}")
+    header = f"{'model':<22}{'params M':>10}{'MMACs':>10}" + ''.join(f"{f'bs{bs} ms':>12}" for bs in args.batch_sizes)
+    print(header + (f"{'acc %':>8}" if validloader is not None else ''))
+    for i, model_name in enumerate(args.models):
+        checkpoint = args.checkpoints[i] if args.checkpoints else None
+        row = report(model_name, args.batch_sizes, checkpoint, validloader)
+        line = f"{model_name:<22}{row['params'] / 1e6:>10.2f}{row['macs'] / 1e6:>10.1f}"
+        line += ''.join(f"{row[f'bs{bs} ms']:>12.2f}" for bs in args.batch_sizes)
+        if 'acc' in row:
+            line += f"{row['acc']:>8.2f}"
+        print(line)
@@ -6,9 +6,12 @@ The ResNet2_Modified and Conv_block combined together would generate a 2 layer R
 In terms of Kaggle competition results, ResNet5M has the highest accuracy 84.7%, ResNet5MWithDropout has 84.5%, and ResNet2_Modified and ResNet2Layers have around 80%.
 """
 
+import contextlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 class BasicBlock(nn.Module):
     expansion = 1
@@ -69,19 +72,62 @@ class Bottleneck(nn.Module):
         return out
 
 
+# the recompute during backward runs the block in train mode again, keep its BatchNorm
+# running stats as they were so every step updates them once, like without checkpointing
+@contextlib.contextmanager
+def _frozen_bn_stats(module):
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in bns]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, (mean, var, count) in zip(bns, saved):
+                m.running_mean.copy_(mean)
+                m.running_var.copy_(var)
+                m.num_batches_tracked.copy_(count)
+
+
+# a stage of residual blocks where every checkpoint_every-th block (0 = none, 1 = all) drops its
+# activations after the forward pass and recomputes them during backward, trading compute for memory.
+# Subclassing nn.Sequential keeps the state_dict keys of existing checkpoints.
+class CheckpointedStage(nn.Sequential):
+    def __init__(self, *blocks, checkpoint_every=0):
+        super(CheckpointedStage, self).__init__(*blocks)
+        self.checkpoint_every = checkpoint_every
+
+    def forward(self, x):
+        for i, block in enumerate(self):
+            if self.checkpoint_every and self.training and torch.is_grad_enabled() and i % self.checkpoint_every == 0:
+                x = checkpoint(block, x, use_reentrant=False,
+                               context_fn=lambda block=block: (contextlib.nullcontext(), _frozen_bn_stats(block)))
+            else:
+                x = block(x)
+        return x
+
+
+# switch activation checkpointing for all stages of a model: 0 = none, N = every N-th block, 1 = all
+def set_activation_checkpointing(model, checkpoint_every):
+    for module in model.modules():
+        if isinstance(module, CheckpointedStage):
+            module.checkpoint_every = checkpoint_every
+    return model
+
+
 class ResNetWithDropout(nn.Module):
-    def __init__(self, block, num_blocks, num_classes=10, dropout_prob = 0.1):
+    def __init__(self, block, num_blocks, num_classes=10, dropout_prob = 0.1, widths=(42, 85, 171, 342)):
         super(ResNetWithDropout, self).__init__()
         self.in_planes = 64
+        self.widths = tuple(widths)
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3,
                                stride=1, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(64)
-        self.layer1 = self._make_layer(block, 42, num_blocks[0], stride=1)
-        self.layer2 = self._make_layer(block, 85, num_blocks[1], stride=2)
-        self.layer3 = self._make_layer(block, 171, num_blocks[2], stride=2)
-        self.layer4 = self._make_layer(block, 342, num_blocks[3], stride=2)
-        self.linear = nn.Linear(342*block.expansion, num_classes)
+        self.layer1 = self._make_layer(block, widths[0], num_blocks[0], stride=1)
+        self.layer2 = self._make_layer(block, widths[1], num_blocks[1], stride=2)
+        self.layer3 = self._make_layer(block, widths[2], num_blocks[2], stride=2)
+        self.layer4 = self._make_layer(block, widths[3], num_blocks[3], stride=2)
+        self.linear = nn.Linear(widths[3]*block.expansion, num_classes)
         self.dropout = nn.Dropout(dropout_prob)
 
     def _make_layer(self, block, planes, num_blocks, stride):
@@ -98,7 +144,7 @@ class ResNetWithDropout(nn.Module):
         out = self.layer2(out)
         out = self.layer3(out)
         out = self.layer4(out)
-        out = F.avg_pool2d(out, 4)
+        out = F.adaptive_avg_pool2d(out, 1)
         out = out.view(out.size(0), -1)
         out = self.dropout(out)
         out = self.linear(out)
@@ -116,7 +162,7 @@ class ResNet2_Modified(nn.Module):
         self.conv4 = conv_block(256, 512, pool=True)
         self.res2 = nn.Sequential(conv_block(512, 512), conv_block(512, 512))
         
-        self.classifier = nn.Sequential(nn.MaxPool2d(4), 
+        self.classifier = nn.Sequential(nn.AdaptiveMaxPool2d(1), 
                                         nn.Flatten(), 
                                         nn.Linear(512, num_classes))
         
@@ -141,16 +187,17 @@ def conv_block(in_channels, out_channels, pool=False):
 # the end 
 
 class ResNet2(nn.Module):
-    def __init__(self, block, num_blocks, num_classes=10):
+    def __init__(self, block, num_blocks, num_classes=10, widths=(128, 256)):
         super(ResNet2, self).__init__()
         self.in_planes = 64
+        self.widths = tuple(widths)
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3,
                                stride=1, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(64)
-        self.layer1 = self._make_layer(block, 128, num_blocks[0], stride=1)
-        self.layer2 = self._make_layer(block, 256, num_blocks[1], stride=2)
-        self.linear = nn.Linear(256*4, num_classes)  
+        self.layer1 = self._make_layer(block, widths[0], num_blocks[0], stride=1)
+        self.layer2 = self._make_layer(block, widths[1], num_blocks[1], stride=2)
+        self.linear = nn.Linear(widths[1]*block.expansion*4, num_classes)  
 
     def _make_layer(self, block, planes, num_blocks, stride):
         strides = [stride] + [1]*(num_blocks-1)
@@ -164,24 +211,26 @@ class ResNet2(nn.Module):
         out = F.relu(self.bn1(self.conv1(x)))
         out = self.layer1(out)
         out = self.layer2(out)
-        out = F.avg_pool2d(out, 8)
+        out = F.adaptive_avg_pool2d(out, 2)
         out = out.view(out.size(0), -1)
         out = self.linear(out)
         return out
  
 class ResNet(nn.Module):
-    def __init__(self, block, num_blocks, num_classes=10):
+    def __init__(self, block, num_blocks, num_classes=10, checkpoint_every=0, widths=(42, 85, 171, 342)):
         super(ResNet, self).__init__()
         self.in_planes = 64
+        self.checkpoint_every = checkpoint_every
+        self.widths = tuple(widths)
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3,
                                stride=1, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(64)
-        self.layer1 = self._make_layer(block, 42, num_blocks[0], stride=1)
-        self.layer2 = self._make_layer(block, 85, num_blocks[1], stride=2)
-        self.layer3 = self._make_layer(block, 171, num_blocks[2], stride=2)
-        self.layer4 = self._make_layer(block, 342, num_blocks[3], stride=2)
-        self.linear = nn.Linear(342*block.expansion, num_classes)
+        self.layer1 = self._make_layer(block, widths[0], num_blocks[0], stride=1)
+        self.layer2 = self._make_layer(block, widths[1], num_blocks[1], stride=2)
+        self.layer3 = self._make_layer(block, widths[2], num_blocks[2], stride=2)
+        self.layer4 = self._make_layer(block, widths[3], num_blocks[3], stride=2)
+        self.linear = nn.Linear(widths[3]*block.expansion, num_classes)
 
     def _make_layer(self, block, planes, num_blocks, stride):
         strides = [stride] + [1]*(num_blocks-1)
@@ -189,7 +238,7 @@ class ResNet(nn.Module):
         for stride in strides:
             layers.append(block(self.in_planes, planes, stride))
             self.in_planes = planes * block.expansion
-        return nn.Sequential(*layers)
+        return CheckpointedStage(*layers, checkpoint_every=self.checkpoint_every)
 
     def forward(self, x):
         out = F.relu(self.bn1(self.conv1(x)))
@@ -197,24 +246,27 @@ class ResNet(nn.Module):
         out = self.layer2(out)
         out = self.layer3(out)
         out = self.layer4(out)
-        out = F.avg_pool2d(out, 4)
+        # same as avg_pool2d(out, 4) at 32x32, and still a 1x1 map for the smaller progressive-resizing inputs
+        out = F.adaptive_avg_pool2d(out, 1)
         out = out.view(out.size(0), -1)
         out = self.linear(out)
         return out
 
 class ResNet5M34(nn.Module):
-    def __init__(self, block, num_blocks, num_classes=10):
+    def __init__(self, block, num_blocks, num_classes=10, checkpoint_every=0, widths=(35, 70, 125, 235)):
         super(ResNet5M34, self).__init__()
         self.in_planes = 64
+        self.checkpoint_every = checkpoint_every
+        self.widths = tuple(widths)
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3,
                                stride=1, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(64)
-        self.layer1 = self._make_layer(block, 35, num_blocks[0], stride=1)
-        self.layer2 = self._make_layer(block, 70, num_blocks[1], stride=2)
-        self.layer3 = self._make_layer(block, 125, num_blocks[2], stride=2)
-        self.layer4 = self._make_layer(block, 235, num_blocks[3], stride=2)
-        self.linear = nn.Linear(235*block.expansion, num_classes)
+        self.layer1 = self._make_layer(block, widths[0], num_blocks[0], stride=1)
+        self.layer2 = self._make_layer(block, widths[1], num_blocks[1], stride=2)
+        self.layer3 = self._make_layer(block, widths[2], num_blocks[2], stride=2)
+        self.layer4 = self._make_layer(block, widths[3], num_blocks[3], stride=2)
+        self.linear = nn.Linear(widths[3]*block.expansion, num_classes)
 
     def _make_layer(self, block, planes, num_blocks, stride):
         strides = [stride] + [1]*(num_blocks-1)
@@ -222,7 +274,7 @@ class ResNet5M34(nn.Module):
         for stride in strides:
             layers.append(block(self.in_planes, planes, stride))
             self.in_planes = planes * block.expansion
-        return nn.Sequential(*layers)
+        return CheckpointedStage(*layers, checkpoint_every=self.checkpoint_every)
 
     def forward(self, x):
         out = F.relu(self.bn1(self.conv1(x)))
@@ -230,7 +282,62 @@ class ResNet5M34(nn.Module):
         out = self.layer2(out)
         out = self.layer3(out)
         out = self.layer4(out)
-        out = F.avg_pool2d(out, 4)
+        out = F.adaptive_avg_pool2d(out, 1)
+        out = out.view(out.size(0), -1)
+        out = self.linear(out)
+        return out
+
+
+# MobileNetV2 inverted residual: 1x1 expand, 3x3 depthwise, 1x1 linear projection.
+# Almost all the MACs are in the two 1x1 convs, the depthwise conv is cheap on CPU.
+class InvertedResidual(nn.Module):
+    def __init__(self, in_planes, out_planes, stride=1, expansion=6):
+        super(InvertedResidual, self).__init__()
+        hidden = in_planes * expansion
+        self.use_residual = stride == 1 and in_planes == out_planes
+        self.conv1 = nn.Conv2d(in_planes, hidden, kernel_size=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(hidden)
+        self.conv2 = nn.Conv2d(hidden, hidden, kernel_size=3, stride=stride,
+                               padding=1, groups=hidden, bias=False)
+        self.bn2 = nn.BatchNorm2d(hidden)
+        self.conv3 = nn.Conv2d(hidden, out_planes, kernel_size=1, bias=False)
+        self.bn3 = nn.BatchNorm2d(out_planes)
+
+    def forward(self, x):
+        out = F.relu6(self.bn1(self.conv1(x)))
+        out = F.relu6(self.bn2(self.conv2(out)))
+        out = self.bn3(self.conv3(out))
+        if self.use_residual:
+            out = out + x
+        return out
+
+# CIFAR MobileNetV2-style network, stage widths / depths / strides are parameters.
+# The stem keeps stride 1 so the 32x32 input is only downsampled inside the stages.
+class MobileNetCIFAR(nn.Module):
+    def __init__(self, widths=(24, 40, 80, 160), depths=(2, 3, 3, 2), strides=(1, 2, 2, 2),
+                 expansion=6, stem_width=32, head_width=640, num_classes=10):
+        super(MobileNetCIFAR, self).__init__()
+        self.widths = tuple(widths)
+        self.conv1 = nn.Conv2d(3, stem_width, kernel_size=3, stride=1, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(stem_width)
+        in_planes = stem_width
+        stages = []
+        for width, depth, stride in zip(widths, depths, strides):
+            blocks = []
+            for i in range(depth):
+                blocks.append(InvertedResidual(in_planes, width, stride if i == 0 else 1, expansion))
+                in_planes = width
+            stages.append(nn.Sequential(*blocks))
+        self.stages = nn.Sequential(*stages)
+        self.conv2 = nn.Conv2d(in_planes, head_width, kernel_size=1, bias=False)
+        self.bn2 = nn.BatchNorm2d(head_width)
+        self.linear = nn.Linear(head_width, num_classes)
+
+    def forward(self, x):
+        out = F.relu6(self.bn1(self.conv1(x)))
+        out = self.stages(out)
+        out = F.relu6(self.bn2(self.conv2(out)))
+        out = F.adaptive_avg_pool2d(out, 1)
         out = out.view(out.size(0), -1)
         out = self.linear(out)
         return out
@@ -255,20 +362,54 @@ def ResNet5M2Layers():
 def ResNet18():
     return ResNet(BasicBlock, [2, 2, 2, 2])
 
-def ResNet34():
-    return ResNet5M34(BasicBlock, [3, 4, 6, 3])
+def ResNet34(checkpoint_every=0):
+    return ResNet5M34(BasicBlock, [3, 4, 6, 3], checkpoint_every=checkpoint_every)
+
+
+def ResNet50(checkpoint_every=0):
+    return ResNet(Bottleneck, [3, 4, 6, 3], checkpoint_every=checkpoint_every)
+
+
+def ResNet101(checkpoint_every=0):
+    return ResNet(Bottleneck, [3, 4, 23, 3], checkpoint_every=checkpoint_every)
+
+
+def ResNet152(checkpoint_every=0):
+    return ResNet(Bottleneck, [3, 8, 36, 3], checkpoint_every=checkpoint_every)
+
+
+# latency-oriented family, roughly 0.11M / 0.83M / 2.2M parameters
+def MobileNetTiny():
+    return MobileNetCIFAR(widths=(16, 24, 48, 96), depths=(1, 2, 2, 1), expansion=4, stem_width=16, head_width=384)
 
+def MobileNetSmall():
+    return MobileNetCIFAR(widths=(24, 40, 80, 160), depths=(2, 3, 3, 2))
 
-def ResNet50():
-    return ResNet(Bottleneck, [3, 4, 6, 3])
+def MobileNetBase():
+    return MobileNetCIFAR(widths=(32, 64, 128, 256), depths=(2, 3, 4, 2), head_width=1024)
 
 
-def ResNet101():
-    return ResNet(Bottleneck, [3, 4, 23, 3])
+# constructors by name, for the command line tools
+MODELS = {
+    'ResNet5M': ResNet5M,
+    'ResNet5MWithDropout': ResNet5MWithDropout,
+    'ResNet5M2Layers': ResNet5M2Layers,
+    'ResNet2_Modified': lambda: ResNet2_Modified(in_channels=3, num_classes=10),
+    'ResNet18': ResNet18,
+    'ResNet34': ResNet34,
+    'ResNet50': ResNet50,
+    'ResNet101': ResNet101,
+    'ResNet152': ResNet152,
+    'MobileNetTiny': MobileNetTiny,
+    'MobileNetSmall': MobileNetSmall,
+    'MobileNetBase': MobileNetBase,
+}
 
 
-def ResNet152():
-    return ResNet(Bottleneck, [3, 8, 36, 3])
+def get_model(name):
+    if name not in MODELS:
+        raise ValueError(f"unknown model {name}, choose from {', '.join(MODELS)}")
+    return MODELS[name]()
 
 
 def test():
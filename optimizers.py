@@ -0,0 +1,169 @@
+"""
+Large-batch training recipe: LARS and LAMB layer-wise adaptive optimizers, parameter
+groups without weight decay on BatchNorm/bias, and a linear warmup in front of the
+existing schedulers.
+
+LARS: You et al. 2017, "Large Batch Training of Convolutional Networks".
+LAMB: You et al. 2019, "Large Batch Optimization for Deep Learning: Training BERT in 76 minutes".
+"""
+
+import torch
+import torch.optim as optim
+from torch.optim.lr_scheduler import LinearLR, SequentialLR
+
+
+# split parameters into a decayed group (conv / linear weights) and a group without
+# weight decay and without layer-wise adaptation (BatchNorm weights and all biases)
+def param_groups_weight_decay(net, weight_decay):
+    decay, no_decay = [], []
+    for name, param in net.named_parameters():
+        if not param.requires_grad:
+            continue
+        if param.ndim <= 1 or name.endswith('.bias'):
+            no_decay.append(param)
+        else:
+            decay.append(param)
+    return [
+        {'params': decay, 'weight_decay': weight_decay},
+        {'params': no_decay, 'weight_decay': 0.0, 'exclude_from_adaptation': True},
+    ]
+
+
+# lr that trains with each optimizer at batch size 128. The LARS / LAMB updates are already
+# scaled to the weight norm: a LARS step is about lr * trust_coefficient * ||w||, so its lr is
+# in the 1-20 range, a LAMB step is about lr * ||w||, so its lr is in the 1e-3 - 1e-2 range
+DEFAULT_LR = {'sgd': 0.1, 'lars': 5.0, 'lamb': 5e-3}
+LR_RANGE = {'sgd': (1e-3, 1.0), 'lars': (0.5, 50.0), 'lamb': (1e-4, 5e-2)}
+
+
+# warn about an lr far outside the range an optimizer trains with
+def check_lr(name, lr):
+    low, high = LR_RANGE[name]
+    if not low <= lr <= high:
+        print(f"warning: lr {lr:g} is outside the usual {low:g}-{high:g} range for {name}, "
+              f"the default is {DEFAULT_LR[name]:g}")
+
+
+class LARS(optim.Optimizer):
+    """SGD with momentum where every layer's update is scaled by the trust ratio
+    trust_coefficient * ||w|| / (||g|| + weight_decay * ||w||), g being the raw gradient."""
+
+    def __init__(self, params, lr=0.1, momentum=0.9, weight_decay=0.0, trust_coefficient=0.001,
+                 eps=1e-8, exclude_from_adaptation=False):
+        defaults = dict(lr=lr, momentum=momentum, weight_decay=weight_decay,
+                        trust_coefficient=trust_coefficient, eps=eps,
+                        exclude_from_adaptation=exclude_from_adaptation)
+        super(LARS, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+                if not group['exclude_from_adaptation']:
+                    param_norm = torch.norm(p)
+                    grad_norm = torch.norm(grad)
+                    trust_ratio = torch.where(
+                        (param_norm > 0) & (grad_norm > 0),
+                        group['trust_coefficient'] * param_norm
+                        / (grad_norm + group['weight_decay'] * param_norm + group['eps']),
+                        torch.ones_like(param_norm))
+                else:
+                    trust_ratio = None
+                if group['weight_decay'] != 0:
+                    grad = grad.add(p, alpha=group['weight_decay'])
+                if trust_ratio is not None:
+                    grad = grad.mul(trust_ratio)
+
+                state = self.state[p]
+                if 'momentum_buffer' not in state:
+                    state['momentum_buffer'] = torch.clone(grad).detach()
+                else:
+                    state['momentum_buffer'].mul_(group['momentum']).add_(grad)
+                p.add_(state['momentum_buffer'], alpha=-group['lr'])
+        return loss
+
+
+class LAMB(optim.Optimizer):
+    """Adam with decoupled weight decay where every layer's update is scaled by
+    ||w|| / ||adam_update||."""
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-6, weight_decay=0.0,
+                 exclude_from_adaptation=False):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay,
+                        exclude_from_adaptation=exclude_from_adaptation)
+        super(LAMB, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+                state['step'] += 1
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
+                update = (exp_avg / bias_correction1) / ((exp_avg_sq / bias_correction2).sqrt() + group['eps'])
+                if group['weight_decay'] != 0:
+                    update.add_(p, alpha=group['weight_decay'])
+
+                if not group['exclude_from_adaptation']:
+                    param_norm = torch.norm(p)
+                    update_norm = torch.norm(update)
+                    trust_ratio = torch.where(
+                        (param_norm > 0) & (update_norm > 0),
+                        param_norm / update_norm,
+                        torch.ones_like(param_norm))
+                    update.mul_(trust_ratio)
+
+                p.add_(update, alpha=-group['lr'])
+        return loss
+
+
+# build the optimizer by name, BatchNorm and bias parameters never get weight decay
+# (and are not layer-wise adapted by LARS/LAMB)
+def build_optimizer(net, name, lr, weight_decay=5e-4, momentum=0.9):
+    groups = param_groups_weight_decay(net, weight_decay)
+    if name == 'sgd':
+        for group in groups:
+            group.pop('exclude_from_adaptation', None)
+        return optim.SGD(groups, lr=lr, momentum=momentum)
+    elif name == 'lars':
+        return LARS(groups, lr=lr, momentum=momentum)
+    elif name == 'lamb':
+        return LAMB(groups, lr=lr)
+    else:
+        raise ValueError(f"unknown optimizer {name}")
+
+
+# linear warmup from lr * start_factor to lr over warmup_steps scheduler steps, then hand over
+# to the given scheduler. Steps are whatever unit the caller steps in (epochs for
+# CosineAnnealingLR in main.py), so the wrapped scheduler should be sized for the remaining steps.
+def with_warmup(optimizer, scheduler, warmup_steps, start_factor=0.01):
+    if warmup_steps <= 0:
+        return scheduler
+    warmup = LinearLR(optimizer, start_factor=start_factor, end_factor=1.0, total_iters=warmup_steps)
+    return SequentialLR(optimizer, schedulers=[warmup, scheduler], milestones=[warmup_steps])
@@ -0,0 +1,212 @@
+"""
+Persistent logit cache for repeated inference on the same images (re-exports, CSV
+regeneration, ensembles, a long-running serving process).
+
+Entries are keyed by (checkpoint hash, preprocessing hash, image hash):
+  * checkpoint hash: sha256 of the checkpoint file, or of the model's state_dict tensors
+  * preprocessing hash: sha256 of the transform's repr (torchvision lists every parameter)
+  * image hash: blake2b of the raw image bytes, shape and dtype, before preprocessing
+
+The store is a SQLite file (WAL mode, so readers in other processes are not blocked) with an
+LRU eviction down to max_mb. Every thread gets its own connection, so one PredictionCache can
+be shared by the threads of a server.
+
+    python prediction_cache.py --model ResNet5M --checkpoint checkpoint/ckpt199.pth --out predictions.csv
+"""
+
+import time
+import hashlib
+import sqlite3
+import argparse
+import threading
+
+import numpy as np
+import torch
+
+from models.resnet import get_model
+from customTensorDataset import CustomTensorDataset, get_transform, test_unpickle
+from utils import load_checkpoint_weights, save_predictions_to_csv
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS logits (
+    model_hash TEXT NOT NULL,
+    prep_hash TEXT NOT NULL,
+    image_hash TEXT NOT NULL,
+    logits BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (model_hash, prep_hash, image_hash)
+);
+CREATE INDEX IF NOT EXISTS logits_last_used ON logits (last_used);
+"""
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_state_dict(net):
+    digest = hashlib.sha256()
+    for name, tensor in net.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def hash_transform(transform):
+    return hashlib.sha256(repr(transform).encode()).hexdigest()
+
+
+def hash_image(image):
+    array = image.detach().cpu().numpy() if isinstance(image, torch.Tensor) else np.asarray(image)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{array.dtype}{array.shape}".encode())
+    digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    def __init__(self, path='./prediction_cache.sqlite', max_mb=512):
+        self.path = path
+        self.max_bytes = int(max_mb * 2**20)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    # cached logits for the image hashes that are present, as {image_hash: np.ndarray}
+    def get_many(self, model_hash, prep_hash, image_hashes, chunk=500):
+        conn = self._conn()
+        found = {}
+        for i in range(0, len(image_hashes), chunk):
+            part = image_hashes[i:i + chunk]
+            rows = conn.execute(
+                f"SELECT image_hash, logits FROM logits WHERE model_hash = ? AND prep_hash = ? "
+                f"AND image_hash IN ({','.join('?' * len(part))})", [model_hash, prep_hash, *part]).fetchall()
+            found.update((h, np.frombuffer(blob, dtype=np.float32)) for h, blob in rows)
+        if found:
+            now = time.time()
+            with self._write_lock, conn:
+                conn.executemany("UPDATE logits SET last_used = ? WHERE model_hash = ? AND prep_hash = ? "
+                                 "AND image_hash = ?", [(now, model_hash, prep_hash, h) for h in found])
+        self.hits += len(found)
+        self.misses += len(image_hashes) - len(found)
+        return found
+
+    def put_many(self, model_hash, prep_hash, items):
+        now = time.time()
+        rows = []
+        for image_hash, logits in items:
+            blob = np.asarray(logits, dtype=np.float32).tobytes()
+            rows.append((model_hash, prep_hash, image_hash, blob, len(blob), now))
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.executemany("INSERT OR REPLACE INTO logits VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._evict(conn)
+
+    # drop least recently used entries until the store is 10% under the cap
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM logits").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        doomed = []
+        for rowid, size in conn.execute("SELECT rowid, size FROM logits ORDER BY last_used"):
+            doomed.append((rowid,))
+            freed += size
+            if freed >= target:
+                break
+        conn.executemany("DELETE FROM logits WHERE rowid = ?", doomed)
+
+    def stats(self):
+        count, total = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM logits").fetchone()
+        return {'entries': count, 'mb': total / 2**20, 'hits': self.hits, 'misses': self.misses}
+
+
+class CachedPredictor:
+    """Model + preprocessing in front of a PredictionCache, takes raw (un-transformed) images.
+    Safe to call from several threads of a serving process."""
+
+    def __init__(self, model, transform, cache, model_hash=None, device='cpu', batch_size=400):
+        self.model = model.to(device).eval()
+        self.transform = transform
+        self.cache = cache
+        self.model_hash = model_hash or hash_state_dict(model)
+        self.prep_hash = hash_transform(transform)
+        self.device = device
+        self.batch_size = batch_size
+
+    def _forward(self, images):
+        batch = torch.stack([self.transform(image) if self.transform else image for image in images])
+        with torch.no_grad():
+            return self.model(batch.to(self.device)).float().cpu().numpy()
+
+    # logits (N, classes) for raw images, only the cache misses run through the model
+    def predict_logits(self, images):
+        hashes = [hash_image(image) for image in images]
+        found = self.cache.get_many(self.model_hash, self.prep_hash, hashes)
+        missing = [i for i, h in enumerate(hashes) if h not in found]
+        new_items = []
+        for start in range(0, len(missing), self.batch_size):
+            part = missing[start:start + self.batch_size]
+            logits = self._forward([images[i] for i in part])
+            for i, row in zip(part, logits):
+                found[hashes[i]] = row
+                new_items.append((hashes[i], row))
+        if new_items:
+            self.cache.put_many(self.model_hash, self.prep_hash, new_items)
+        return np.stack([found[h] for h in hashes])
+
+    def predict(self, images):
+        return self.predict_logits(images).argmax(1)
+
+
+# drop-in for utils.generate_predictions on a CustomTensorDataset, reusing cached logits
+def cached_generate_predictions(model, dataset, cache, model_hash=None, device='cpu', batch_size=400):
+    predictor = CachedPredictor(model, dataset.transform, cache, model_hash, device, batch_size)
+    images = dataset.tensors[0]
+    if dataset.indices is not None:
+        images = images[torch.as_tensor(dataset.indices)]
+    predictions = []
+    for start in range(0, len(images), batch_size * 10):
+        predictions.extend(predictor.predict(images[start:start + batch_size * 10]))
+    return predictions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Kaggle test predictions through the logit cache')
+    parser.add_argument('--model', default='ResNet5M')
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--test-pickle', default='cifar_test_nolabels.pkl')
+    parser.add_argument('--cache', default='./prediction_cache.sqlite')
+    parser.add_argument('--max-mb', default=512, type=float)
+    parser.add_argument('--out', default='predictions.csv')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    batch_dict = test_unpickle(args.test_pickle)
+    test_images = torch.Tensor(batch_dict[b'data'].reshape((-1, 3, 32, 32)))
+    test_ids = batch_dict[b'ids']
+    test_dataset = CustomTensorDataset(tensors=(test_images, torch.as_tensor(test_ids)), transform=get_transform("test"))
+
+    cache = PredictionCache(args.cache, args.max_mb)
+    model = load_checkpoint_weights(get_model(args.model), args.checkpoint)
+    start = time.time()
+    predictions = cached_generate_predictions(model, test_dataset, cache, hash_file(args.checkpoint), device)
+    print(f"{len(predictions)} predictions in {time.time() - start:.1f}s, cache {cache.stats()}")
+    save_predictions_to_csv(predictions, test_ids, args.out)
@@ -0,0 +1,89 @@
+"""
+Preemption handling for runs on preemptible capacity.
+
+SIGTERM / SIGINT only set a flag. The training loop checks it after every optimizer step
+(should_stop(), agreed on by all ranks), writes a snapshot and exits, so the step in flight
+always completes and the snapshot is consistent. A second SIGINT interrupts immediately.
+
+A snapshot holds what a normal checkpoint holds plus the position in the epoch (batch index,
+the running loss / accuracy sums) and the RNG states. Together with a
+distributed.ResumableSampler, whose order only depends on seed + epoch, the resumed run
+continues at the first batch not yet trained on. Every rank writes its own file, their RNG
+states and running sums differ.
+"""
+
+import os
+import random
+import signal
+
+import numpy as np
+import torch
+
+from distributed import all_reduce_sum
+
+
+class PreemptionHandler:
+    def __init__(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        self.requested = False
+        self._previous = {sig: signal.signal(sig, self._handle) for sig in signals}
+
+    def _handle(self, signum, frame):
+        if self.requested and signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        self.requested = True
+        print(f"\n{signal.Signals(signum).name} received, snapshotting after the current step")
+
+    # every rank has to stop at the same step, or the others hang in the next all_reduce
+    def should_stop(self, device='cpu'):
+        return all_reduce_sum([float(self.requested)], device)[0] > 0
+
+    def restore(self):
+        for sig, handler in self._previous.items():
+            signal.signal(sig, handler)
+
+
+def capture_rng():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot_path(directory, rank=0):
+    return os.path.join(directory, f'preempt_rank{rank}.pth')
+
+
+# written to a temporary file first, a kill during the write leaves the previous snapshot intact
+def save_snapshot(path, state):
+    state = dict(state, rng=capture_rng())
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+# None if there is no snapshot, RNG states are restored on load unless restore=False
+def load_snapshot(path, map_location='cpu', restore=True):
+    if not os.path.exists(path):
+        return None
+    # not just tensors (python / numpy RNG states)
+    state = torch.load(path, map_location=map_location, weights_only=False)
+    if restore:
+        restore_rng(state['rng'])
+    return state
+
+
+# a finished epoch supersedes the snapshot
+def clear_snapshot(path):
+    if os.path.exists(path):
+        os.remove(path)
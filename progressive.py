@@ -0,0 +1,66 @@
+"""
+Progressive resizing: train the early epochs on downsampled images and ramp the resolution up
+to 32x32, then optionally fine-tune at 32x32 with test-time preprocessing to correct the
+train/test resolution discrepancy (Touvron et al. 2019, "Fixing the train-test resolution
+discrepancy"). Conv FLOPs scale with H*W, so a 16px epoch costs a quarter of a 32px one.
+
+The pooling heads in models/resnet.py are adaptive, so the same weights run at every size.
+"""
+
+import torch
+import torch.optim as optim
+
+from utils import progress_bar
+from batch_finder import autocast_context
+
+
+class ProgressiveSchedule:
+    """Image size per epoch: start_size until ramp_start, linear ramp to end_size at ramp_end,
+    rounded down to a multiple of `multiple`."""
+
+    def __init__(self, start_size=16, end_size=32, ramp_start=0, ramp_end=100, multiple=4):
+        self.start_size = start_size
+        self.end_size = end_size
+        self.ramp_start = ramp_start
+        self.ramp_end = max(ramp_end, ramp_start + 1)
+        self.multiple = multiple
+
+    def size_at(self, epoch):
+        if epoch <= self.ramp_start:
+            return self.start_size
+        if epoch >= self.ramp_end:
+            return self.end_size
+        t = (epoch - self.ramp_start) / (self.ramp_end - self.ramp_start)
+        size = self.start_size + t * (self.end_size - self.start_size)
+        return max(self.start_size, int(size) // self.multiple * self.multiple)
+
+    # training FLOPs relative to training every epoch at end_size
+    def relative_cost(self, epochs):
+        return sum((self.size_at(e) / self.end_size) ** 2 for e in epochs) / max(len(epochs), 1)
+
+
+# only BatchNorm and the classifier adapt to the new input statistics in FixRes
+def fixres_parameters(net):
+    params = []
+    for module in net.modules():
+        if isinstance(module, (torch.nn.BatchNorm2d, torch.nn.Linear)):
+            params.extend(p for p in module.parameters() if p.requires_grad)
+    return params
+
+
+# the whole net still runs forward/backward (DDP expects every gradient), only the FixRes parameters move
+def fixres_finetune(net, loader, epochs, lr, criterion, device='cpu', precision='fp32'):
+    optimizer = optim.SGD(fixres_parameters(net), lr=lr, momentum=0.9)
+    for epoch in range(epochs):
+        net.train()
+        train_loss = 0
+        for batch_idx, (inputs, targets) in enumerate(loader):
+            inputs, targets = inputs.to(device), targets.to(device)
+            net.zero_grad()
+            with autocast_context(device, precision):
+                loss = criterion(net(inputs), targets)
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item()
+            progress_bar(batch_idx, len(loader), 'fixres epoch %d Loss: %.3f' % (epoch, train_loss / (batch_idx + 1)))
+    return net
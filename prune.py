@@ -0,0 +1,211 @@
+"""
+Structured pruning / width alignment for the 4-stage ResNets (ResNet, ResNetWithDropout, ResNet5M34).
+
+The odd stage widths (42/85/171/342, 35/70/125/235) leave SIMD lanes and GEMM tiles partly
+empty. This tool rounds every stage width to a multiple of 8 or 16, keeping the parameter
+count under a budget, and moves the trained weights over:
+
+  * filters are ranked by L1 norm scaled by the |gamma| of the BatchNorm that follows them
+  * stage output channels are shared by every block of the stage through the residual adds,
+    so they are ranked once per stage (last conv + shortcut conv of every block) and the same
+    selection is applied to conv2/conv3, the shortcut convs, the next stage's inputs and the
+    final linear layer
+  * channels added when a width grows get zero filters and zero BatchNorm gamma, so they
+    contribute nothing until the fine-tune trains them
+
+    python prune.py --model ResNet5M --checkpoint checkpoint/ckpt199.pth --multiple 16 --finetune-epochs 2
+"""
+
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+from models.resnet import get_model, BasicBlock, Bottleneck
+from customTensorDataset import get_transform, load_cifar_train
+from splits import stratified_split, make_split_datasets
+from utils import count_params, load_checkpoint_weights, evaluate_accuracy, measure_latency, progress_bar
+
+STAGES = ['layer1', 'layer2', 'layer3', 'layer4']
+
+
+def _filter_importance(conv, bn):
+    return conv.weight.detach().abs().flatten(1).sum(1) * bn.weight.detach().abs()
+
+
+def _block_convs(block):
+    # (conv, bn) pairs for the inner channels and the conv/bn producing the block output
+    if isinstance(block, Bottleneck):
+        return [(block.conv1, block.bn1), (block.conv2, block.bn2)], (block.conv3, block.bn3)
+    return [(block.conv1, block.bn1)], (block.conv2, block.bn2)
+
+
+def _select(importance, new_width):
+    # indices of the channels to keep, most important first; when growing all are kept
+    order = torch.argsort(importance, descending=True)
+    return order[:new_width].sort().values
+
+
+def _copy_conv(src, dst, out_idx, in_idx):
+    with torch.no_grad():
+        dst.weight.zero_()
+        dst.weight[:len(out_idx), :len(in_idx)] = src.weight[out_idx][:, in_idx]
+
+
+def _copy_bn(src, dst, idx):
+    with torch.no_grad():
+        dst.weight.zero_()
+        dst.bias.zero_()
+        dst.running_mean.zero_()
+        dst.running_var.fill_(1.0)
+        dst.weight[:len(idx)] = src.weight[idx]
+        dst.bias[:len(idx)] = src.bias[idx]
+        dst.running_mean[:len(idx)] = src.running_mean[idx]
+        dst.running_var[:len(idx)] = src.running_var[idx]
+        dst.num_batches_tracked.copy_(src.num_batches_tracked)
+
+
+def _build_like(net, widths):
+    block = type(net.layer1[0])
+    num_blocks = [len(getattr(net, stage)) for stage in STAGES]
+    return type(net)(block, num_blocks, widths=widths)
+
+
+def round_to_multiple(width, multiple):
+    return max(multiple, int(round(width / multiple)) * multiple)
+
+
+# round every stage width to the multiple, then shrink the widest stages until the model fits
+def align_widths(net, multiple=8, max_params=5_000_000):
+    widths = [round_to_multiple(w, multiple) for w in net.widths]
+    while count_params(_build_like(net, widths)) >= max_params:
+        stage = max(range(len(widths)), key=lambda i: widths[i])
+        if widths[stage] <= multiple:
+            raise ValueError(f"cannot fit under {max_params} parameters with multiples of {multiple}")
+        widths[stage] -= multiple
+    return widths
+
+
+# new model with the given stage widths, weights moved over from net by filter importance
+def prune_to_widths(net, widths):
+    net = net.cpu().eval()
+    new_net = _build_like(net, widths)
+    expansion = type(net.layer1[0]).expansion
+
+    with torch.no_grad():
+        new_net.conv1.weight.copy_(net.conv1.weight)
+        new_net.bn1.load_state_dict(net.bn1.state_dict())
+        in_idx = torch.arange(net.conv1.out_channels)
+
+        for stage, width in zip(STAGES, widths):
+            old_blocks, new_blocks = getattr(net, stage), getattr(new_net, stage)
+
+            # one selection for the stage output channels, shared through the residual adds
+            importance = 0
+            for block in old_blocks:
+                importance = importance + _filter_importance(*_block_convs(block)[1])
+                if len(block.shortcut) > 0:
+                    importance = importance + _filter_importance(block.shortcut[0], block.shortcut[1])
+            out_idx = _select(importance, width * expansion)
+
+            for old_block, new_block in zip(old_blocks, new_blocks):
+                old_inner, old_last = _block_convs(old_block)
+                new_inner, new_last = _block_convs(new_block)
+                prev_idx = in_idx
+                for (old_conv, old_bn), (new_conv, new_bn) in zip(old_inner, new_inner):
+                    mid_idx = _select(_filter_importance(old_conv, old_bn), width)
+                    _copy_conv(old_conv, new_conv, mid_idx, prev_idx)
+                    _copy_bn(old_bn, new_bn, mid_idx)
+                    prev_idx = mid_idx
+                _copy_conv(old_last[0], new_last[0], out_idx, prev_idx)
+                _copy_bn(old_last[1], new_last[1], out_idx)
+                if len(old_block.shortcut) > 0 and len(new_block.shortcut) > 0:
+                    _copy_conv(old_block.shortcut[0], new_block.shortcut[0], out_idx, in_idx)
+                    _copy_bn(old_block.shortcut[1], new_block.shortcut[1], out_idx)
+                elif len(new_block.shortcut) > 0:
+                    # identity shortcut in the old model, projection in the new one: start it as the identity
+                    conv, bn = new_block.shortcut[0], new_block.shortcut[1]
+                    conv.weight.zero_()
+                    positions = {int(c): j for j, c in enumerate(in_idx)}
+                    for k, c in enumerate(out_idx):
+                        if int(c) in positions:
+                            conv.weight[k, positions[int(c)], 0, 0] = 1.0
+                    bn.weight.fill_(1.0)
+                    bn.bias.zero_()
+                    bn.running_mean.zero_()
+                    bn.running_var.fill_(1.0 - bn.eps)
+                # a projection that becomes an identity (e.g. layer1 aligned to the 64 stem channels)
+                # cannot be carried over exactly, the fine-tune makes up for it
+                in_idx = out_idx
+
+        new_net.linear.weight.zero_()
+        new_net.linear.weight[:, :len(in_idx)] = net.linear.weight[:, in_idx]
+        new_net.linear.bias.copy_(net.linear.bias)
+    return new_net
+
+
+# short fine-tune after pruning
+def finetune(net, trainloader, epochs, lr=0.01, device='cpu'):
+    net.to(device)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.SGD(net.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4)
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(epochs * len(trainloader), 1))
+    for epoch in range(epochs):
+        net.train()
+        for batch_idx, (inputs, targets) in enumerate(trainloader):
+            inputs, targets = inputs.to(device), targets.to(device)
+            optimizer.zero_grad()
+            loss = criterion(net(inputs), targets)
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            progress_bar(batch_idx, len(trainloader), 'finetune epoch %d Loss: %.3f' % (epoch, loss.item()))
+    return net
+
+
+def report(name, net, validloader, device, batch_sizes):
+    acc = evaluate_accuracy(net, validloader, device)
+    latencies = ' '.join(f"bs{bs}={measure_latency(net, bs, device):.2f}ms" for bs in batch_sizes)
+    print(f"{name:<8} widths={list(net.widths)} params={count_params(net)} acc={acc:.2f}% {latencies}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Width alignment / structured pruning')
+    parser.add_argument('--model', default='ResNet5M')
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--multiple', default=8, type=int, help='align channel counts to this multiple (8 or 16)')
+    parser.add_argument('--max-params', default=5_000_000, type=int)
+    parser.add_argument('--widths', default=None, type=lambda s: [int(w) for w in s.split(',')],
+                        help='explicit stage widths instead of rounding, e.g. 32,64,128,256')
+    parser.add_argument('--finetune-epochs', default=1, type=int)
+    parser.add_argument('--lr', default=0.01, type=float)
+    parser.add_argument('--batch-size', default=128, type=int)
+    parser.add_argument('--out', default='./checkpoint/pruned.pth')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    net = load_checkpoint_weights(get_model(args.model), args.checkpoint)
+    if not hasattr(net, 'widths'):
+        raise ValueError(f"{args.model} has no 4-stage width layout to align")
+
+    images, labels = load_cifar_train()
+    tensors = (torch.Tensor(images), torch.from_numpy(labels))
+    train_idx, valid_idx = stratified_split(labels, valid_size=0.1, seed=42)
+    train_dataset, valid_dataset = make_split_datasets(tensors, train_idx, valid_idx,
+                                                       get_transform("train"), get_transform("valid"))
+    trainloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
+    validloader = DataLoader(valid_dataset, batch_size=400, shuffle=False)
+
+    widths = args.widths or align_widths(net, args.multiple, args.max_params)
+    batch_sizes = [1, 64]
+    report('before', net.to(device), validloader, device, batch_sizes)
+    pruned = prune_to_widths(net, widths)
+    report('pruned', pruned.to(device), validloader, device, batch_sizes)
+    if args.finetune_epochs > 0:
+        finetune(pruned, trainloader, args.finetune_epochs, args.lr, device)
+        report('tuned', pruned, validloader, device, batch_sizes)
+
+    torch.save({'net': pruned.state_dict(), 'model': args.model, 'widths': widths}, args.out)
+    print(f"saved {args.out}")
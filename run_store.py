@@ -0,0 +1,272 @@
+"""
+Experiment results store: one SQLite file for every run, instead of PNG filenames built from
+paras_for_graph and grepping stdout.
+
+  runs       one row per run: the hyperparameters as indexed columns, the full config as JSON,
+             and the best validation accuracy so far (kept up to date on every flush, so
+             "best per lr" never scans the epochs table)
+  epochs     one row per (run, epoch): losses, accuracies, lr and timings
+  artifacts  checkpoints, prediction CSVs, plots of a run
+
+The training loop only appends to in-memory buffers; rows are written with executemany in one
+transaction every flush_every epochs and on finish().
+
+    python run_store.py list --where model=ResNet5M --limit 20
+    python run_store.py best --by lr
+    python run_store.py times --by batch_size
+    python run_store.py show 42
+    python run_store.py import metrics/metrics.csv --name old-sweep --config lr=0.01 model=ResNet5M
+"""
+
+import csv
+import json
+import time
+import sqlite3
+import argparse
+
+# indexed columns of the runs table, the only ones the query CLI can filter or group by
+HYPERPARAMS = ['model', 'optimizer', 'lr', 'batch_size', 'epochs', 'world_size']
+EPOCH_FIELDS = ['train_loss', 'train_acc', 'valid_loss', 'valid_acc', 'lr',
+                'epoch_time', 'train_time', 'valid_time']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    name TEXT,
+    started REAL NOT NULL,
+    finished REAL,
+    status TEXT NOT NULL,
+    model TEXT,
+    optimizer TEXT,
+    lr REAL,
+    batch_size INTEGER,
+    epochs INTEGER,
+    world_size INTEGER,
+    config TEXT NOT NULL,
+    best_valid_acc REAL,
+    best_epoch INTEGER,
+    num_epochs INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    epoch INTEGER NOT NULL,
+    train_loss REAL,
+    train_acc REAL,
+    valid_loss REAL,
+    valid_acc REAL,
+    lr REAL,
+    epoch_time REAL,
+    train_time REAL,
+    valid_time REAL,
+    PRIMARY KEY (run_id, epoch)
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    epoch INTEGER,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_run ON artifacts (run_id, kind);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE INDEX IF NOT EXISTS runs_best ON runs (best_valid_acc);
+""" + ''.join(f"CREATE INDEX IF NOT EXISTS runs_{p} ON runs ({p}, best_valid_acc);\n" for p in HYPERPARAMS)
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class RunStore:
+    """Records one run. Only the main process should create one."""
+
+    def __init__(self, path='./runs.sqlite', flush_every=10):
+        self.path = path
+        self.flush_every = flush_every
+        self.conn = connect(path)
+        self.run_id = None
+        self.best_valid_acc = None
+        self.best_epoch = None
+        self.num_epochs = 0
+        self._epochs = []
+        self._artifacts = []
+
+    def start_run(self, config, name=None):
+        columns = {p: config.get(p) for p in HYPERPARAMS}
+        with self.conn:
+            cursor = self.conn.execute(
+                f"INSERT INTO runs (name, started, status, {', '.join(HYPERPARAMS)}, config) "
+                f"VALUES (?, ?, 'running', {', '.join('?' * len(HYPERPARAMS))}, ?)",
+                [name, time.time(), *columns.values(), json.dumps(config, sort_keys=True, default=str)])
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def log_epoch(self, epoch, **metrics):
+        self._epochs.append((self.run_id, epoch, *[metrics.get(field) for field in EPOCH_FIELDS]))
+        valid_acc = metrics.get('valid_acc')
+        if valid_acc is not None and (self.best_valid_acc is None or valid_acc > self.best_valid_acc):
+            self.best_valid_acc, self.best_epoch = valid_acc, epoch
+        self.num_epochs += 1
+        if len(self._epochs) >= self.flush_every:
+            self.flush()
+
+    def log_artifact(self, kind, path, epoch=None):
+        self._artifacts.append((self.run_id, epoch, kind, path))
+
+    def flush(self):
+        if not self._epochs and not self._artifacts:
+            return
+        with self.conn:
+            self.conn.executemany(f"INSERT OR REPLACE INTO epochs VALUES ({', '.join('?' * (2 + len(EPOCH_FIELDS)))})",
+                                  self._epochs)
+            self.conn.executemany("INSERT INTO artifacts VALUES (?, ?, ?, ?)", self._artifacts)
+            self.conn.execute("UPDATE runs SET best_valid_acc = ?, best_epoch = ?, num_epochs = ? WHERE run_id = ?",
+                              (self.best_valid_acc, self.best_epoch, self.num_epochs, self.run_id))
+        self._epochs = []
+        self._artifacts = []
+
+    def finish(self, status='finished'):
+        self.flush()
+        with self.conn:
+            self.conn.execute("UPDATE runs SET finished = ?, status = ? WHERE run_id = ?",
+                              (time.time(), status, self.run_id))
+        self.conn.close()
+
+
+# parse "key=value" filters on the indexed hyperparameters into a WHERE clause
+def where_clause(filters, prefix='r.'):
+    clauses, values = [], []
+    for item in filters or []:
+        key, _, value = item.partition('=')
+        if key not in HYPERPARAMS:
+            raise SystemExit(f"can only filter on {', '.join(HYPERPARAMS)}, not {key!r}")
+        # the column affinity converts numeric strings, so lr=0.01 matches the REAL column
+        clauses.append(f"{prefix}{key} = ?")
+        values.append(value)
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', values
+
+
+def _check_column(column):
+    if column not in HYPERPARAMS:
+        raise SystemExit(f"can only group by {', '.join(HYPERPARAMS)}, not {column!r}")
+
+
+def list_runs(conn, filters=None, limit=20):
+    where, values = where_clause(filters)
+    return conn.execute(f"SELECT r.run_id, r.name, r.status, r.model, r.optimizer, r.lr, r.batch_size, "
+                        f"r.num_epochs, r.best_valid_acc, r.best_epoch FROM runs r{where} "
+                        f"ORDER BY r.started DESC LIMIT ?", values + [limit]).fetchall()
+
+
+# best validation accuracy for every value of a hyperparameter, with the run that reached it
+def best_by(conn, column, filters=None):
+    _check_column(column)
+    where, values = where_clause(filters)
+    where += (' AND' if where else ' WHERE') + ' r.best_valid_acc IS NOT NULL'
+    # SQLite returns the other columns of the row holding the MAX()
+    return conn.execute(f"SELECT r.{column}, MAX(r.best_valid_acc), r.run_id, r.best_epoch, COUNT(*) "
+                        f"FROM runs r{where} GROUP BY r.{column} ORDER BY 2 DESC", values).fetchall()
+
+
+def percentile(sorted_values, q):
+    # nearest rank
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+# epoch-time percentiles per run, or per value of a hyperparameter
+def epoch_times(conn, column=None, filters=None, field='epoch_time', percentiles=(50, 90, 99)):
+    if field not in ('epoch_time', 'train_time', 'valid_time'):
+        raise SystemExit(f"no timing field {field!r}")
+    group = 'r.run_id'
+    if column is not None:
+        _check_column(column)
+        group = f"r.{column}"
+    where, values = where_clause(filters)
+    where += (' AND' if where else ' WHERE') + f" e.{field} IS NOT NULL"
+    rows = conn.execute(f"SELECT {group}, e.{field} FROM epochs e JOIN runs r ON r.run_id = e.run_id{where} "
+                        f"ORDER BY {group}, e.{field}", values)
+    groups = {}
+    for key, value in rows:
+        groups.setdefault(key, []).append(value)
+    return [(key, len(times), *[percentile(times, q) for q in percentiles]) for key, times in groups.items()]
+
+
+# an old metrics_sink CSV log as a new run
+def import_metrics_csv(store, path, config, name=None):
+    store.start_run(config, name=name or path)
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            store.log_epoch(int(row['epoch']), **{k: float(v) for k, v in row.items()
+                                                  if k in EPOCH_FIELDS and v != ''})
+    store.log_artifact('metrics_csv', path)
+    store.finish('imported')
+    return store.run_id
+
+
+def _fmt(value):
+    if value is None:
+        return '-'
+    return f"{value:.4g}" if isinstance(value, float) else str(value)
+
+
+def _print_table(header, rows):
+    rows = [[_fmt(v) for v in row] for row in rows]
+    widths = [max([len(h)] + [len(row[i]) for row in rows]) for i, h in enumerate(header)]
+    print('  '.join(h.rjust(w) for h, w in zip(header, widths)))
+    for row in rows:
+        print('  '.join(v.rjust(w) for v, w in zip(row, widths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the experiment results store')
+    parser.add_argument('--db', default='./runs.sqlite')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('list', help='most recent runs')
+    p.add_argument('--where', action='append', help='hyperparameter filter, e.g. lr=0.01 (repeatable)')
+    p.add_argument('--limit', default=20, type=int)
+    p = sub.add_parser('best', help='best valid acc per value of a hyperparameter')
+    p.add_argument('--by', default='lr')
+    p.add_argument('--where', action='append')
+    p = sub.add_parser('times', help='epoch time percentiles per run or per hyperparameter value')
+    p.add_argument('--by', default=None)
+    p.add_argument('--field', default='epoch_time', choices=['epoch_time', 'train_time', 'valid_time'])
+    p.add_argument('--where', action='append')
+    p = sub.add_parser('show', help='per-epoch metrics and artifacts of a run')
+    p.add_argument('run_id', type=int)
+    p = sub.add_parser('import', help='record a metrics_sink CSV log as a run')
+    p.add_argument('csv')
+    p.add_argument('--name', default=None)
+    p.add_argument('--config', nargs='*', default=[], help='hyperparameters as key=value')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'import':
+        config = dict(item.partition('=')[::2] for item in args.config)
+        run_id = import_metrics_csv(RunStore(args.db, flush_every=1000), args.csv, config, args.name)
+        print(f"imported {args.csv} as run {run_id}")
+    else:
+        conn = connect(args.db)
+        if args.command == 'list':
+            _print_table(['run', 'name', 'status', 'model', 'optimizer', 'lr', 'batch', 'epochs', 'best acc', 'at'],
+                         list_runs(conn, args.where, args.limit))
+        elif args.command == 'best':
+            _print_table([args.by, 'best acc', 'run', 'epoch', 'runs'], best_by(conn, args.by, args.where))
+        elif args.command == 'times':
+            _print_table([args.by or 'run', 'epochs', 'p50 s', 'p90 s', 'p99 s'],
+                         epoch_times(conn, args.by, args.where, args.field))
+        elif args.command == 'show':
+            run = conn.execute("SELECT name, status, config FROM runs WHERE run_id = ?", (args.run_id,)).fetchone()
+            if run is None:
+                raise SystemExit(f"no run {args.run_id}")
+            print(f"run {args.run_id} {run[0]} ({run[1]})\n{run[2]}")
+            _print_table(['epoch'] + EPOCH_FIELDS,
+                         conn.execute(f"SELECT epoch, {', '.join(EPOCH_FIELDS)} FROM epochs WHERE run_id = ? "
+                                      f"ORDER BY epoch", (args.run_id,)).fetchall())
+            for epoch, kind, path in conn.execute("SELECT epoch, kind, path FROM artifacts WHERE run_id = ? "
+                                                  "ORDER BY epoch", (args.run_id,)):
+                print(f"  {kind} epoch {_fmt(epoch)}: {path}")
+    print(f"({(time.perf_counter() - start) * 1000:.1f} ms)")
@@ -0,0 +1,156 @@
+"""
+CPU thread and core configuration for training and inference.
+
+The available cores (after splitting them between the local torchrun processes) are
+divided into two disjoint sets: one for the intra-op compute threads of the main
+process and one for the DataLoader workers, each worker pinned to its own core and
+limited to a single thread. This keeps loader workers and compute threads from
+oversubscribing the same cores.
+
+OMP_NUM_THREADS / MKL_NUM_THREADS only take full effect when exported before python
+starts, torch.set_num_threads is applied here regardless.
+"""
+
+import os
+import time
+import functools
+
+import torch
+from torch.utils.data import DataLoader
+
+from utils import repeat_batches, time_train_steps, run_isolated
+
+
+# affinity of the process before any pinning, pinning the main thread shrinks sched_getaffinity
+_process_cores = None
+_interop_warned = False
+
+
+def available_cores():
+    global _process_cores
+    if _process_cores is None:
+        if hasattr(os, 'sched_getaffinity'):
+            _process_cores = sorted(os.sched_getaffinity(0))
+        else:
+            _process_cores = list(range(os.cpu_count() or 1))
+    return list(_process_cores)
+
+
+# split the cores of this process into compute and loader-worker sets
+def plan_threads(num_threads=None, interop_threads=None, num_workers=None,
+                 local_rank=0, local_world_size=1):
+    cores = available_cores()
+    if local_world_size > 1:
+        per_rank = max(len(cores) // local_world_size, 1)
+        cores = cores[local_rank * per_rank:(local_rank + 1) * per_rank] or cores[-1:]
+
+    if num_workers is None:
+        # a quarter of the cores for augmentation, the rest for the model
+        num_workers = min(len(cores) // 4, 8)
+    num_workers = min(num_workers, max(len(cores) - 1, 0))
+    worker_cores = cores[len(cores) - num_workers:] if num_workers else []
+    compute_cores = cores[:len(cores) - num_workers]
+
+    if num_threads is None:
+        num_threads = len(compute_cores)
+    if interop_threads is None:
+        interop_threads = 1 if num_threads <= 4 else 2
+    return {
+        'num_threads': num_threads,
+        'interop_threads': interop_threads,
+        'num_workers': num_workers,
+        'compute_cores': compute_cores,
+        'worker_cores': worker_cores,
+    }
+
+
+# pin every thread of the process, threads that already exist (e.g. an OpenMP pool started by
+# an earlier parallel op) do not follow a change of the main thread's mask
+def _pin_all_threads(cores):
+    os.sched_setaffinity(0, cores)
+    if not os.path.isdir('/proc/self/task'):
+        return
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            os.sched_setaffinity(int(tid), cores)
+        except OSError:
+            # the thread exited in the meantime
+            pass
+
+
+# apply a plan to the current process, best before the first parallel torch op
+def apply_thread_config(config, pin=True, set_interop=True):
+    global _interop_warned
+    os.environ['OMP_NUM_THREADS'] = str(config['num_threads'])
+    os.environ['MKL_NUM_THREADS'] = str(config['num_threads'])
+    torch.set_num_threads(config['num_threads'])
+    if set_interop:
+        try:
+            torch.set_num_interop_threads(config['interop_threads'])
+        except RuntimeError:
+            # can only be set once per process, before any inter-op work
+            if not _interop_warned:
+                print(f"interop threads already initialised, keeping {torch.get_num_interop_threads()}")
+                _interop_warned = True
+    # threads created after this inherit the mask, so the OpenMP pool stays on the compute cores
+    if pin and config['compute_cores'] and hasattr(os, 'sched_setaffinity'):
+        _pin_all_threads(config['compute_cores'])
+
+
+def _pin_worker(worker_cores, worker_id):
+    torch.set_num_threads(1)
+    if worker_cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [worker_cores[worker_id % len(worker_cores)]])
+
+
+# DataLoader keyword arguments matching a plan (workers pinned to the worker cores)
+def loader_kwargs(config, pin=True):
+    if config['num_workers'] == 0:
+        return {}
+    return {
+        'num_workers': config['num_workers'],
+        'worker_init_fn': functools.partial(_pin_worker, config['worker_cores'] if pin else []),
+        'persistent_workers': True,
+    }
+
+
+def describe(config):
+    return (f"threads={config['num_threads']} interop={config['interop_threads']} "
+            f"workers={config['num_workers']} compute_cores={config['compute_cores']} "
+            f"worker_cores={config['worker_cores']}")
+
+
+def _time_candidate(config, model_fn, dataset, batch_size, steps, pin):
+    apply_thread_config(config, pin=pin, set_interop=False)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, **loader_kwargs(config, pin=pin))
+    return time_train_steps(model_fn(), repeat_batches(loader), 'cpu', steps=steps)
+
+
+# time a few training steps of model_fn for different compute/worker splits and return the best plan.
+# Every candidate runs in a fresh forked process, so its thread pool starts out with its own pinning.
+# Interop threads can only be set once per process, so only the intra-op / worker split is searched.
+def autotune_threads(model_fn, dataset, batch_size, candidate_workers=None, steps=5,
+                     local_rank=0, local_world_size=1, pin=True):
+    total = len(plan_threads(num_workers=0, local_rank=local_rank, local_world_size=local_world_size)['compute_cores'])
+    if candidate_workers is None:
+        candidate_workers = sorted({0, 1, 2, total // 8, total // 4, total // 2} - {total})
+
+    best_config, best_speed = None, 0.0
+    for num_workers in candidate_workers:
+        config = plan_threads(num_workers=num_workers, local_rank=local_rank, local_world_size=local_world_size)
+        start = time.time()
+        try:
+            speed, _ = run_isolated(_time_candidate, config, model_fn, dataset, batch_size, steps, pin)
+        except (RuntimeError, MemoryError) as e:
+            print(f"autotune: {describe(config)} failed: {e}")
+            continue
+        print(f"autotune: {describe(config)} -> {speed:.1f} img/s ({time.time() - start:.1f}s)")
+        if speed > best_speed:
+            best_config, best_speed = config, speed
+
+    if best_config is None:
+        best_config = plan_threads(local_rank=local_rank, local_world_size=local_world_size)
+        print("autotune: no candidate could be timed, keeping the default split")
+    apply_thread_config(best_config, pin=pin)
+    print(f"autotune picked {describe(best_config)}")
+    return best_config
@@ -0,0 +1,69 @@
+"""
+Selective backprop (Jiang et al. 2019, "Accelerating Deep Learning by Focusing on the Biggest
+Losers").
+
+Every batch is first run forward without autograd to get the per-sample losses. A sample is
+kept for the backward pass with probability percentile(loss)^beta, where the percentile is
+taken over the most recent losses, so easy samples are mostly skipped. Kept samples are
+collected until a full batch is ready, and only that batch is run forward and backward.
+
+The loss of every sample is also kept by its position in the dataset (CustomTensorDataset
+with return_index=True), for inspecting which samples stay hard.
+"""
+
+import torch
+
+
+class SelectiveBackprop:
+    def __init__(self, num_samples, batch_size, beta=2.0, window=4096, min_prob=0.0):
+        self.batch_size = batch_size
+        self.beta = beta
+        self.min_prob = min_prob
+        self.sample_loss = torch.full((num_samples,), float('nan'))
+        self._window = torch.empty(0)
+        self._window_size = window
+        self._pending = []
+        self._num_pending = 0
+        self.seen = 0
+        self.selected = 0
+
+    # boolean mask of the samples to backpropagate through
+    def select(self, losses, sample_ids):
+        device = losses.device
+        losses = losses.detach().float().cpu()
+        self.sample_loss[sample_ids.cpu()] = losses
+        self._window = torch.cat([self._window, losses])[-self._window_size:]
+        ranked = torch.sort(self._window).values
+        percentile = torch.searchsorted(ranked, losses, right=True).float() / len(ranked)
+        keep = torch.rand(len(losses)) < percentile.pow(self.beta).clamp(min=self.min_prob)
+        self.seen += len(losses)
+        self.selected += int(keep.sum())
+        return keep.to(device)
+
+    # queue the selected samples, yield every full batch that is ready
+    def add(self, inputs, targets, keep):
+        if keep.any():
+            self._pending.append((inputs[keep], targets[keep]))
+            self._num_pending += int(keep.sum())
+        while self._num_pending >= self.batch_size:
+            inputs = torch.cat([x for x, _ in self._pending])
+            targets = torch.cat([y for _, y in self._pending])
+            yield inputs[:self.batch_size], targets[:self.batch_size]
+            rest = (inputs[self.batch_size:], targets[self.batch_size:])
+            self._pending = [rest] if len(rest[0]) else []
+            self._num_pending = len(rest[0])
+
+    # the leftover partial batch at the end of an epoch
+    def flush(self):
+        if self._num_pending:
+            inputs = torch.cat([x for x, _ in self._pending])
+            targets = torch.cat([y for _, y in self._pending])
+            self._pending, self._num_pending = [], 0
+            yield inputs, targets
+
+    # fraction of backward passes skipped since the last call
+    def backward_saved(self, reset=True):
+        saved = 1.0 - self.selected / self.seen if self.seen else 0.0
+        if reset:
+            self.seen, self.selected = 0, 0
+        return saved
@@ -0,0 +1,204 @@
+"""
+Sharded on-disk training set for data that does not fit in memory (expanded / pseudo-labelled
+sets on top of CIFAR-10).
+
+Layout of a shard directory:
+
+    index.json          image shape, records per shard, shard files and their record counts
+    shard-00000.bin     fixed-size records: int16 label followed by the uint8 image (C, H, W)
+    shard-00001.bin     ...
+
+ShardedDataset streams the records with bounded memory: the shard order is reshuffled every
+epoch, and every distributed rank / DataLoader worker reads an equal contiguous range of the
+records in that order (wrapping around at the end, like the DistributedSampler pads), so each
+record is read once per epoch and DDP ranks never run a different number of steps. A shuffle
+buffer mixes records from consecutive shards.
+
+convert_cifar only writes the training part of the same stratified split as main.py, the index
+records the split so main.py can check it matches its validation set.
+
+    python shards.py --out data/cifar10-shards --records-per-shard 5000 --valid-size 0.1
+"""
+
+import os
+import json
+import math
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from customTensorDataset import load_cifar_train
+from splits import stratified_split
+from distributed import get_rank, get_world_size
+
+
+def record_dtype(image_shape):
+    return np.dtype([('label', '<i2'), ('image', np.uint8, tuple(image_shape))])
+
+
+class ShardWriter:
+    def __init__(self, out_dir, image_shape=(3, 32, 32), records_per_shard=5000):
+        self.out_dir = out_dir
+        self.image_shape = tuple(image_shape)
+        self.records_per_shard = records_per_shard
+        self.dtype = record_dtype(image_shape)
+        self.shards = []
+        self._buffer = np.empty(records_per_shard, dtype=self.dtype)
+        self._count = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def add(self, image, label):
+        self._buffer[self._count] = (label, image)
+        self._count += 1
+        if self._count == self.records_per_shard:
+            self._flush()
+
+    def add_many(self, images, labels):
+        for image, label in zip(images, labels):
+            self.add(image, label)
+
+    def _flush(self):
+        if self._count == 0:
+            return
+        name = f'shard-{len(self.shards):05d}.bin'
+        self._buffer[:self._count].tofile(os.path.join(self.out_dir, name))
+        self.shards.append({'file': name, 'num_records': self._count})
+        self._count = 0
+
+    def close(self, **extra):
+        self._flush()
+        index = {
+            'image_shape': list(self.image_shape),
+            'records_per_shard': self.records_per_shard,
+            'num_records': sum(s['num_records'] for s in self.shards),
+            'shards': self.shards,
+            **extra,
+        }
+        with open(os.path.join(self.out_dir, 'index.json'), 'w') as f:
+            json.dump(index, f, indent=2)
+        return index
+
+
+# the validation positions of stratified_split(valid_size, seed) are left out, 0 writes everything
+def convert_cifar(out_dir, cifar10_dir='data/cifar-10-batches-py', records_per_shard=5000, valid_size=0.1, seed=42):
+    images, labels = load_cifar_train(cifar10_dir)
+    train_idx, _ = stratified_split(labels, valid_size=valid_size, seed=seed)
+    writer = ShardWriter(out_dir, images.shape[1:], records_per_shard)
+    writer.add_many(images[train_idx], labels[train_idx])
+    return writer.close(split={'valid_size': valid_size, 'seed': seed})
+
+
+class ShardedDataset(IterableDataset):
+    def __init__(self, root, transform=None, shuffle=True, buffer_size=2000, seed=0):
+        with open(os.path.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        self.root = root
+        self.transform = transform
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.dtype = record_dtype(self.index['image_shape'])
+        # shared with forked (persistent) loader workers, so set_epoch reaches them
+        self._epoch = mp.get_context('fork').Value('i', 0)
+
+    def set_epoch(self, epoch):
+        self._epoch.value = epoch
+
+    # samples per rank, every rank gets the same count
+    def __len__(self):
+        return math.ceil(self.index['num_records'] / get_world_size())
+
+    def _open_shard(self, shard):
+        return np.memmap(os.path.join(self.root, shard['file']), dtype=self.dtype, mode='r',
+                         shape=(shard['num_records'],))
+
+    # (shard, lo, hi) pieces covering `count` records from position `start` of the shard sequence,
+    # wrapping around at the end
+    def _segments(self, shards, start, count):
+        total = self.index['num_records']
+        bounds, offset = [], 0
+        for shard in shards:
+            bounds.append((shard, offset, offset + shard['num_records']))
+            offset += shard['num_records']
+        segments = []
+        while count > 0:
+            pos = start % total
+            for shard, lo, hi in bounds:
+                if lo <= pos < hi:
+                    take = min(hi - pos, count)
+                    segments.append((shard, pos - lo, pos - lo + take))
+                    start += take
+                    count -= take
+                    break
+        return segments
+
+    def _records(self, segments, rng):
+        # one memmapped shard at a time
+        for shard, lo, hi in segments:
+            records = self._open_shard(shard)
+            order = lo + rng.permutation(hi - lo) if self.shuffle else range(lo, hi)
+            for i in order:
+                yield int(records['label'][i]), np.array(records['image'][i])
+            del records
+
+    def __iter__(self):
+        epoch = self._epoch.value
+        rank, world_size = get_rank(), get_world_size()
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+
+        # the same shard order on every rank and worker, then a disjoint slice for each
+        shards = list(self.index['shards'])
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + epoch).permutation(len(shards))
+            shards = [shards[i] for i in order]
+        slot, num_slots = rank * num_workers + worker_id, world_size * num_workers
+
+        # an equal share of records for every rank, split as evenly as possible between its workers
+        per_rank = len(self)
+        quota = per_rank // num_workers + (1 if worker_id < per_rank % num_workers else 0)
+        start = rank * per_rank + worker_id * (per_rank // num_workers) + min(worker_id, per_rank % num_workers)
+        rng = np.random.RandomState(self.seed + epoch * num_slots + slot + 1)
+
+        records = self._records(self._segments(shards, start, quota), rng)
+        if not self.shuffle:
+            for record in records:
+                yield self._sample(record)
+            return
+        # shuffle buffer: emit a random buffered record and put the new one in its place
+        buffer = []
+        for record in records:
+            if len(buffer) < self.buffer_size:
+                buffer.append(record)
+                continue
+            j = rng.randint(len(buffer))
+            yield self._sample(buffer[j])
+            buffer[j] = record
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield self._sample(record)
+
+    def _sample(self, record):
+        label, image = record
+        # float like the torch.Tensor images of the validation / test path, ToPILImage scales
+        # both the same way
+        x = torch.from_numpy(image).float()
+        if self.transform:
+            x = self.transform(x)
+        return x, label
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the CIFAR-10 training pickles to record shards')
+    parser.add_argument('--cifar10-dir', default='data/cifar-10-batches-py')
+    parser.add_argument('--out', default='data/cifar10-shards')
+    parser.add_argument('--records-per-shard', default=5000, type=int)
+    parser.add_argument('--valid-size', default=0.1, type=lambda v: int(v) if v.isdigit() else float(v),
+                        help='leave out the validation split main.py uses with the same --valid-size, 0 for all samples')
+    args = parser.parse_args()
+
+    index = convert_cifar(args.out, args.cifar10_dir, args.records_per_shard, args.valid_size)
+    print(f"wrote {index['num_records']} records in {len(index['shards'])} shards to {args.out}")
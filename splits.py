@@ -0,0 +1,46 @@
+"""
+Train/validation splits as index arrays.
+
+Only the labels are looked at (and copied to the host), the images stay in one shared
+tensor and the datasets index into it through CustomTensorDataset(indices=...). Moving
+between the 45k/5k, 50k/10k and 60k/0 setups therefore costs no extra image memory.
+"""
+
+import numpy as np
+import torch
+from sklearn.model_selection import StratifiedShuffleSplit, StratifiedKFold
+
+from customTensorDataset import CustomTensorDataset
+
+
+def _labels_to_numpy(labels):
+    if torch.is_tensor(labels):
+        return labels.detach().cpu().numpy()
+    return np.asarray(labels)
+
+
+# stratified train/valid index split, valid_size is a fraction or a number of samples (0 = no validation set)
+def stratified_split(labels, valid_size=0.1, seed=42):
+    labels = _labels_to_numpy(labels)
+    num_samples = len(labels)
+    if not valid_size:
+        return np.arange(num_samples), np.arange(0)
+    splitter = StratifiedShuffleSplit(n_splits=1, test_size=valid_size, random_state=seed)
+    train_idx, valid_idx = next(splitter.split(np.zeros(num_samples), labels))
+    # sorted indices keep the reads from the shared tensor in memory order
+    return np.sort(train_idx), np.sort(valid_idx)
+
+
+# stratified K-fold, yields (train_idx, valid_idx) for every fold
+def stratified_kfold(labels, n_splits=5, seed=42):
+    labels = _labels_to_numpy(labels)
+    splitter = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    for train_idx, valid_idx in splitter.split(np.zeros(len(labels)), labels):
+        yield np.sort(train_idx), np.sort(valid_idx)
+
+
+# build the train and valid datasets as views over the same (images, labels) tensors
+def make_split_datasets(tensors, train_idx, valid_idx, train_transform=None, valid_transform=None):
+    train_dataset = CustomTensorDataset(tensors=tensors, transform=train_transform, indices=train_idx)
+    valid_dataset = CustomTensorDataset(tensors=tensors, transform=valid_transform, indices=valid_idx)
+    return train_dataset, valid_dataset
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.resnet import get_model
+from export_onnx import fold_batchnorm, export_onnx
+from inference import TorchBackend, OnnxBackend, check_parity
+
+TOLERANCE = 1e-3
+
+
+# fresh BatchNorm layers are the identity in eval mode, random running stats make folding matter
+@pytest.fixture(scope='module')
+def net():
+    torch.manual_seed(0)
+    net = get_model('ResNet5M2Layers')
+    for m in net.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.0)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.2, 0.2)
+    return net.eval()
+
+
+def test_folded_torch_parity(net):
+    folded = fold_batchnorm(net)
+    assert not any(isinstance(m, torch.nn.BatchNorm2d) for m in folded.modules())
+    max_diff, agreement = check_parity(net, TorchBackend(folded, 'cpu'))
+    assert max_diff < TOLERANCE
+    assert agreement == 1.0
+
+
+@pytest.mark.parametrize('fold_bn', [True, False])
+def test_onnx_parity(net, tmp_path, fold_bn):
+    path = str(tmp_path / 'model.onnx')
+    export_onnx(net, path, fold_bn=fold_bn)
+    max_diff, agreement = check_parity(net, OnnxBackend(path, num_threads=1))
+    assert max_diff < TOLERANCE
+    assert agreement == 1.0
@@ -2,6 +2,11 @@ import os
 import sys
 import time
 import math
+import shutil
+import resource
+import multiprocessing as mp
+import torch
+import pandas as pd
 import matplotlib
 import matplotlib.pyplot as plt
 import torch.nn as nn
@@ -42,8 +47,8 @@ def init_params(net):
                 init.constant(m.bias, 0)
 
 
-_, term_width = os.popen('stty size', 'r').read().split()
-term_width = int(term_width)
+# fall back to a default width when there is no tty (background workers, nohup, cron)
+term_width = shutil.get_terminal_size().columns
 
 TOTAL_BAR_LENGTH = 65.
 last_time = time.time()
@@ -155,9 +160,14 @@ def get_lrs(optimizer):
         return param_group['lr']
         
 # function to plot learning rates
-def plot_lr(lr_trend, epoch, hyperparam):
+def plot_lr(lr_trend, epoch, hyperparam, steps=None):
     plt.figure(figsize=(10, 5))
-    plt.plot(lr_trend, '-o', label='Learning Rate')
+    if steps is None:
+        plt.plot(lr_trend, '-o', label='Learning Rate')
+    else:
+        # already downsampled series, plot against the original step numbers
+        plt.plot(steps, lr_trend, '-', label='Learning Rate')
+        plt.xlabel('Step')
     # plt.title(f'Learning Rate with {hyperparam} {epoch} epoches')
     plt.title(f'LR with {" | ".join(hyperparam)} {epoch} epoches')
     plt.ylabel('lr')
@@ -165,3 +175,183 @@ def plot_lr(lr_trend, epoch, hyperparam):
     plt.grid(True)
     plt.savefig(f"LR {' | '.join(hyperparam)} in {epoch} epochs.png")
     plt.close()
+
+# smoothed loss against a log-scale lr from the LR range test, suggested lrs as vertical lines
+def plot_lr_range(lrs, losses, hyperparam, marks=None):
+    plt.figure(figsize=(10, 5))
+    plt.semilogx(lrs, losses, '-', label='Smoothed Loss')
+    for name, lr in (marks or {}).items():
+        plt.axvline(lr, linestyle='--', color='gray')
+        plt.text(lr, max(losses), f' {name} {lr:.2e}', rotation=90, va='top')
+    plt.title(f'LR range test with {" | ".join(hyperparam)}')
+    plt.xlabel('lr')
+    plt.ylabel('loss')
+    plt.legend()
+    plt.grid(True)
+    plt.savefig(f"LR range {' | '.join(hyperparam)}.png")
+    plt.close()
+
+# yield batches from a loader forever, restarting it when it runs out
+def repeat_batches(loader):
+    while True:
+        for batch in loader:
+            yield batch
+
+def _synchronize(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+
+# time a few SGD steps over the given batches, returns images per second (warmup steps not counted)
+def time_train_steps(net, batches, device, steps=5, warmup=1, lr=0.01):
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(net.parameters(), lr=lr, momentum=0.9)
+    net.train()
+    batches = iter(batches)
+    images = 0
+    start = time.time()
+    for i in range(warmup + steps):
+        if i == warmup:
+            _synchronize(device)
+            start = time.time()
+            images = 0
+        inputs, targets = next(batches)[:2]
+        inputs, targets = inputs.to(device), targets.to(device)
+        optimizer.zero_grad()
+        loss = criterion(net(inputs), targets)
+        loss.backward()
+        optimizer.step()
+        images += inputs.size(0)
+    _synchronize(device)
+    return images / (time.time() - start)
+
+# number of trainable parameters
+def count_params(net):
+    return sum(p.numel() for p in net.parameters() if p.requires_grad)
+
+# multiply-accumulates of one forward pass on a single image, counted with forward hooks
+# on every conv and linear layer (BatchNorm, activations and pooling are ignored)
+def count_macs(net, image_size=32):
+    macs = []
+
+    def conv_hook(module, inputs, output):
+        kernel = module.kernel_size[0] * module.kernel_size[1]
+        macs.append(output[0].numel() * kernel * module.in_channels // module.groups)
+
+    def linear_hook(module, inputs, output):
+        macs.append(module.in_features * module.out_features)
+
+    hooks = []
+    for module in net.modules():
+        if isinstance(module, nn.Conv2d):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+    device = next(net.parameters()).device
+    was_training = net.training
+    net.eval()
+    with torch.no_grad():
+        net(torch.zeros(1, 3, image_size, image_size, device=device))
+    net.train(was_training)
+    for hook in hooks:
+        hook.remove()
+    return sum(macs)
+
+# load the weights of a training checkpoint ({'net': state_dict, ...} or a bare state_dict),
+# dropping the 'module.' prefix left by DataParallel / DistributedDataParallel
+def load_checkpoint_weights(net, path, device='cpu'):
+    checkpoint = torch.load(path, map_location=device)
+    state = checkpoint['net'] if isinstance(checkpoint, dict) and 'net' in checkpoint else checkpoint
+    state = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state.items()}
+    net.load_state_dict(state)
+    return net
+
+# top-1 accuracy (%) over a labelled loader
+def evaluate_accuracy(net, loader, device='cpu'):
+    net.eval()
+    correct = 0
+    total = 0
+    with torch.no_grad():
+        for inputs, targets in loader:
+            inputs, targets = inputs.to(device), targets.to(device)
+            correct += net(inputs).argmax(1).eq(targets).sum().item()
+            total += targets.size(0)
+    return 100.0 * correct / max(total, 1)
+
+# median forward latency in milliseconds for one batch of random 32x32 images
+def measure_latency(net, batch_size=1, device='cpu', iters=20, warmup=5, image_size=32):
+    net.eval()
+    inputs = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + iters):
+            _synchronize(device)
+            start = time.perf_counter()
+            net(inputs)
+            _synchronize(device)
+            if i >= warmup:
+                times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+# current resident memory of this process in MB
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+# peak resident memory of this process in MB (ru_maxrss is in KB on Linux)
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _isolated_child(conn, fn, args, kwargs):
+    try:
+        baseline = current_rss_mb()
+        result = fn(*args, **kwargs)
+        conn.send((result, peak_rss_mb() - baseline, None))
+    except Exception as e:
+        conn.send((None, 0.0, (type(e).__name__, repr(e))))
+    conn.close()
+
+# run fn in a forked process so its CPU peak memory can be measured on its own,
+# returns (result, peak RSS above the process baseline in MB).
+# A MemoryError in the child, or the child dying without reporting (OOM killer), raises MemoryError
+def run_isolated(fn, *args, **kwargs):
+    ctx = mp.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_isolated_child, args=(child_conn, fn, args, kwargs))
+    process.start()
+    # only the child may hold the write end, or recv() never sees EOF when it is killed
+    child_conn.close()
+    try:
+        result, peak_mb, error = parent_conn.recv()
+    except EOFError:
+        process.join()
+        raise MemoryError(f"isolated run died with exit code {process.exitcode}, likely out of memory")
+    finally:
+        parent_conn.close()
+    process.join()
+    if error is not None:
+        kind, message = error
+        if kind == 'MemoryError':
+            raise MemoryError(f"isolated run failed: {message}")
+        raise RuntimeError(f"isolated run failed: {message}")
+    return result, peak_mb
+
+# Help to test on the provided test data
+def generate_predictions(model, test_loader, device='cpu'):
+    model.eval()
+    predictions = []
+    with torch.no_grad():
+        for batch in test_loader:
+            images, _ = batch
+            images = images.to(device)
+            outputs = model(images)
+            _, preds = torch.max(outputs, dim=1)
+            predictions.extend(preds.cpu().numpy())
+    return predictions
+
+# functions to save the predictions to desirable output
+def save_predictions_to_csv(predictions, test_ids, csv_filename="predictions.csv"):
+    df = pd.DataFrame({"ID": test_ids, "Labels": predictions})
+    df.to_csv(csv_filename, index=False)
+    print(f"Predictions saved to {csv_filename}")
@@ -0,0 +1,137 @@
+"""
+Memory-mappable inference weights (safetensors-style layout):
+
+    8 bytes     little-endian length of the JSON header
+    header      {"name": {"dtype", "shape", "data_offsets": [start, end]}, "__metadata__": {...}}
+    data        raw tensor bytes, offsets relative to the end of the header
+
+Only the weights are stored, no optimizer / scheduler / trend lists. Loading maps the file
+copy-on-write and builds the tensors directly on the mapped pages (load_state_dict(assign=True)),
+so nothing is deserialized and every inference process on the host shares the same page cache.
+Floating point weights can be stored as fp16 / bf16 to halve the file.
+
+    python weights_io.py --model ResNet5M --checkpoint checkpoint/ckpt199.pth --dtype fp16
+"""
+
+import os
+import json
+import mmap
+import time
+import struct
+import argparse
+
+import torch
+
+from models.resnet import get_model
+from utils import load_checkpoint_weights, run_isolated, current_rss_mb
+
+DTYPES = {
+    'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'U8': torch.uint8,
+}
+DTYPE_NAMES = {v: k for k, v in DTYPES.items()}
+STORE_DTYPES = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+ALIGNMENT = 64
+
+
+def save_weights(state_dict, path, dtype=None, metadata=None):
+    header, tensors, offset = {}, [], 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu()
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        tensor = tensor.contiguous()
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': DTYPE_NAMES[tensor.dtype], 'shape': list(tensor.shape),
+                        'data_offsets': [offset, offset + size]}
+        tensors.append(tensor)
+        # keep every tensor aligned inside the mapping
+        offset += size + (-size) % ALIGNMENT
+    header['__metadata__'] = {k: str(v) for k, v in (metadata or {}).items()}
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * ((-(8 + len(header_bytes))) % ALIGNMENT)
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for tensor in tensors:
+            data = tensor.reshape(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() else b''
+            f.write(data)
+            f.write(b'\0' * ((-len(data)) % ALIGNMENT))
+    return path
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        return json.loads(f.read(header_len)), 8 + header_len
+
+
+# state_dict whose tensors live on the copy-on-write mapping of the file (no copy, shared pages)
+def load_weights(path):
+    header, data_start = read_header(path)
+    metadata = header.pop('__metadata__', {})
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    state = {}
+    for name, info in header.items():
+        dtype = DTYPES[info['dtype']]
+        start, end = info['data_offsets']
+        count = (end - start) // torch.empty((), dtype=dtype).element_size()
+        if count == 0:
+            state[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        state[name] = torch.frombuffer(mapping, dtype=dtype, count=count,
+                                       offset=data_start + start).view(info['shape'])
+    return state, metadata
+
+
+# model with its parameters on the mapped pages; fp16/bf16 files are upcast to fp32 unless
+# keep_dtype, which costs a copy but CPU kernels are mostly fp32
+def load_model(net, path, keep_dtype=False):
+    state, _ = load_weights(path)
+    if not keep_dtype:
+        state = {k: v.float() if v.is_floating_point() and v.dtype != torch.float32 else v
+                 for k, v in state.items()}
+    net.load_state_dict(state, assign=True)
+    return net.eval()
+
+
+def _shared_mb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[2])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def _measure_load(kind, model_name, path):
+    baseline = current_rss_mb()
+    start = time.perf_counter()
+    if kind == 'torch.load':
+        net = load_checkpoint_weights(get_model(model_name), path)
+    else:
+        net = load_model(get_model(model_name), path)
+    load_time = time.perf_counter() - start
+    with torch.no_grad():
+        net(torch.randn(1, 3, 32, 32))
+    return load_time, current_rss_mb() - baseline, _shared_mb()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export / benchmark memory-mapped inference weights')
+    parser.add_argument('--model', default='ResNet5M')
+    parser.add_argument('--checkpoint', required=True, help='torch.save checkpoint to export')
+    parser.add_argument('--dtype', default='fp32', choices=list(STORE_DTYPES))
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args()
+
+    out = args.out or os.path.splitext(args.checkpoint)[0] + f'.{args.dtype}.weights'
+    net = load_checkpoint_weights(get_model(args.model), args.checkpoint)
+    save_weights(net.state_dict(), out, STORE_DTYPES[args.dtype], metadata={'model': args.model})
+    print(f"wrote {out}: {os.path.getsize(out) / 2**20:.1f} MB "
+          f"(checkpoint {os.path.getsize(args.checkpoint) / 2**20:.1f} MB)")
+
+    # every load runs in a fresh forked process so the peak memory is its own
+    print(f"{'loader':<12}{'load ms':>10}{'rss MB':>10}{'peak MB':>10}{'shared MB':>11}")
+    for kind, path in [('torch.load', args.checkpoint), ('mmap', out)]:
+        (load_time, rss_mb, shared_mb), peak_mb = run_isolated(_measure_load, kind, args.model, path)
+        print(f"{kind:<12}{load_time * 1000:>10.1f}{rss_mb:>10.1f}{peak_mb:>10.1f}{shared_mb:>11.1f}")